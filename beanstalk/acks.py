@@ -0,0 +1,124 @@
+"""
+Deferred, batched deletes for consumers.
+
+With ack batching enabled on a ServerConn, Job.Finish() does not wait for
+its delete: the jid is queued, and the queued deletes are sent together,
+pipelined (see ServerConn.pipeline), when
+
+  - max_acks of them are queued,
+  - the oldest has been queued for linger milliseconds, checked whenever a
+    delete is queued or poll() is called,
+  - the connection is about to send a reserve, in which case the deletes go
+    in the same write as the reserve, costing no round trip at all,
+  - it sends any other command, or is closed.
+
+    conn = ServerConn(host, port, job=Job)
+    conn.enable_ack_batching(max_acks=100, linger=20, on_error=report)
+    while True:
+        job = conn.reserve()
+        handle(job)
+        job.Finish()
+
+A delete that fails, with errors.NotFound because the job's time to run ran
+out, or because the connection was lost before it was sent, is passed to
+on_error(jid, error) rather than raised; without on_error it is logged.
+Either way the job is back in the queue, so handlers must be idempotent, as
+they should be anyway. Whatever must wait until the job is really gone is
+given to add() as a callback, called once its delete succeeded; Job.Finish()
+passes Job._finished.
+"""
+
+import logging
+import time
+
+import protohandler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class AckBatcher(object):
+    '''Queued deletes of conn, a ServerConn. See the module documentation
+    and ServerConn.enable_ack_batching().'''
+
+    def __init__(self, conn, max_acks=100, linger=20, on_error=None):
+        self.conn = conn
+        self.max_acks = max_acks
+        self.linger = linger / 1000.0
+        self.on_error = on_error
+
+        self.sent = 0
+        self.failed = 0
+        self.flushing = False
+        self._jids = []
+        self._since = None
+
+    def __repr__(self):
+        return '<%s(%r) pending=%d>' % (self.__class__.__name__, self.conn,
+                                        self.pending)
+
+    @property
+    def pending(self):
+        '''the number of deletes queued'''
+        return len(self._jids)
+
+    def add(self, jid, deleted=None):
+        '''Queue a delete of jid; deleted(), if given, is called once it
+        succeeded.'''
+        if not self._jids:
+            self._since = time.time()
+        self._jids.append((jid, deleted))
+        if len(self._jids) >= self.max_acks:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        '''Send the queued deletes if the oldest has waited long enough.'''
+        if self._jids and time.time() - self._since >= self.linger:
+            self.flush()
+
+    def flush(self, command=None, timeout=None):
+        '''Send the queued deletes, followed by command, a (line, handler)
+        pair, if given. Returns the result of command, raising the error it
+        was answered with, if any. timeout bounds the exchange as for
+        ServerConn.pipeline.'''
+        if self.flushing:
+            return
+        jids, self._jids = self._jids, []
+        commands = [protohandler.process_delete(jid) for jid, deleted in jids]
+        if command is not None:
+            commands.append(command)
+        self.flushing = True
+        try:
+            results = self.conn.pipeline(commands, timeout)
+        except Exception, e:
+            for jid, deleted in jids:
+                self._failed(jid, e)
+            if command is not None:
+                raise
+            return
+        finally:
+            self.flushing = False
+        self.sent += len(jids)
+        for (jid, deleted), res in zip(jids, results):
+            if isinstance(res, Exception):
+                self._failed(jid, res)
+            elif deleted is not None:
+                try:
+                    deleted()
+                except Exception:
+                    logger.exception('%r: callback for job %s failed', self,
+                                     jid)
+        if command is not None:
+            if isinstance(results[-1], Exception):
+                raise results[-1]
+            return results[-1]
+
+    def _failed(self, jid, error):
+        self.failed += 1
+        if self.on_error is not None:
+            self.on_error(jid, error)
+        else:
+            logger.warning('%r: delete of job %s failed: %s', self, jid,
+                           error)
@@ -0,0 +1,69 @@
+"""
+Exponential backoff with jitter, for reconnecting and retrying.
+
+    policy = Backoff(initial=0.05, maximum=30, retries=10)
+    for delay in policy.delays():
+        time.sleep(delay)
+        try:
+            connect()
+            break
+        except socket.error:
+            pass
+
+The delay before attempt n (counting from 0) is drawn at random below
+min(maximum, initial * factor ** n). Jitter matters more than the exponent
+when many clients lose the same server at once: without it they all come
+back at the same instants and knock it over again.
+"""
+
+import random
+
+
+class Backoff(object):
+    '''How long to wait between attempts, and how many to make.
+
+    initial -- upper bound of the first delay, in seconds
+    maximum -- no delay is longer than this
+    factor -- the bound grows by this factor per attempt
+    jitter -- the fraction of each delay that is random: 1.0 ("full
+              jitter") spreads clients the most, 0 waits exactly the bound
+    retries -- the number of attempts, or None to never give up
+    '''
+
+    def __init__(self, initial=0.05, maximum=30.0, factor=2.0, jitter=1.0,
+                 retries=10):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.retries = retries
+
+    def __repr__(self):
+        return ('%s(initial=%r, maximum=%r, factor=%r, jitter=%r, retries=%r)'
+                % (self.__class__.__name__, self.initial, self.maximum,
+                   self.factor, self.jitter, self.retries))
+
+    def bound(self, attempt):
+        '''the longest delay before attempt (counting from 0)'''
+        # capped, since factor ** attempt overflows long before retries do
+        return min(self.maximum,
+                   self.initial * self.factor ** min(attempt, 64))
+
+    def delay(self, attempt):
+        '''a delay, in seconds, to wait before attempt'''
+        bound = self.bound(attempt)
+        return bound - random.uniform(0, bound * self.jitter)
+
+    def exhausted(self, attempt):
+        '''True if attempt is one more than allowed'''
+        return self.retries is not None and attempt >= self.retries
+
+    def delays(self):
+        '''the delay before each attempt, as many as there are attempts'''
+        attempt = 0
+        while not self.exhausted(attempt):
+            yield self.delay(attempt)
+            attempt += 1
+
+# a single attempt, at once
+ONCE = Backoff(initial=0, retries=1)
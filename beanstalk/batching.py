@@ -0,0 +1,225 @@
+"""
+Micro-batching: many small logical messages carried by one beanstalk job.
+
+A BatchProducer collects messages per tube and puts them as a single job once
+a batch holds max_messages messages, would grow past max_bytes, or has been
+open for linger milliseconds. On the consumer side a BatchJob iterates the
+messages of such a job; messages that could not be processed are marked with
+fail(), and Finish() re-enqueues only those before deleting the job.
+
+The envelope is a 4 byte magic string followed by every message, each one
+prefixed by its length as a 4 byte big endian unsigned integer.
+
+Producer:
+
+    producer = BatchProducer(conn, max_messages=500, linger=20)
+    for event in events:
+        producer.add(event, tube='events')
+    producer.close()
+
+Consumer:
+
+    conn = ServerConn(host, port, job=BatchJob)
+    job = conn.reserve()
+    for i, message in enumerate(job):
+        if not handle(message):
+            job.fail(i)
+    job.Finish()
+
+Note that the linger time is checked whenever add() or poll() is called;
+a producer that goes quiet should call poll() periodically, or flush().
+"""
+
+import struct
+import time
+
+import errors
+import protohandler
+from job import SlimJob
+
+MAGIC = 'PBB\x01'
+_length = struct.Struct('!I')
+
+
+def pack(messages):
+    '''build a batch envelope from a sequence of strings'''
+    parts = [MAGIC]
+    for m in messages:
+        parts.append(_length.pack(len(m)))
+        parts.append(m)
+    return ''.join(parts)
+
+def is_batch(body):
+    return body.startswith(MAGIC)
+
+def unpack(body):
+    '''return the list of messages in a batch envelope'''
+    if not is_batch(body):
+        raise errors.JobError('Job body is not a batch envelope')
+    messages = []
+    offset, end = len(MAGIC), len(body)
+    while offset < end:
+        if offset + _length.size > end:
+            raise errors.JobError('Truncated batch envelope')
+        size, = _length.unpack_from(body, offset)
+        offset += _length.size
+        if offset + size > end:
+            raise errors.JobError('Truncated batch envelope')
+        messages.append(body[offset:offset + size])
+        offset += size
+    return messages
+
+
+class _Batch(object):
+    __slots__ = ('messages', 'size', 'opened')
+
+    def __init__(self):
+        self.messages = []
+        self.size = len(MAGIC)
+        self.opened = time.time()
+
+
+class BatchProducer(object):
+    '''Groups messages per tube into batch jobs on conn, which may be a
+    ServerConn or a ServerPool. pri, delay and ttr apply to every batch job.
+
+    max_bytes defaults to the server's max job size. linger is given in
+    milliseconds. The producer keeps track of the tube it has told the
+    connection to use, so the connection should not be shared with code that
+    calls use() itself.
+    '''
+
+    def __init__(self, conn, max_messages=100, max_bytes=None, linger=50,
+                 pri=1, delay=0, ttr=60):
+        self.conn = conn
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.linger = linger / 1000.0
+        self.pri = pri
+        self.delay = delay
+        self.ttr = ttr
+
+        self._batches = {}
+        self._using = None
+
+    def _limit(self):
+        if self.max_bytes is not None:
+            return self.max_bytes
+        # process_put requires the body to be strictly below the max
+        return protohandler.MAX_JOB_SIZE - 1
+
+    def add(self, message, tube='default'):
+        '''add a message to the batch for tube. Returns the put replies of any
+        batches that were closed as a result, which may be an empty list.
+        Raises errors.JobTooBig, buffering nothing, for a message too big
+        for any batch.'''
+        sent = []
+        batch = self._batches.get(tube)
+        needed = _length.size + len(message)
+        if len(MAGIC) + needed > self._limit():
+            # would not fit even a batch of its own
+            raise errors.JobTooBig('Message size is %s (max allowed is %s)'
+                                   % (len(message),
+                                      self._limit() - len(MAGIC)
+                                      - _length.size))
+        if batch is not None and batch.size + needed > self._limit():
+            sent.append(self.flush_tube(tube))
+            batch = None
+        if batch is None:
+            batch = self._batches[tube] = _Batch()
+
+        batch.messages.append(message)
+        batch.size += needed
+
+        if len(batch.messages) >= self.max_messages:
+            sent.append(self.flush_tube(tube))
+        sent.extend(self.poll())
+        return sent
+
+    def poll(self):
+        '''flush the batches that have been open for longer than linger'''
+        if not self._batches:
+            return []
+        expired = time.time() - self.linger
+        return [self.flush_tube(tube)
+                for tube, batch in self._batches.items()
+                if batch.opened <= expired]
+
+    def flush_tube(self, tube):
+        '''put the batch for tube. If that fails the batch is kept, to be
+        sent by a later flush, and the error is raised.'''
+        batch = self._batches.get(tube)
+        if not batch or not batch.messages:
+            self._batches.pop(tube, None)
+            return None
+        if self._using != tube:
+            self.conn.use(tube)
+            self._using = tube
+        res = self.conn.put(pack(batch.messages), self.pri, self.delay,
+                            self.ttr)
+        del self._batches[tube]
+        return res
+
+    def flush(self):
+        return [self.flush_tube(tube) for tube in self._batches.keys()]
+
+    def close(self):
+        return self.flush()
+
+    @property
+    def pending(self):
+        '''number of messages waiting in open batches'''
+        return sum(len(b.messages) for b in self._batches.itervalues())
+
+
+class BatchJob(SlimJob):
+    '''A job carrying a batch envelope, see BatchProducer. data is the list of
+    messages, decoded on first access. A body that isn't a batch envelope is
+    treated as a batch of one message, so BatchJob can consume tubes where
+    batched and plain jobs are mixed.
+
+    Mark messages that failed with fail(index). Finish() then puts a new batch
+    job holding only the failed messages, into the tube this job came from
+    and with the same priority and ttr, before deleting this one.
+    '''
+
+    __slots__ = ('failed',)
+
+    def __init__(self, *args, **kw):
+        super(BatchJob, self).__init__(*args, **kw)
+        self.failed = set()
+
+    def _decode(self, body):
+        if not is_batch(body):
+            return [body]
+        return unpack(body)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def fail(self, index):
+        if not 0 <= index < len(self.data):
+            raise IndexError('batch has no message %s' % (index,))
+        self.failed.add(index)
+
+    def _requeue_failed(self):
+        messages = [m for i, m in enumerate(self.data) if i in self.failed]
+        stats = self.Server.stats_job(self.jid)['data']
+        oldtube = self.Server.tube
+        if oldtube != stats['tube']:
+            self.Server.use(stats['tube'])
+        try:
+            self.Server.put(pack(messages), stats['pri'], 0, stats['ttr'])
+        finally:
+            if oldtube != stats['tube']:
+                self.Server.use(oldtube)
+
+    def Finish(self):
+        if self.failed:
+            if self.imutable:
+                raise errors.JobError("Cannot do that to a job you don't own")
+            self._requeue_failed()
+        return super(BatchJob, self).Finish()
@@ -0,0 +1,137 @@
+"""
+Per-server circuit breakers, used by multiserverconn.ServerPool.
+
+A breaker is closed while its server is healthy. It opens when, of the last
+window calls, at least error_rate of them failed (a call slower than
+slow_call seconds counts as failed), or at once when trip() is called, e.g.
+because the connection was lost. While open the server gets no commands.
+Once the breaker's backoff delay has passed it is due for a probe; a probe
+that succeeds half-opens it, and the next real call closes it again or, if
+it fails, opens it for a longer delay.
+
+    breaker = CircuitBreaker(slow_call=0.5)
+    if breaker.allow():
+        start = time.time()
+        try:
+            call()
+        except ServerError:
+            breaker.record(time.time() - start, error=True)
+        else:
+            breaker.record(time.time() - start)
+"""
+
+import threading
+import time
+from collections import deque
+
+from backoff import Backoff
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    '''Health state of one server.
+
+    window -- how many recent calls the error rate is taken over
+    min_calls -- no tripping on the error rate before this many calls
+    error_rate -- the fraction of failed calls that opens the breaker
+    slow_call -- calls taking longer than this many seconds count as
+                 failed, None to not judge latency
+    backoff -- a backoff.Backoff; its delay(n) is how long the breaker stays
+               open after the n-th failed probe in a row
+    on_open -- called with the breaker whenever it opens
+    '''
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5,
+                 slow_call=None, backoff=None, on_open=None):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.backoff = backoff or Backoff(initial=1.0, maximum=30.0,
+                                          retries=None)
+        self.on_open = on_open
+
+        self.state = CLOSED
+        self.trips = 0
+        self.opened_at = None
+        self.retry_at = None
+        self._probes_failed = 0
+        self._calls = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s(%s)>' % (self.__class__.__name__, self.state)
+
+    def allow(self):
+        '''True if the server may be sent commands'''
+        return self.state != OPEN
+
+    def due(self, now=None):
+        '''True if the breaker is open and it is time to probe the server'''
+        return (self.state == OPEN and
+                (now or time.time()) >= self.retry_at)
+
+    def record(self, seconds, error=False):
+        '''Count a call that took seconds, and failed if error.'''
+        failed = error or (self.slow_call is not None and
+                           seconds > self.slow_call)
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    self._close()
+                return
+            self._calls.append(failed)
+            if self.state == CLOSED and len(self._calls) >= self.min_calls:
+                if sum(self._calls) >= self.error_rate * len(self._calls):
+                    self._open()
+
+    def trip(self):
+        '''Open the breaker, whatever the error rate.'''
+        with self._lock:
+            self._open()
+
+    def probed(self, ok):
+        '''Take the outcome of a probe of an open breaker: half-open it if
+        ok, or keep it open for longer.'''
+        with self._lock:
+            if self.state != OPEN:
+                return
+            if ok:
+                self.state = HALF_OPEN
+            else:
+                self._probes_failed += 1
+                self._open()
+
+    def _open(self):
+        if self.state == HALF_OPEN:
+            self._probes_failed += 1
+        elif self.state == CLOSED:
+            self.trips += 1
+            self.opened_at = time.time()
+        self.state = OPEN
+        self.retry_at = time.time() + self.backoff.delay(self._probes_failed)
+        if self.on_open is not None:
+            self.on_open(self)
+
+    def _close(self):
+        self.state = CLOSED
+        self.opened_at = self.retry_at = None
+        self._probes_failed = 0
+        self._calls.clear()
+
+    def snapshot(self):
+        calls = list(self._calls)
+        return {
+            'state': self.state,
+            'calls': len(calls),
+            'failures': sum(calls),
+            'error_rate': float(sum(calls)) / len(calls) if calls else 0.0,
+            'trips': self.trips,
+            'opened_at': self.opened_at,
+            'retry_at': self.retry_at,
+        }
@@ -0,0 +1,206 @@
+"""
+Claim-check support for payloads that are too big for beanstalkd.
+
+Instead of sending a large body to the server, the producer writes it to a
+blob store and puts a short reference in its place. The consumer side job
+class, ClaimCheckJob, recognises such references, reads the blob back when its
+data is first accessed, and removes the blob once the job is finished.
+
+Producer side:
+
+    store = LocalBlobStore('/var/spool/beanstalk-blobs')
+    conn.put(offload(payload, store))
+
+Consumer side:
+
+    ClaimCheckJob.blobstore = store
+    conn = ServerConn(host, port, job=ClaimCheckJob)
+    job = conn.reserve()
+    process(job.data)   # read from the blob store if it was offloaded
+    job.Finish()        # deletes the job, then the blob
+
+Both sides must of course be able to reach the same store.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import tempfile
+import uuid
+
+import errors
+import protohandler
+from job import SlimJob
+
+REFERENCE_PREFIX = 'pybeanstalk-claim-check:'
+
+
+class BlobStore(object):
+    '''Interface for claim-check blob stores. Keys are strings chosen by the
+    store, and must not contain whitespace.'''
+
+    def put(self, data):
+        '''store data, and return the key it can be read back with'''
+        raise NotImplementedError
+
+    def get(self, key):
+        '''return the data stored under key, raise KeyError if missing'''
+        raise NotImplementedError
+
+    def delete(self, key):
+        '''remove the data stored under key, missing keys are ignored'''
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    '''A content-addressed blob store in a local (or shared) directory.
+
+    Each blob is written once to objects/<sha1>, and every put adds a hard link
+    to it under refs/<sha1>-<token>. The ref name is the key. Identical
+    payloads thus share their disk space, while each job still owns the ref it
+    was given, and deleting a key only removes the object when its last ref
+    is gone.
+
+    Blobs are read back through mmap, see open().
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._objects = os.path.join(directory, 'objects')
+        self._refs = os.path.join(directory, 'refs')
+        for d in (self._objects, self._refs):
+            try:
+                os.makedirs(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def __repr__(self):
+        return '<%s(%s)>' % (self.__class__.__name__, self.directory)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest)
+
+    def _ref_path(self, key):
+        if os.sep in key or not key:
+            raise KeyError(key)
+        return os.path.join(self._refs, key)
+
+    def _write_object(self, digest, data):
+        fd, tmp = tempfile.mkstemp(dir=self._objects, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self._object_path(digest))
+        except:
+            os.unlink(tmp)
+            raise
+
+    def put(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        key = '%s-%s' % (digest, uuid.uuid4().hex)
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._write_object(digest, data)
+        try:
+            os.link(path, self._ref_path(key))
+        except OSError, e:
+            # the last ref was deleted (and the object with it) between our
+            # check and the link, so write it again
+            if e.errno != errno.ENOENT:
+                raise
+            self._write_object(digest, data)
+            os.link(path, self._ref_path(key))
+        return key
+
+    def open(self, key):
+        '''return a read only mmap of the blob. The caller must close it.
+        Empty blobs can't be mapped, for those an empty string is returned.'''
+        try:
+            f = open(self._ref_path(key), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+        try:
+            if not os.fstat(f.fileno()).st_size:
+                return ''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def get(self, key):
+        blob = self.open(key)
+        if not blob:
+            return ''
+        try:
+            return blob[:]
+        finally:
+            blob.close()
+
+    def delete(self, key):
+        ref = self._ref_path(key)
+        obj = self._object_path(key.partition('-')[0])
+        try:
+            os.unlink(ref)
+            if os.stat(obj).st_nlink <= 1:
+                os.unlink(obj)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def make_reference(key):
+    return '%s%s' % (REFERENCE_PREFIX, key)
+
+def reference_key(body):
+    '''return the blob key if body is a claim-check reference, else None'''
+    if len(body) > 512 or not body.startswith(REFERENCE_PREFIX):
+        return None
+    return body[len(REFERENCE_PREFIX):]
+
+def offload(data, store, threshold=None):
+    '''Return data itself if it fits in a job, else store it in store and
+    return a reference to it. threshold defaults to the server's max job
+    size, as learned by the connection (protohandler.MAX_JOB_SIZE).'''
+    if threshold is None:
+        threshold = protohandler.MAX_JOB_SIZE
+    if len(data) < threshold:
+        return data
+    return make_reference(store.put(data))
+
+
+class ClaimCheckJob(SlimJob):
+    '''A SlimJob that transparently resolves claim-check references.
+
+    Set blobstore on the class (or a subclass) to the store the producers
+    offload to. data reads the blob on first access; body is still the raw
+    reference. Finish() deletes the blob once the job itself was deleted,
+    which with ack batching is only when its delete succeeded.
+    '''
+
+    __slots__ = ()
+    blobstore = None
+
+    def _get_store(self):
+        if self.blobstore is None:
+            raise errors.JobError('%s.blobstore is not set, cannot resolve '
+                                  'claim-check references' %
+                                  (self.__class__.__name__,))
+        return self.blobstore
+
+    @property
+    def claim_key(self):
+        return reference_key(self.body)
+
+    def _decode(self, body):
+        key = reference_key(body)
+        if key is None:
+            return body
+        return self._get_store().get(key)
+
+    def _finished(self):
+        key = self.claim_key
+        if key is not None:
+            self._get_store().delete(key)
@@ -0,0 +1,278 @@
+"""
+Producer-side deduplication: putting the same job twice within a time window
+returns the jid of the first put instead of creating a second job.
+
+    producer = DedupProducer(conn, DedupCache(ttl=300))
+    jid = producer.put(payload, tube='orders', key=request_id)
+    # a retry of the same request, within 5 minutes:
+    producer.put(payload, tube='orders', key=request_id) == jid
+
+A job is identified by its tube and the key given to put(), or, without a
+key, a hash of its data. DedupCache keeps the jids of recent puts in memory,
+the least recently used dropped beyond max_entries and all of them after
+ttl seconds. Give it a SharedTable to also find the puts of other processes
+on the same host: a fixed size hash table in a memory-mapped file, locked
+with fcntl where available.
+
+Two puts of the same job racing each other may both reach the server; the
+cache only knows about puts that were answered.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import errors
+import protohandler
+
+_TABLE_MAGIC = 'PBDD'
+_table_header = struct.Struct('!4sII')
+# key digest, jid, expiry time
+_slot = struct.Struct('!16sQd')
+HEADER_SIZE = 64
+PROBES = 8
+
+
+def job_key(tube, data=None, key=None):
+    '''the digest identifying a put of data, or of key if given, into
+    tube'''
+    if key is None:
+        return hashlib.sha1('%s\0d\0%s' % (tube, data)).digest()[:16]
+    return hashlib.sha1('%s\0k\0%s' % (tube, key)).digest()[:16]
+
+
+class SharedTable(object):
+    '''A hash table of jids by key digest in the file at path, created with
+    room for slots entries if missing. Every key may be stored in one of
+    PROBES slots; when they are all taken the one expiring first goes.'''
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0644),
+                               'r+b')
+        try:
+            self._locked(self._init, slots)
+        except:
+            self._file.close()
+            raise
+
+    def __repr__(self):
+        return '<%s(%r) slots=%d>' % (self.__class__.__name__, self.path,
+                                      self.slots)
+
+    def _init(self, slots):
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            self._file.truncate(HEADER_SIZE + slots * _slot.size)
+            self._file.seek(0)
+            self._file.write(_table_header.pack(_TABLE_MAGIC, 1, slots))
+            self._file.flush()
+        self._file.seek(0)
+        magic, version, self.slots = _table_header.unpack(
+            self._file.read(_table_header.size))
+        if magic != _TABLE_MAGIC or version != 1:
+            raise errors.BeanStalkError('%s is not a dedup table' %
+                                        (self.path,))
+        self.size = HEADER_SIZE + self.slots * _slot.size
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+
+    def _locked(self, func, *args):
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                return func(*args)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _offsets(self, digest):
+        first = struct.unpack('!Q', digest[:8])[0] % self.slots
+        for i in xrange(min(PROBES, self.slots)):
+            yield HEADER_SIZE + ((first + i) % self.slots) * _slot.size
+
+    def _get(self, digest, now):
+        for offset in self._offsets(digest):
+            found, jid, expires = _slot.unpack_from(self._map, offset)
+            if found == digest:
+                return jid if expires > now else None
+        return None
+
+    def _set(self, digest, jid, expires, now):
+        victim = None
+        for offset in self._offsets(digest):
+            found, old_jid, old_expires = _slot.unpack_from(self._map, offset)
+            if found == digest or old_expires <= now:
+                victim = offset
+                break
+            if victim is None or old_expires < victim_expires:
+                victim, victim_expires = offset, old_expires
+        _slot.pack_into(self._map, victim, digest, jid, expires)
+
+    def get(self, digest):
+        '''the jid stored for digest, or None'''
+        return self._locked(self._get, digest, time.time())
+
+    def set(self, digest, jid, expires):
+        self._locked(self._set, digest, jid, expires, time.time())
+
+    def entries(self):
+        '''the number of entries not expired yet'''
+        def count(now):
+            return sum(1 for offset in xrange(HEADER_SIZE, self.size,
+                                              _slot.size)
+                       if _slot.unpack_from(self._map, offset)[2] > now)
+        return self._locked(count, time.time())
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class DedupCache(object):
+    '''The jids of recent puts by job_key() digest.
+
+    max_entries -- how many jids are kept in memory, least recently used
+                   dropped first
+    ttl -- seconds a put counts as recent
+    shared -- a SharedTable to share the jids with other processes, or None
+    '''
+
+    def __init__(self, max_entries=100000, ttl=300, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s entries=%d>' % (self.__class__.__name__,
+                                    len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, digest):
+        '''the jid of a recent put of digest, or None'''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(digest, None)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries[digest] = entry
+                    self.hits += 1
+                    return entry[0]
+                self.expirations += 1
+        if self.shared is not None:
+            jid = self.shared.get(digest)
+            if jid is not None:
+                self.shared_hits += 1
+                self._store(digest, jid, now + self.ttl)
+                return jid
+        self.misses += 1
+        return None
+
+    def add(self, digest, jid):
+        expires = time.time() + self.ttl
+        self._store(digest, jid, expires)
+        if self.shared is not None:
+            self.shared.set(digest, jid, expires)
+
+    def _store(self, digest, jid, expires):
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._entries[digest] = (jid, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''hit rate and size; bytes is an estimate of the memory the entries
+        take, not counting a shared table'''
+        with self._lock:
+            entries = len(self._entries)
+            item = self._entries and next(self._entries.iteritems())
+            # key, (jid, expires) and the OrderedDict's link
+            per_entry = (sys.getsizeof(item[0]) + sys.getsizeof(item[1]) +
+                         sys.getsizeof(item[1][1]) + sys.getsizeof([0] * 3)
+                         if item else 0)
+            size = sys.getsizeof(self._entries) + entries * per_entry
+        lookups = self.hits + self.shared_hits + self.misses
+        stats = {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits + self.shared_hits,
+            'shared-hits': self.shared_hits,
+            'misses': self.misses,
+            'hit-rate': (float(self.hits + self.shared_hits) / lookups
+                         if lookups else 0.0),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+        if self.shared is not None:
+            stats['shared-entries'] = self.shared.entries()
+            stats['shared-bytes'] = self.shared.size
+        return stats
+
+
+class DedupProducer(object):
+    '''Puts jobs through conn, a ServerConn or ServerPool, skipping those
+    put recently according to cache, a DedupCache.'''
+
+    def __init__(self, conn, cache=None):
+        self.conn = conn
+        self.cache = cache if cache is not None else DedupCache()
+        self.tube = 'default'
+        self._using = None
+
+    def __repr__(self):
+        return '<%s(%r, %r)>' % (self.__class__.__name__, self.conn,
+                                 self.cache)
+
+    def use(self, tube):
+        '''the tube later puts go to'''
+        protohandler.check_name(tube)
+        self.tube = tube
+
+    def put(self, data, pri=1, delay=0, ttr=60, tube=None, key=None):
+        '''Put data into tube, by default the one in use, unless the same
+        job was put recently. key identifies the job if given, otherwise
+        its data does. Returns the jid, of the earlier put for a
+        duplicate.'''
+        tube = tube or self.tube
+        digest = job_key(tube, data, key)
+        jid = self.cache.get(digest)
+        if jid is not None:
+            return jid
+        if tube != self._using:
+            self._using = None
+            self.conn.use(tube)
+            self._using = tube
+        try:
+            jid = self.conn.put(data, pri, delay, ttr)['jid']
+        except (errors.NotConnected, errors.ConnectionLost):
+            self._using = None
+            raise
+        self.cache.add(digest, jid)
+        return jid
@@ -6,6 +6,8 @@ class ProtoError(BeanStalkError): pass
 class ServerError(BeanStalkError): pass
 
 class NotConnected(BeanStalkError): pass
+class CommandTimeout(BeanStalkError): pass
+class QueueFull(BeanStalkError): pass
 
 class OutOfMemory(ServerError): pass
 class InternalError(ServerError): pass
@@ -20,6 +22,7 @@ class NotIgnored(ProtoError): pass
 class DeadlineSoon(ProtoError):pass
 
 class UnexpectedResponse(ProtoError): pass
+class ConnectionLost(ProtoError): pass
 
 def checkError(linestr):
     '''Note, this will throw an error internally for every case that is a
@@ -0,0 +1,371 @@
+"""
+An event driven, callback style connection, for running many connections in
+one thread without Twisted.
+
+    def got_job(job, conn):
+        conn.delete(job['jid'])
+        conn.reserve()
+
+    def got_error(eclass, e, tb):
+        print 'error', e
+
+    loop = EventLoop()
+    for i in range(100):
+        conn = EventConn(host, port, loop=loop, result_callback=got_job,
+                         error_callback=got_error)
+        conn.result_callback_args = (conn,)
+        conn.reserve()
+    loop.run()
+
+Commands return at once; their replies are passed to the callbacks from
+within EventLoop.run(). Commands may be issued without waiting for earlier
+replies: they are pipelined, and each reply goes to the callbacks of its own
+command.
+
+The loop uses the selectors module (Python 3.4+, or the selectors34 backport)
+if available, and select.poll otherwise.
+"""
+
+import errno
+import os
+import socket
+import select
+import time
+from collections import deque, namedtuple
+
+import errors
+import protohandler
+import transport
+
+try:
+    import selectors
+except ImportError:
+    try:
+        import selectors34 as selectors
+    except ImportError:
+        selectors = None
+
+if selectors is not None:
+    EVENT_READ = selectors.EVENT_READ
+    EVENT_WRITE = selectors.EVENT_WRITE
+    DefaultSelector = selectors.DefaultSelector
+else:
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+
+    SelectorKey = namedtuple('SelectorKey', 'fileobj fd events data')
+
+    class DefaultSelector(object):
+        '''The part of the selectors.BaseSelector interface EventLoop uses,
+        on top of select.poll.'''
+
+        def __init__(self):
+            self._poll = select.poll()
+            self._map = {}
+
+        def _mask(self, events):
+            return ((select.POLLIN if events & EVENT_READ else 0) |
+                    (select.POLLOUT if events & EVENT_WRITE else 0))
+
+        def register(self, fileobj, events, data=None):
+            key = SelectorKey(fileobj, fileobj.fileno(), events, data)
+            self._poll.register(key.fd, self._mask(events))
+            self._map[key.fd] = key
+            return key
+
+        def modify(self, fileobj, events, data=None):
+            key = self._map[fileobj.fileno()]._replace(events=events,
+                                                       data=data)
+            self._poll.modify(key.fd, self._mask(events))
+            self._map[key.fd] = key
+            return key
+
+        def unregister(self, fileobj):
+            key = self._map.pop(fileobj.fileno())
+            self._poll.unregister(key.fd)
+            return key
+
+        def select(self, timeout=None):
+            if timeout is not None:
+                timeout = max(0, int(timeout * 1000))
+            ready = []
+            for fd, mask in self._poll.poll(timeout):
+                key = self._map.get(fd)
+                if key is None:
+                    continue
+                events = 0
+                # errors and hangups show up as readable, recv() tells more
+                if mask & ~select.POLLOUT:
+                    events |= EVENT_READ
+                if mask & select.POLLOUT:
+                    events |= EVENT_WRITE
+                ready.append((key, events & key.events or EVENT_READ))
+            return ready
+
+        def get_map(self):
+            return self._map
+
+        def close(self):
+            self._map.clear()
+
+
+class EventLoop(object):
+    '''Dispatches socket events to any number of EventConns.'''
+
+    def __init__(self):
+        self.selector = DefaultSelector()
+        self._running = False
+
+    def register(self, conn, events):
+        self.selector.register(conn, events, conn)
+
+    def modify(self, conn, events):
+        self.selector.modify(conn, events, conn)
+
+    def unregister(self, conn):
+        self.selector.unregister(conn)
+
+    def connections(self):
+        return [key.data for key in self.selector.get_map().values()]
+
+    def busy(self):
+        '''True if any connection has a command waiting for its reply'''
+        for key in self.selector.get_map().values():
+            if key.data.pending():
+                return True
+        return False
+
+    def run(self, timeout=None):
+        '''Dispatch events until no connection has commands pending, stop()
+        is called, or timeout seconds passed.'''
+        deadline = None if timeout is None else time.time() + timeout
+        self._running = True
+        try:
+            while self._running and self.busy():
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        break
+                for key, events in self.selector.select(wait):
+                    key.data._handle(events)
+        finally:
+            self._running = False
+
+    def stop(self):
+        '''Make run() return, after the events at hand are dispatched.'''
+        self._running = False
+
+    def close(self):
+        for conn in self.connections():
+            conn.close()
+        self.selector.close()
+
+
+_default_loop = None
+
+def default_loop():
+    '''The loop EventConns use when none is given.'''
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    return _default_loop
+
+def run(timeout=None):
+    '''Run the default loop, see EventLoop.run().'''
+    default_loop().run(timeout)
+
+
+class _Command(object):
+    __slots__ = ('handler', 'result_callback', 'result_callback_args',
+                 'error_callback')
+
+    def __init__(self, handler, rc, rca, ec):
+        self.handler = handler
+        self.result_callback = rc
+        self.result_callback_args = rca
+        self.error_callback = ec
+
+
+class EventConn(object):
+    '''EventConn -- Like other connection types in pybeanstalk, is intended
+    to only handle the beanstalk related connections. Its initialization
+    variables are those of ServerConn (including transport addresses and
+    socket_options), plus loop, the EventLoop to run on (by default the
+    module's default_loop()), and the callbacks below.
+
+    The connection object also has a few special properties:
+    result_callback -- callable object, must take at least one argument,
+                       a response (or job if job is set and the protocol
+                       interaction returns a job), which will be the default
+                       callback.
+    result_callback_args -- a tuple which will be passed as *args to the
+                            result_callback when it is called
+    error_callback -- a callable that takes 3 arguments, which are the
+                      results of a sys.exc_info() call. For errors returned
+                      by the server the traceback is None.
+
+    Each command method takes the same arguments as in ServerConn, plus
+    result_callback, result_callback_args and error_callback keywords,
+    which override the connection defaults for that command.
+
+    The socket is non-blocking: commands are queued, and written out as
+    the socket takes them, many at a time. If the connection is lost, the
+    error_callback of every command still waiting is called.
+    '''
+
+    RECV_SIZE = 65536
+
+    def __init__(self, server, port=None, job=False, loop=None,
+                 result_callback=None, result_callback_args=(),
+                 error_callback=None, socket_options=None):
+        self.server = server
+        self.port = port
+        self.job = job
+        self.socket_options = socket_options
+        self.loop = loop if loop is not None else default_loop()
+        self.result_callback = result_callback
+        self.result_callback_args = result_callback_args
+        self.error_callback = error_callback
+
+        self._out = deque()
+        self._pending = deque()
+        self._reader = protohandler.ReplyReader()
+        self._socket = None
+        self._make_socket()
+
+    def __repr__(self):
+        s = "<[%(active)s]%(class)s(%(address)s)>"
+        active_ = "Open" if self._socket else "Closed"
+        return s % {"class" : self.__class__.__name__, "active" : active_,
+                    "address" : transport.format_address(self.server,
+                                                         self.port)}
+
+    def _make_socket(self):
+        self._socket, address = transport.make_socket(self.server, self.port,
+                                                      self.socket_options)
+        self._socket.setblocking(False)
+        err = self._socket.connect_ex(address)
+        # unix domain sockets may say EAGAIN when the backlog is full
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            self._socket.close()
+            self._socket = None
+            raise socket.error(err, os.strerror(err))
+        # writable once connected
+        self._connected = False
+        self._events = EVENT_READ | EVENT_WRITE
+        self.loop.register(self, self._events)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def pending(self):
+        '''the number of commands waiting for their reply'''
+        return len(self._pending)
+
+    def close(self):
+        '''Close the connection. Commands still waiting for their reply are
+        dropped without calling their callbacks.'''
+        if self._socket is None:
+            return
+        self.loop.unregister(self)
+        self._socket.close()
+        self._socket = None
+        self._out.clear()
+        self._pending.clear()
+
+    def _setup_callbacks(self, d):
+        rc = d.get('result_callback', self.result_callback)
+        if 'result_callback' in d:
+            rca = d.get('result_callback_args', ())
+        else:
+            rca = d.get('result_callback_args', self.result_callback_args)
+        ec = d.get('error_callback', self.error_callback)
+        if not (rc and ec):
+            raise errors.BeanStalkError('Callbacks missing')
+        return rc, rca, ec
+
+    def _do_interaction(self, line, handler, **callbacks):
+        if self._socket is None:
+            raise errors.NotConnected('%s is closed' % (self,))
+        self._pending.append(_Command(handler,
+                                      *self._setup_callbacks(callbacks)))
+        self._out.append(line)
+        # written once the loop finds the socket writable, together with
+        # whatever else was issued by then
+        self._update()
+
+    def _update(self):
+        events = EVENT_READ
+        if self._out or not self._connected:
+            events |= EVENT_WRITE
+        if events != self._events:
+            self._events = events
+            self.loop.modify(self, events)
+
+    def _handle(self, events):
+        if events & EVENT_WRITE:
+            if not self._connected:
+                err = self._socket.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_ERROR)
+                if err:
+                    return self._abort(socket.error(err, os.strerror(err)))
+                self._connected = True
+            self._write()
+        if events & EVENT_READ and self._socket is not None:
+            self._read()
+
+    def _write(self):
+        out = self._out
+        while out:
+            if len(out) > 1:
+                # pipelined commands go out in as few sends as possible
+                data = ''.join(out)
+                out.clear()
+                out.append(data)
+            data = out[0]
+            try:
+                sent = self._socket.send(data)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                return self._abort(e)
+            if sent < len(data):
+                out[0] = data[sent:]
+                break
+            out.popleft()
+        self._update()
+
+    def _read(self):
+        try:
+            data = self._socket.recv(self.RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self._abort(e)
+        if not data:
+            return self._abort(errors.ProtoError(
+                "Remote server %s has closed connection"
+                % (transport.format_address(self.server, self.port),)))
+        for command, res, e in self._reader.feed(data, self._pending):
+            if e is not None:
+                command.error_callback(e.__class__, e, None)
+                continue
+            if self.job and 'jid' in res:
+                res = self.job(conn=self, **res)
+            command.result_callback(res, *command.result_callback_args)
+            if self._socket is None:
+                # a callback closed the connection
+                return
+        if self._reader.buffered() and not self._pending:
+            self._abort(errors.UnexpectedResponse(
+                'Unexpected data from %s' % (self,)))
+
+    def _abort(self, e):
+        pending = list(self._pending)
+        self.close()
+        for command in pending:
+            command.error_callback(e.__class__, e, None)
+
+EventConn = protohandler.protProvider(EventConn, options=(
+    'result_callback', 'result_callback_args', 'error_callback'))
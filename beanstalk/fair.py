@@ -0,0 +1,149 @@
+"""
+Weighted fair consumption of several tubes.
+
+beanstalkd hands out the jobs of all watched tubes by priority, then age, so
+a tube flooded with urgent jobs starves the others. A FairConsumer instead
+reserves from one tube at a time, taking turns by deficit round robin: on
+its turn a tube is credited its weight times quantum, and is served one job
+per whole credit, while it has jobs. A tube found empty loses its credit
+and the turn passes. With weights {'noisy': 3, 'quiet': 1} and both tubes
+busy, 'quiet' gets one job in four.
+
+    consumer = FairConsumer(conn, {'tenant-a': 3, 'tenant-b': 1})
+    while True:
+        job = consumer.reserve()
+        ...
+        conn.delete(job['jid'])
+
+Turning to another tube changes the connection's watch list with watch and
+ignore commands; the watch list is remembered, so they are only sent when
+the tube changes, and they are pipelined with the reserve that follows them
+(see ServerConn.pipeline), in one round trip. When every tube is empty,
+reserve() watches all of them and waits for whichever gets a job first.
+
+The consumer owns the connection's watch list: do not watch or ignore tubes
+on it directly. If the connection is lost, the consumer asks for the watch
+list again before its next reserve, see ServerConn's reconnect.
+"""
+
+import time
+
+import errors
+import protohandler
+
+
+def _timed_out(res):
+    return isinstance(res, dict) and 'jid' not in res
+
+
+class FairConsumer(object):
+    '''Reserves jobs from the tubes of weights, a dict of tube names to
+    weights (or a list of (name, weight) pairs, setting the order of the
+    turns), through conn, a ServerConn.'''
+
+    def __init__(self, conn, weights, quantum=1.0):
+        self.conn = conn
+        if isinstance(weights, dict):
+            weights = sorted(weights.items())
+        self.tubes = [tube for tube, weight in weights]
+        self.weights = dict(weights)
+        self.quantum = quantum
+        for tube in self.tubes:
+            protohandler.check_name(tube)
+
+        self.received = dict((tube, 0) for tube in self.tubes)
+        self.round_trips = 0
+        self._deficit = dict((tube, 0.0) for tube in self.tubes)
+        self._turn = 0
+        self._credited = False
+        self._watching = set(conn.list_tubes_watched()['data'])
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.weights)
+
+    def stats(self):
+        total = sum(self.received.values())
+        return {
+            'received': dict(self.received),
+            'share': dict((tube, float(n) / total if total else 0.0)
+                          for tube, n in self.received.items()),
+            'deficit': dict(self._deficit),
+            'round-trips': self.round_trips,
+        }
+
+    def _send(self, commands):
+        '''the result of the last of commands'''
+        self.round_trips += 1
+        try:
+            res = self.conn.pipeline(commands)[-1]
+        except (errors.NotConnected, errors.ConnectionLost,
+                errors.CommandTimeout):
+            # some of the watches may not have been made, and the
+            # connection restores the ones it saw answered
+            self._watching = None
+            raise
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def _watch(self, tubes):
+        '''the commands turning the watch list into tubes'''
+        if self._watching is None:
+            self._watching = set(self.conn.list_tubes_watched()['data'])
+        commands = [protohandler.process_watch(t)
+                    for t in tubes if t not in self._watching]
+        # watched first, since the last tube cannot be ignored
+        commands.extend(protohandler.process_ignore(t)
+                        for t in self._watching if t not in tubes)
+        self._watching = set(tubes)
+        return commands
+
+    def _try(self, tube):
+        '''a job of tube, or None if it has none ready'''
+        commands = self._watch([tube])
+        commands.append(protohandler.process_reserve_with_timeout(0))
+        res = self._send(commands)
+        if _timed_out(res):
+            return None
+        return res
+
+    def _wait_any(self, timeout):
+        commands = self._watch(self.tubes)
+        if timeout is None:
+            commands.append(protohandler.process_reserve())
+        else:
+            commands.append(protohandler.process_reserve_with_timeout(
+                int(max(0, timeout))))
+        res = self._send(commands)
+        if _timed_out(res):
+            return None
+        tube = self.conn.stats_job(res['jid'])['data']['tube']
+        self.round_trips += 1
+        if tube in self.received:
+            self.received[tube] += 1
+        return res
+
+    def reserve(self, timeout=None):
+        '''The next job, by turns; if no tube has one, wait up to timeout
+        seconds (forever if None) for one. Returns None if none came.'''
+        deadline = None if timeout is None else time.time() + timeout
+        empty = set()
+        while True:
+            for i in xrange(len(self.tubes)):
+                tube = self.tubes[self._turn]
+                if not self._credited:
+                    self._deficit[tube] += self.quantum * self.weights[tube]
+                    self._credited = True
+                if self._deficit[tube] >= 1:
+                    job = self._try(tube)
+                    if job is not None:
+                        self._deficit[tube] -= 1
+                        self.received[tube] += 1
+                        return job
+                    empty.add(tube)
+                    self._deficit[tube] = 0.0
+                self._turn = (self._turn + 1) % len(self.tubes)
+                self._credited = False
+            if len(empty) == len(self.tubes):
+                wait = None if deadline is None else deadline - time.time()
+                return self._wait_any(wait)
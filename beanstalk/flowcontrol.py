@@ -0,0 +1,200 @@
+"""
+Producer flow control: puts paced by a token bucket whose rate follows the
+backlog of the tubes they go to.
+
+    producer = PacedProducer(conn, target_backlog=5000, rate=200)
+    producer.put(payload, tube='events')   # waits for a token if need be
+
+Every interval seconds the producer samples stats-tube for the tubes it put
+into, summed over the servers of a ServerPool. The rate grows by increase
+jobs per second after every sample with every tube's ready jobs below
+target_backlog (and its urgent jobs below target_urgent, if given), and is
+multiplied by decrease when a tube is above target and not shrinking, or
+when a put is answered with DRAINING or OUT_OF_MEMORY: additive increase,
+multiplicative decrease. The rate stays between min_rate and max_rate.
+
+Sampling happens in put(), so a producer that stops putting stops sampling
+too.
+"""
+
+import logging
+import threading
+import time
+
+import errors
+import protohandler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TokenBucket(object):
+    '''rate tokens a second, with up to burst of them saved up'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = self._capacity()
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s rate=%.1f>' % (self.__class__.__name__, self.rate)
+
+    def _capacity(self):
+        return float(self.burst if self.burst is not None
+                     else max(1.0, self.rate))
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.time())
+            self.rate = float(rate)
+            self._tokens = min(self._tokens, self._capacity())
+
+    def _refill(self, now):
+        self._tokens = min(self._capacity(),
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens=1, timeout=None):
+        '''Take tokens, waiting until there are enough. Returns False,
+        without taking any, if that would be longer than timeout seconds.'''
+        with self._lock:
+            self._refill(time.time())
+            wait = (tokens - self._tokens) / self.rate
+            if timeout is not None and wait > timeout:
+                return False
+            # taken now, paid for by waiting
+            self._tokens -= tokens
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+class PacedProducer(object):
+    '''Puts jobs through conn, a ServerConn or ServerPool, at a rate
+    adjusted to the backlog of their tubes.
+
+    target_backlog -- ready jobs a tube may have before the rate goes down
+    target_urgent -- urgent jobs a tube may have, None to not look at them
+    rate -- puts per second to start with
+    min_rate, max_rate -- bounds of the rate
+    increase -- puts per second added after a sample under target
+    decrease -- what the rate is multiplied by to back off
+    interval -- seconds between samples
+    '''
+
+    def __init__(self, conn, target_backlog=1000, target_urgent=None,
+                 rate=100.0, min_rate=1.0, max_rate=10000.0, increase=10.0,
+                 decrease=0.5, interval=1.0):
+        self.conn = conn
+        self.target_backlog = target_backlog
+        self.target_urgent = target_urgent
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.bucket = TokenBucket(rate)
+        self.tube = 'default'
+
+        self.backlog = {}
+        self.backoffs = 0
+        self.throttled = 0.0
+        self._sampled = time.time()
+        self._tubes = set()
+        self._using = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s(%r) rate=%.1f>' % (self.__class__.__name__, self.conn,
+                                       self.rate)
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'backlog': dict(self.backlog),
+            'backoffs': self.backoffs,
+            'throttled': self.throttled,
+        }
+
+    def use(self, tube):
+        '''the tube later puts go to'''
+        protohandler.check_name(tube)
+        self.tube = tube
+
+    def put(self, data, pri=1, delay=0, ttr=60, tube=None, timeout=None):
+        '''Put data into tube, by default the one in use, once the rate
+        allows it. Raises errors.QueueFull if that takes longer than
+        timeout seconds. Returns the jid.'''
+        tube = tube or self.tube
+        if time.time() - self._sampled >= self.interval:
+            self.sample()
+        start = time.time()
+        if not self.bucket.acquire(timeout=timeout):
+            raise errors.QueueFull('put rate is %.1f/s' % self.rate)
+        self.throttled += time.time() - start
+        with self._lock:
+            self._tubes.add(tube)
+            try:
+                if tube != self._using:
+                    self._using = None
+                    self.conn.use(tube)
+                    self._using = tube
+                return self.conn.put(data, pri, delay, ttr)['jid']
+            except (errors.Draining, errors.OutOfMemory), e:
+                logger.warning('%r: backing off: %s', self, e)
+                self.back_off()
+                raise
+            except (errors.NotConnected, errors.ConnectionLost):
+                self._using = None
+                raise
+
+    def _tube_stats(self, tube):
+        '''(ready, urgent) jobs of tube'''
+        if hasattr(self.conn, 'healthy_servers'):
+            servers = self.conn.healthy_servers()
+        else:
+            servers = [self.conn]
+        ready = urgent = 0
+        for server in servers:
+            try:
+                data = server.stats_tube(tube)['data']
+            except errors.NotFound:
+                # a tube without jobs or watchers is gone
+                continue
+            ready += data['current-jobs-ready']
+            urgent += data['current-jobs-urgent']
+        return ready, urgent
+
+    def sample(self):
+        '''Look at the backlog of the tubes put into, and adjust the rate.'''
+        with self._lock:
+            self._sampled = time.time()
+            over = growing = False
+            for tube in self._tubes:
+                ready, urgent = self._tube_stats(tube)
+                previous = self.backlog.get(tube, (0, 0))
+                self.backlog[tube] = (ready, urgent)
+                checks = [(ready, previous[0], self.target_backlog)]
+                if self.target_urgent is not None:
+                    checks.append((urgent, previous[1], self.target_urgent))
+                for jobs, before, target in checks:
+                    if jobs >= target:
+                        over = True
+                        growing = growing or jobs >= before
+        if growing:
+            self.back_off()
+        elif not over:
+            self._set_rate(self.rate + self.increase)
+
+    def back_off(self):
+        self.backoffs += 1
+        self._set_rate(self.rate * self.decrease)
+
+    def _set_rate(self, rate):
+        self.bucket.set_rate(min(self.max_rate, max(self.min_rate, rate)))
@@ -1,10 +1,12 @@
 import StringIO
+import math
 from pprint import pformat
 from functools import wraps
 
 import yaml
 
 import errors
+from backoff import Backoff
 
 DEFAULT_CONN = None
 
@@ -16,27 +18,57 @@ def honorimmutable(func):
         return func(*args, **kw)
     return deco
 
-class Job(object):
-    ''' class Job is an optional class for keeping track of jobs returned
-    by the beanstalk server.
+class RetryPolicy(object):
+    ''' class RetryPolicy says when and how often a failed job is tried
+    again, see JobBase.Retry.
 
-    It is designed to be as flexible as possible, with a minimal number of extra
-    methods. (See below).  It has 4 protocol methods, for dealing with the
-    server via a connection object. It also has 2 methods, _serialize and
-    _unserialize for dealing with the data returned by beanstalkd. These
-    default to a simple yaml dump and load respectively.
+    The delay before trying again grows exponentially, with jitter (see
+    backoff.Backoff), with the number of times the job was released before.
+    A job that failed attempts times in all is buried, with bury_pri, for
+    someone to look at. Kicking a buried job does not reset its count, so a
+    kicked job that fails again is buried again at once.
 
-    One intent is that in simple applications, the Job class can be a
-    superclass or mixin, with a method run. In this case, the pybeanstalk.main()
-    loop will get a Job, call its run method, and when finished delete the job.
+    delay -- the policy's backoff.Backoff, in seconds; release delays are
+             whole seconds, so they are rounded up
+    '''
 
-    In more complex applications, where the pybeanstalk.main is insufficient,
-    Job was designed so that processing data (e.g. data is more of a message),
-    can be handled within the specific data object (JobObj.data) or by external
-    means. In this case, Job is just a convenience class, to simplify job
-    management on the consumer end.
+    def __init__(self, attempts=5, initial=1.0, maximum=3600.0, factor=2.0,
+                 jitter=0.5, bury_pri=0):
+        self.attempts = attempts
+        self.bury_pri = bury_pri
+        self.delay = Backoff(initial, maximum, factor, jitter, attempts)
+
+    def __repr__(self):
+        return '%s(attempts=%r, %r)' % (self.__class__.__name__,
+                                        self.attempts, self.delay)
+
+    def retry_delay(self, releases):
+        '''the release delay of a job released releases times before, or
+        None if it should be buried'''
+        if self.delay.exhausted(releases + 1):
+            return None
+        return int(math.ceil(self.delay.delay(releases)))
+
+DEFAULT_RETRY = RetryPolicy()
+
+class JobBase(object):
+    ''' class JobBase holds the protocol methods shared by every job type. It
+    defines no storage of its own (note the empty __slots__), so subclasses are
+    free to pick either a regular instance __dict__ (Job) or a fixed set of
+    slots (SlimJob).
+
+    __init__ sets the attributes _conn, jid, pri, delay, state, imutable,
+    _from_queue, tube, ttr and releases, which subclasses must have room
+    for, and passes the body to _set_body, which subclasses implement to
+    store it.
+
+    retry_policy is the RetryPolicy of Retry; subclasses set their own.
     '''
 
+    __slots__ = ()
+
+    retry_policy = DEFAULT_RETRY
+
     def __init__(self, conn = None, jid=0, pri=0, data='', state = 'ok', **kw):
 
         if not any([conn, DEFAULT_CONN]):
@@ -47,15 +79,19 @@ class Job(object):
         self.pri = pri
         self.delay = 0
         self.state = state
-        self.data = data if data else ''
+        self._set_body(data if data else '')
 
         self.imutable = bool(kw.get('imutable', False))
         self._from_queue = bool(kw.get('from_queue', False))
         self.tube = kw.get('tube', 'default')
         self.ttr = kw.get('ttr', 60)
+        self.releases = kw.get('releases')
+
+    def _set_body(self, body):
+        raise NotImplementedError
 
     def __eq__(self, comparable):
-        if not isinstance(comparable, Job):
+        if not isinstance(comparable, JobBase):
             return False
         return not all([cmp(self.Server, comparable.Server),
                         cmp(self.jid, comparable.jid),
@@ -127,8 +163,33 @@ class Job(object):
         else:
             return True
 
+    @honorimmutable
+    def Retry(self):
+        ''' Release the job to be tried again after a delay growing with the
+        times it was released before, or bury it once it used up its
+        attempts, as retry_policy says. The count comes from the releases
+        attribute if the job was made with one (e.g. from a stats-job
+        reply), from stats-job otherwise, which also tells the job's
+        priority, kept by the release. Returns False if the job is no
+        longer reserved by this connection, like Return.'''
+        if self.releases is None:
+            try:
+                stats = self.Server.stats_job(self.jid)['data']
+            except errors.NotFound:
+                return False
+            self.releases, self.pri = stats['releases'], stats['pri']
+        delay = self.retry_policy.retry_delay(self.releases)
+        if delay is None:
+            return self.Bury(self.retry_policy.bury_pri)
+        return self.Delay(delay)
+
     @honorimmutable
     def Finish(self):
+        acks = getattr(self.Server, 'acks', None)
+        if acks is not None:
+            # sent later, see ServerConn.enable_ack_batching
+            acks.add(self.jid, self._finished)
+            return True
         try:
             self.Server.delete(self.jid)
         except errors.NotFound:
@@ -136,8 +197,13 @@ class Job(object):
         except:
             raise
         else:
+            self._finished()
             return True
 
+    def _finished(self):
+        '''Called once the job was deleted by Finish(), which may be later
+        than Finish() returns if the connection batches its deletes.'''
+
     @honorimmutable
     def Touch(self):
         try:
@@ -176,6 +242,72 @@ class Job(object):
     def Server(self):
         return self._conn
 
+class Job(JobBase):
+    ''' class Job is an optional class for keeping track of jobs returned
+    by the beanstalk server.
+
+    It is designed to be as flexible as possible, with a minimal number of extra
+    methods. (See below).  It has 4 protocol methods, for dealing with the
+    server via a connection object. It also has 2 methods, _serialize and
+    _unserialize for dealing with the data returned by beanstalkd. These
+    default to a simple yaml dump and load respectively.
+
+    One intent is that in simple applications, the Job class can be a
+    superclass or mixin, with a method run. In this case, the pybeanstalk.main()
+    loop will get a Job, call its run method, and when finished delete the job.
+
+    In more complex applications, where the pybeanstalk.main is insufficient,
+    Job was designed so that processing data (e.g. data is more of a message),
+    can be handled within the specific data object (JobObj.data) or by external
+    means. In this case, Job is just a convenience class, to simplify job
+    management on the consumer end.
+    '''
+
+    def _set_body(self, body):
+        self.data = body
+
+
+_UNDECODED = object()
+
+class SlimJob(JobBase):
+    ''' class SlimJob is a compact alternative to Job for consumers that hold
+    many reserved jobs at once, e.g. ServerConn(..., job=SlimJob).
+
+    Instances use __slots__ instead of a __dict__, and keep the raw body as
+    returned by the server in the body attribute. The data attribute is only
+    computed on first access, by passing the body through _decode, and the
+    result is cached. Consumers that route or filter on jid, pri or tube alone
+    never pay for decoding.
+
+    _decode returns the body unchanged, which matches what Job does with its
+    data. Subclasses override it to e.g. load yaml or json payloads.
+    '''
+
+    __slots__ = ('_conn', 'jid', 'pri', 'delay', 'state', 'imutable',
+                 '_from_queue', 'tube', 'ttr', 'releases', 'body', '_data')
+
+    def _set_body(self, body):
+        self.body = body
+        self._data = _UNDECODED
+
+    def _decode(self, body):
+        return body
+
+    def _get_data(self):
+        if self._data is _UNDECODED:
+            self._data = self._decode(self.body)
+        return self._data
+
+    def _set_data(self, value):
+        self._data = value
+
+    data = property(_get_data, _set_data)
+
+    @property
+    def decoded(self):
+        '''True once data has been computed (or assigned).'''
+        return self._data is not _UNDECODED
+
 def newJob(**kw):
     kw['from_queue'] = False
     return Job(**kw)
@@ -0,0 +1,180 @@
+"""
+Per-command instrumentation for connections.
+
+Metrics are off by default, and cost nothing but an attribute check per
+command while off. Turn them on per connection (or per pool):
+
+    conn = ServerConn(host, port)
+    conn.enable_metrics()
+    ...
+    conn.metrics()['put']['latency']['p99']
+
+For every command (by its wire name, e.g. 'put' or 'reserve-with-timeout')
+a Metrics object counts calls, reply states (e.g. 'ok', 'timeout', 'buried'),
+errors by class name (e.g. 'NotFound', 'DeadlineSoon'), bytes sent and
+received, and keeps a latency Histogram.
+
+To forward measurements elsewhere, add a hook. It is called after every
+command as hook(metrics, command, seconds, outcome, sent, received), where
+outcome is the reply state or the error class name, and metrics.name tells
+which connection it came from:
+
+    def forward(metrics, command, seconds, outcome, sent, received):
+        statsd.timing('beanstalk.%s' % command, seconds * 1000)
+    conn.enable_metrics().add_hook(forward)
+"""
+
+from array import array
+
+# bucket i counts latencies below 2**i microseconds (and at least 2**(i-1)),
+# the last bucket counts everything longer, i.e. above ~9 minutes
+BUCKETS = 30
+
+
+class Histogram(object):
+    '''A fixed size, log2-bucketed latency histogram.'''
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = array('L', [0] * BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        i = int(seconds * 1e6).bit_length()
+        self.counts[i if i < BUCKETS else BUCKETS - 1] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    @staticmethod
+    def upper_bound(i):
+        '''upper bound of bucket i, in seconds'''
+        return 2 ** i / 1e6
+
+    def percentile(self, p):
+        '''upper bound (in seconds) of the bucket holding the p-th percentile,
+        which overestimates the true value by at most a factor 2'''
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.upper_bound(i), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': dict((self.upper_bound(i), n)
+                            for i, n in enumerate(self.counts) if n),
+        }
+
+
+class CommandStats(object):
+    __slots__ = ('latency', 'replies', 'errors', 'bytes_sent',
+                 'bytes_received')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.replies = {}
+        self.errors = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        for mine, theirs in ((self.replies, other.replies),
+                             (self.errors, other.errors)):
+            for key, n in theirs.iteritems():
+                mine[key] = mine.get(key, 0) + n
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+
+    def snapshot(self):
+        return {
+            'count': self.latency.count,
+            'latency': self.latency.snapshot(),
+            'replies': dict(self.replies),
+            'errors': dict(self.errors),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+
+def command_name(line):
+    '''the wire command name of a protocol line, e.g. "put"'''
+    return line.split(None, 1)[0]
+
+def reply_state(result):
+    '''the state of a reply dict or Job'''
+    if isinstance(result, dict):
+        return result.get('state')
+    return getattr(result, 'state', None)
+
+
+class Metrics(object):
+    '''Per-command statistics for one connection (or several, if shared).'''
+
+    def __init__(self, name=None, hooks=()):
+        self.name = name
+        self.commands = {}
+        self.hooks = list(hooks)
+
+    def __repr__(self):
+        return '<%s(%s)>' % (self.__class__.__name__, self.name)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, command, seconds, sent, received, state=None,
+               error=None):
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.latency.record(seconds)
+        stats.bytes_sent += sent
+        stats.bytes_received += received
+        if error is not None:
+            outcome = error.__class__.__name__
+            stats.errors[outcome] = stats.errors.get(outcome, 0) + 1
+        else:
+            outcome = state
+            stats.replies[state] = stats.replies.get(state, 0) + 1
+        for hook in self.hooks:
+            hook(self, command, seconds, outcome, sent, received)
+
+    def merge(self, other):
+        for command, theirs in other.commands.iteritems():
+            mine = self.commands.get(command)
+            if mine is None:
+                mine = self.commands[command] = CommandStats()
+            mine.merge(theirs)
+
+    def reset(self):
+        self.commands.clear()
+
+    def snapshot(self):
+        return dict((command, stats.snapshot())
+                    for command, stats in self.commands.iteritems())
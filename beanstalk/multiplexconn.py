@@ -0,0 +1,414 @@
+"""
+A connection many threads can share: MultiplexedConn sends the commands of
+all its callers down one socket, from an I/O thread of its own.
+
+    conn = MultiplexedConn(host, port)
+
+    def produce():          # in as many threads as you like
+        conn.use('events')
+        while True:
+            conn.put(next_event())
+
+    future = conn.submit(*protohandler.process_stats())   # without waiting
+    future.result()
+
+Callers append their command, a (line, handler) pair as returned by the
+protohandler process_* functions, to a queue (a deque, which needs no lock)
+and wait on a future. The I/O thread takes everything queued, writes it in
+one send, and hands the replies back in order: beanstalkd answers the
+commands of a connection in the order they came, so the replies are matched
+to their callers first in, first out. Under load the commands of many
+threads go out together while earlier replies are on their way, pipelined
+without anyone asking for it.
+
+The tube in use is kept per thread. The I/O thread sends a use ahead of a
+thread's command when the connection uses another tube, so every thread
+sees the connection as if it were its own. Reserves, watch and ignore are
+refused: a reserve waiting for a job would hold up the replies of every
+other caller, and there is only one watch list. Consumers need connections
+of their own.
+
+A caller that times out gets errors.CommandTimeout, but unlike a ServerConn
+the connection stays open, since the late reply is still matched to its
+command and dropped. When the connection is lost, the commands waiting for
+their reply fail with errors.ConnectionLost, except those in
+serverconn.IDEMPOTENT, which are sent again if reconnect (a backoff.Backoff,
+or True for the default one) is given; the I/O thread then reconnects when
+it has something to send. Without reconnect the connection is closed, and
+later commands raise errors.NotConnected.
+
+submit() returns a concurrent.futures.Future if the futures package is
+available, and a compatible one otherwise, see the producer module.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+import backoff
+import errors
+import protohandler
+import transport
+from metrics import command_name
+from producer import Future, TimeoutError as FutureTimeout
+from serverconn import IDEMPOTENT, MAX_REPLAYS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# the commands that cannot share a connection
+REFUSED = frozenset(['reserve', 'reserve-with-timeout', 'watch', 'ignore'])
+
+RECV_SIZE = 65536
+
+
+class _Request(object):
+    __slots__ = ('line', 'handler', 'future', 'tube', 'replays')
+
+    def __init__(self, line, handler, future=None, tube=None):
+        self.line = line
+        self.handler = handler
+        # None for the uses the I/O thread sends of its own
+        self.future = future
+        self.tube = tube
+        self.replays = 0
+
+
+class MultiplexedConn(object):
+    '''One connection to server (and port), for any number of threads.
+    job, socket_options and reconnect are as for a ServerConn; timeout
+    bounds connecting and how long callers wait for a reply.'''
+
+    def __init__(self, server, port=None, job=False, socket_options=None,
+                 timeout=None, reconnect=None):
+        self.job = job
+        self.server = server
+        self.port = port
+        self.socket_options = socket_options
+        self.timeout = timeout
+        self.backoff = backoff.Backoff() if reconnect is True else reconnect
+
+        self.requests = 0
+        self.writes = 0
+        self.uses = 0
+        self.reconnects = 0
+        self._queue = deque()
+        self._replay = []
+        self._pending = deque()
+        self._local = threading.local()
+        self._using = 'default'
+        self._closed = False
+        self._stopped = False
+        self._socket = None
+        self._connect()
+
+        self._signalled = False
+        self._wake_r, self._wake_w = os.pipe()
+        fcntl.fcntl(self._wake_r, fcntl.F_SETFL,
+                    fcntl.fcntl(self._wake_r, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._thread = threading.Thread(target=self._run,
+                                        name='MultiplexedConn')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        s = "<[%(active)s]%(class)s(%(address)s)>"
+        active_ = "Closed" if self._closed else "Open"
+        return s % {"class" : self.__class__.__name__, "active" : active_,
+                    "address" : transport.format_address(self.server,
+                                                         self.port)}
+
+    @property
+    def tube(self):
+        '''the tube in use by the calling thread'''
+        return getattr(self._local, 'tube', 'default')
+
+    def io_stats(self):
+        '''counters of the I/O thread; stats() is the server's'''
+        return {
+            'queued': len(self._queue),
+            'in-flight': len(self._pending),
+            'requests': self.requests,
+            'writes': self.writes,
+            'uses': self.uses,
+            'reconnects': self.reconnects,
+        }
+
+    def submit(self, line, handler):
+        '''Queue the command line, answered through handler, and return a
+        Future resolved with its result or the error it was answered
+        with.'''
+        name = command_name(line)
+        if name in REFUSED:
+            raise errors.BeanStalkError(
+                '%s cannot be shared, use a connection of its own' % (name,))
+        if self._closed:
+            raise errors.NotConnected('%r is closed' % (self,))
+        if name == 'use':
+            self._local.tube = line.split()[1]
+        request = _Request(line, handler, Future(), self.tube)
+        self._queue.append(request)
+        if self._stopped:
+            # the I/O thread is gone, it may not have seen the request
+            self._fail_queued(errors.NotConnected('%r is closed' % (self,)))
+        elif not self._signalled:
+            self._wake()
+        return request.future
+
+    def _do_interaction(self, line, handler, timeout=None):
+        future = self.submit(line, handler)
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            raise errors.CommandTimeout(
+                '%s: %s got no reply in time'
+                % (transport.format_address(self.server, self.port),
+                   command_name(line)))
+
+    def close(self, timeout=None):
+        '''Stop taking commands, and stop the I/O thread once the ones
+        queued are answered. Returns False if that took longer than timeout
+        seconds.'''
+        self._closed = True
+        self._wake()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return False
+        if self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
+        return True
+
+    def _wake(self):
+        '''make the I/O thread look at the queue'''
+        self._signalled = True
+        fd = self._wake_w
+        if fd is not None:
+            try:
+                os.write(fd, 'x')
+            except OSError:
+                # closed meanwhile
+                pass
+
+    def _fail_queued(self, error):
+        while True:
+            try:
+                request = self._queue.popleft()
+            except IndexError:
+                return
+            request.future.set_exception(error)
+
+    #
+    # the I/O thread
+    #
+
+    def _connect(self):
+        sock = transport.connect(self.server, self.port, self.socket_options,
+                                 self.timeout)
+        try:
+            line, handler = protohandler.process_stats()
+            sock.sendall(line)
+            reader = protohandler.ReplyReader()
+            pending = deque([_Request(line, handler)])
+            while pending:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    raise errors.ConnectionLost('closed while connecting')
+                for command, res, e in reader.feed(data, pending):
+                    if e is not None:
+                        raise e
+            protohandler.MAX_JOB_SIZE = res['data']['max-job-size']
+        except:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        self._socket = sock
+        self._reader = reader
+        self._using = 'default'
+
+    def _reconnect(self):
+        '''connect again, or fail what is waiting to be sent and return
+        False'''
+        if self.backoff is None:
+            # requests queued while the connection was being given up on
+            self._give_up(errors.NotConnected('%r is closed' % (self,)))
+            return False
+        address = transport.format_address(self.server, self.port)
+        error = None
+        for delay in self.backoff.delays():
+            time.sleep(delay)
+            try:
+                self._connect()
+                self.reconnects += 1
+                return True
+            except (socket.error, errors.ConnectionLost), e:
+                error = e
+                logger.warning("Reconnecting to %s failed: %s", address, e)
+        self._give_up(errors.NotConnected(
+            '%s: could not reconnect: %s' % (address, error)))
+        return False
+
+    def _give_up(self, error):
+        self._closed = True
+        for request in self._replay:
+            request.future.set_exception(error)
+        self._replay = []
+        self._fail_queued(error)
+
+    def _take(self, out):
+        '''move the queued requests to out, the data to send'''
+        requests = self._replay
+        self._replay = []
+        queue = self._queue
+        while queue:
+            request = queue.popleft()
+            if request.future.set_running_or_notify_cancel():
+                requests.append(request)
+        for request in requests:
+            if request.line.startswith('use '):
+                self._using = request.tube
+            elif request.tube != self._using:
+                use = _Request(*protohandler.process_use(request.tube))
+                out.append(use.line)
+                self._pending.append(use)
+                self._using = request.tube
+                self.uses += 1
+            out.append(request.line)
+            self._pending.append(request)
+        self.requests += len(requests)
+
+    def _write(self, out):
+        if len(out) > 1:
+            data = ''.join(out)
+            del out[:]
+            out.append(data)
+        data = out[0]
+        try:
+            sent = self._socket.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self.writes += 1
+        if sent < len(data):
+            out[0] = data[sent:]
+        else:
+            del out[:]
+
+    def _read(self):
+        try:
+            data = self._socket.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            raise errors.ConnectionLost('has closed connection')
+        for command, res, e in self._reader.feed(data, self._pending):
+            if command.future is None:
+                if e is not None:
+                    logger.warning('%r: %s failed: %s', self,
+                                   command.line.strip(), e)
+                continue
+            if e is not None:
+                command.future.set_exception(e)
+                continue
+            if self.job and 'jid' in res:
+                res = self.job(conn=self, **res)
+            command.future.set_result(res)
+        if self._reader.buffered() and not self._pending:
+            raise errors.UnexpectedResponse('Unexpected data')
+
+    def _lost(self, reason, out):
+        self._socket.close()
+        self._socket = None
+        del out[:]
+        address = transport.format_address(self.server, self.port)
+        logger.warning('Connection to %s lost: %s', address, reason)
+        error = errors.ConnectionLost('Remote server %s: %s'
+                                      % (address, reason))
+        for request in self._pending:
+            if request.future is None:
+                continue
+            if (self.backoff is not None and request.replays < MAX_REPLAYS
+                    and command_name(request.line) in IDEMPOTENT):
+                request.replays += 1
+                request.handler = request.handler.clone()
+                self._replay.append(request)
+            else:
+                request.future.set_exception(error)
+        self._pending.clear()
+        if self.backoff is None:
+            self._give_up(errors.NotConnected('%r is closed' % (self,)))
+
+    def _drain_wake(self):
+        try:
+            os.read(self._wake_r, 4096)
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _done(self, out):
+        return (self._closed and not self._queue and not self._replay and
+                not self._pending and not out)
+
+    def _run(self):
+        out = []
+        try:
+            while not self._done(out):
+                if self._socket is None:
+                    if not (self._queue or self._replay):
+                        if self._closed:
+                            break
+                        select.select([self._wake_r], [], [])
+                        self._drain_wake()
+                        continue
+                    if not self._reconnect():
+                        break
+                # cleared before taking: a request queued after this
+                # wakes the thread again
+                self._signalled = False
+                self._take(out)
+                try:
+                    if out:
+                        self._write(out)
+                    if self._done(out):
+                        break
+                    writable = [self._socket] if out else []
+                    readable, writable, x = select.select(
+                        [self._socket, self._wake_r], writable, [])
+                    if self._wake_r in readable:
+                        self._drain_wake()
+                    if self._socket in writable:
+                        self._write(out)
+                    if self._socket in readable:
+                        self._read()
+                except (socket.error, errors.ConnectionLost,
+                        errors.UnexpectedResponse), e:
+                    self._lost(e, out)
+        except Exception, e:
+            logger.exception('%r: I/O thread failed', self)
+            self._closed = True
+            for request in self._pending:
+                if request.future is not None:
+                    request.future.set_exception(e)
+            self._pending.clear()
+            self._give_up(e)
+        finally:
+            self._stopped = True
+            self._fail_queued(errors.NotConnected('%r is closed' % (self,)))
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+MultiplexedConn = protohandler.protProvider(MultiplexedConn,
+                                            options=('timeout',))
@@ -8,12 +8,17 @@ import asynchat
 import errno
 import traceback
 import time
+import math
 import sys
 import copy
 
 import protohandler
-from serverconn import ServerConn
+import transport
+from backoff import Backoff
+from breaker import CircuitBreaker, OPEN, HALF_OPEN
+from serverconn import ServerConn, IDEMPOTENT, RESERVE_MARGIN, _timed_out
 from job import Job
+from metrics import Metrics, command_name, reply_state
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -28,20 +33,52 @@ logger.setLevel(logging.INFO)
 ASYNCORE_TIMEOUT = 0.1
 ASYNCORE_COUNT   = 10
 
+# how often ServerPool looks for servers due for a health probe, and how long
+# a probe may take
+PROBE_INTERVAL = 0.5
+PROBE_TIMEOUT = 2.0
+
 class ServerInUse(Exception): pass
 
+
+def _wait_for_replies(servers, deadline=None):
+    """Runs the asyncore loop until none of servers has a command
+    outstanding. Gives up after ASYNCORE_COUNT rounds of ASYNCORE_TIMEOUT
+    seconds, as asyncore.loop(count=ASYNCORE_COUNT) would, or at deadline if
+    given.
+
+    """
+    rounds = 0
+    while [s for s in servers if s.line or s.waiting]:
+        timeout = ASYNCORE_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+            if timeout <= 0:
+                return
+        elif rounds == ASYNCORE_COUNT:
+            return
+        asyncore.loop(use_poll=True, timeout=timeout, count=1)
+        rounds += 1
+
 class AsyncServerConn(object, asyncore.dispatcher):
-    def __init__(self, server, port, job = False):
+    def __init__(self, server, port = None, job = False,
+                 socket_options = None):
         self.job = job
         self.server = server
         self.port = port
+        self.socket_options = socket_options
 
         self.__line = None
         self.__handler = None
         self.__result = None
         self.__waiting = False
         self.__mutex = threading.Lock()
+        self.__sent = None
+        self.__started = None
 
+        # set by the ServerPool, a breaker.CircuitBreaker
+        self.breaker = None
+        self._metrics = None
         self._socket  = None
         asyncore.dispatcher.__init__(self)
 
@@ -50,32 +87,15 @@ class AsyncServerConn(object, asyncore.dispatcher):
         return s % {'id' : id(self), 'object' : self }
 
     def __str__(self):
-        s = "%(class)s(%(ip)s:%(port)s#[%(active)s][%(waiting)s])"
+        s = "%(class)s(%(address)s#[%(active)s][%(waiting)s])"
         active_ = "Open" if self._socket else "Closed"
         waiting_ = "Waiting" if self.__waiting else "NotWaiting"
         return s % {"class" : self.__class__.__name__,
                     "active" : active_,
-                    "ip" : self.server,
-                    "port" : self.port,
+                    "address" : transport.format_address(self.server,
+                                                         self.port),
                     "waiting" : waiting_}
 
-    def __getattribute__(self, attr):
-        res = getattr(protohandler, 'process_%s' % attr, None)
-        if res:
-            def caller(*args, **kw):
-                logger.info("Calling %s on %r with args(%s), kwargs(%s)",
-                             res.__name__, self, args, kw)
-
-                func = self._do_interaction
-                func(*res(*args, **kw))
-                asyncore.loop(use_poll=True,
-                              timeout=ASYNCORE_TIMEOUT,
-                              count=ASYNCORE_COUNT)
-                return self.result
-            return caller
-
-        return super(AsyncServerConn, self).__getattribute__(attr)
-
     def __eq__(self, comparable):
         #for unit testing
         assert isinstance(comparable, AsyncServerConn)
@@ -88,7 +108,14 @@ class AsyncServerConn(object, asyncore.dispatcher):
 
     def _get_response(self):
         while True:
-            recv = self._socket.recv(self.handler.remaining)
+            try:
+                recv = self._socket.recv(self.handler.remaining)
+            except socket.error, e:
+                # e.g. reset by peer: as lost as a closed connection
+                self.close()
+                raise protohandler.errors.NotConnected, (
+                    "Remote server %s:%s: %s" % (self.server, self.port, e),
+                    self)
 
             if not recv:
                 closedmsg = "Remote server %(server)s:%(port)s has "\
@@ -110,6 +137,11 @@ class AsyncServerConn(object, asyncore.dispatcher):
         self.line = line
         self.handler = handler
 
+    def _interact_and_wait(self, line, handler):
+        self._do_interaction(line, handler)
+        _wait_for_replies([self])
+        return self.result
+
     def _get_watchlist(self):
         return self.list_tubes_watched()['data']
 
@@ -189,10 +221,19 @@ class AsyncServerConn(object, asyncore.dispatcher):
     def connect(self):
         # else the socket is not open at all
         # so, open the socket, and add it to the dispatcher
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket, address = transport.make_socket(self.server, self.port,
+                                                      self.socket_options)
         self.set_socket(self._socket) # set socket to asyncore.dispatcher
         self.set_reuse_addr() # try to re-use the address
-        self._socket.connect((self.server, self.port))
+        self._socket.connect(address)
+
+    def attach(self, sock):
+        """Use sock, already connected to the server, as the connection.
+        Unlike connect(), no stats is sent.
+
+        """
+        self._socket = sock
+        self.set_socket(self._socket)
 
     def interact(self, line):
         self.__assert_not_waiting()
@@ -202,6 +243,8 @@ class AsyncServerConn(object, asyncore.dispatcher):
             raise protohandler.errors.ProtoError(e)
 
     def close(self):
+        if self._socket is None:
+            return
         self._socket.close()
         self.del_channel()
         # very important in python to set to None
@@ -212,12 +255,48 @@ class AsyncServerConn(object, asyncore.dispatcher):
     def fileno(self):
         return self._socket.fileno()
 
+    def enable_metrics(self, metrics=None):
+        '''Start collecting per-command metrics, see ServerConn'''
+        if metrics is None:
+            metrics = Metrics(transport.format_address(self.server,
+                                                       self.port))
+        self._metrics = metrics
+        return metrics
+
+    def disable_metrics(self):
+        self._metrics = None
+
+    def metrics(self):
+        if self._metrics is None:
+            return {}
+        return self._metrics.snapshot()
+
+    def __record(self, state=None, error=None):
+        line, start = self.__sent
+        self.__sent = None
+        self._metrics.record(command_name(line), time.time() - start,
+                             len(line), self.handler.received,
+                             state=state, error=error)
+
     @threadsafe
     def handle_read(self):
         logger.info("Handling read on %s", self)
         try:
             self.__result = self._get_response()
             logger.info("Results are: %s", self.result)
+        except Exception, e:
+            if self.__sent is not None:
+                self.__record(error=e)
+            if self.breaker is not None:
+                # errors like NotFound still mean a healthy server
+                self.breaker.record(time.time() - self.__started,
+                    error=not isinstance(e, protohandler.errors.ProtoError))
+            raise
+        else:
+            if self.__sent is not None:
+                self.__record(state=reply_state(self.__result))
+            if self.breaker is not None:
+                self.breaker.record(time.time() - self.__started)
         finally:
             # must make sure that waiting is set to false!
             self.__waiting = False
@@ -225,6 +304,9 @@ class AsyncServerConn(object, asyncore.dispatcher):
     @threadsafe
     def handle_write(self):
         logger.info("writing: %s to %s", self.line, self)
+        self.__started = time.time()
+        if self._metrics is not None:
+            self.__sent = (self.line, self.__started)
         self.interact(self.line)
         self.__waiting = True
         self.__line = None
@@ -239,15 +321,13 @@ class AsyncServerConn(object, asyncore.dispatcher):
     def handle_error(self):
         # get exception information
         exctype, value = sys.exc_info()[:2]
-        # if we disconnected..
+        # if we disconnected, the pool reconnects (with backoff) and decides
+        # whether the command may be sent again
         if exctype == protohandler.errors.NotConnected:
             msg, server = value
-            logger.warn("Got %s, so, reconnecting to: %s", msg, server)
-            assert server == self # sanity 
-            # remove from the socket map
-            del asyncore.socket_map[self.fileno()]
-            # reconnect
-            self.connect()
+            logger.warn("Got %s from: %s", msg, server)
+            assert server == self # sanity
+            raise
         else:
             raise
             asyncore.dispatcher.handle_error(self)
@@ -265,18 +345,66 @@ class AsyncServerConn(object, asyncore.dispatcher):
         logger.debug("Checking if %s is writeable.", self)
         return self.line
 
+AsyncServerConn = protohandler.protProvider(AsyncServerConn,
+                                            interaction='_interact_and_wait')
+
+
 class ServerPool(object):
     """ServerPool is a queue implementation of ServerConns with distributed
     server support.
 
-    @serverlist is a list of tuples as so: (ip, port, job)
+    @serverlist is a list of tuples as so: (ip, port, job), where ip may
+    also be a transport address string with port None, e.g.
+    ('unix:/tmp/beanstalkd.sock', None, job)
+    @socket_options is used for every server, see the transport module
+    @backoff is a backoff.Backoff spacing out retries while a server is
+    draining, and bounding retries after a server is lost
+    @breaker is a dict of breaker.CircuitBreaker arguments, e.g.
+    {'slow_call': 0.5}, used for every server's breaker
+    @connect_timeout bounds, in seconds, connecting to all the servers
+
+    The servers are connected to all at once, and sent one stats together.
+    Servers that did not answer within connect_timeout are left out, as if
+    lost (see below), and added once they answer probes; only if none
+    answers does the constructor raise socket.error.
+
+    Each server has a circuit breaker, opened by errors, slow replies or a
+    lost connection. Servers whose breaker is open get no puts and are
+    left out of broadcasts such as reserve; a server that lost its
+    connection is also taken out of self.servers. A background thread
+    probes them on their own connections, and they are readmitted, with the
+    pool's tube and watch list restored, once a probe succeeds. If no
+    server is left, the lost ones are reconnected to by the caller instead,
+    as soon as their breaker is due for a probe.
+
+    When a server is lost, commands in serverconn.IDEMPOTENT are sent again
+    to the remaining servers; others raise errors.NotConnected, since the
+    lost server may have acted on them. See health() for the state of each
+    server.
 
     """
-    def __init__(self, serverlist):
+    def __init__(self, serverlist, socket_options=None, backoff=None,
+                 breaker=None, connect_timeout=None):
         # build servers into the self.servers list
         self.servers = []
-        for ip, port, job in serverlist:
-            self.add_server(ip, port, job)
+        self.socket_options = socket_options
+        self.backoff = backoff or Backoff()
+        self.breaker_options = dict(breaker or {})
+        self.connect_timeout = connect_timeout
+        self._ejected = []
+        self._using = None
+        self._watchlist = None
+        self._metrics_hooks = None
+        self._prober = None
+        self._probe_lock = threading.Lock()
+        self._stop_probing = threading.Event()
+        serverlist = list(serverlist)
+        if serverlist and not self.add_servers(serverlist):
+            self.close()
+            raise socket.error(
+                "Could not connect to any of: %s" % ", ".join(
+                    transport.format_address(ip, port)
+                    for ip, port, job in serverlist))
 
     def _get_watchlist(self):
         """Returns the global watchlist for all servers"""
@@ -290,6 +418,7 @@ class ServerPool(object):
 
     def _set_watchlist(self, value):
         """Sets the watchlist for all global servers"""
+        self._watchlist = list(value)
         for server in self.servers:
             server.watchlist = value
 
@@ -304,18 +433,27 @@ class ServerPool(object):
         return comparison
 
     def close(self):
-        for server in self.servers:
+        self._stop_probing.set()
+        for server in self.servers + self._ejected:
             server.close()
         del self.servers[:]
+        del self._ejected[:]
 
     def clone(self):
-        return ServerPool(map(lambda s: (s.server, s.port, s.job), self.servers))
+        return ServerPool(map(lambda s: (s.server, s.port, s.job),
+                              self.servers + self._ejected),
+                          self.socket_options, self.backoff,
+                          self.breaker_options, self.connect_timeout)
+
+    def healthy_servers(self):
+        """The connected servers whose breaker lets commands through."""
+        return [s for s in self.servers if s.breaker.allow()]
 
     def get_random_server(self):
         #random seed by local time
         random.seed()
         try:
-            choice = random.choice(self.servers)
+            choice = random.choice(self.healthy_servers())
         except IndexError, e:
             # implicitly convert IndexError to BeanStalkError
             NotConnected = protohandler.errors.NotConnected
@@ -335,30 +473,229 @@ class ServerPool(object):
             for t in target:
                 t.close()
                 self.servers.remove(t)
-        return bool(target)
+        ejected = filter(self._server_cmp(ip, port), self._ejected)
+        for t in ejected:
+            self._ejected.remove(t)
+        return bool(target or ejected)
 
     def add_server(self, ip, port, job=Job):
         """Checks if the server doesn't already exist and adds it. Returns
         True on successful addition or False if the server already exists.
 
         Upon server addition, the server socket is automatically created
-        and a connection is created.
+        and a connection is created. If that fails the server is added all
+        the same, and used once it answers probes.
 
         """
-        target = filter(self._server_cmp(ip, port), self.servers)
+        target = filter(self._server_cmp(ip, port),
+                        self.servers + self._ejected)
         # if we got a server back
         if not target:
-            server = AsyncServerConn(ip, port, job)
-            server.pool_instance = self
-            server.connect()
-            self.servers.append(server)
+            self.add_servers([(ip, port, job)])
 
         # return the opposite of target
         return not bool(target)
 
+    def add_servers(self, serverlist, timeout=None):
+        """Adds the servers of serverlist, (ip, port, job) tuples, that are
+        not in the pool yet, connecting to all of them at once. timeout (by
+        default the pool's connect_timeout) bounds the whole of it. Servers
+        that cannot be reached in time are added as lost ones, and used once
+        they answer probes. Returns the number of servers connected to.
+
+        """
+        if timeout is None:
+            timeout = self.connect_timeout
+        deadline = None if timeout is None else time.time() + timeout
+        new = []
+        for ip, port, job in serverlist:
+            if filter(self._server_cmp(ip, port),
+                      self.servers + self._ejected + new):
+                continue
+            server = AsyncServerConn(ip, port, job, self.socket_options)
+            server.pool_instance = self
+            server.breaker = CircuitBreaker(on_open=self._start_probing,
+                                            **self.breaker_options)
+            if self._metrics_hooks is not None:
+                server.enable_metrics(Metrics(transport.format_address(ip, port),
+                                              self._metrics_hooks))
+            new.append(server)
+
+        connected = []
+        socks = transport.connect_all([(s.server, s.port) for s in new],
+                                      self.socket_options, timeout)
+        for server, sock in zip(new, socks):
+            if isinstance(sock, socket.error):
+                logger.warn("Could not connect to %s: %s", server, sock)
+                self._eject(server)
+            else:
+                server.attach(sock)
+                connected.append(server)
+
+        # connect() sends a stats for max-job-size; one is enough, the rest
+        # only need to show they answer, without a YAML reply to parse
+        for i, server in enumerate(connected):
+            if i == 0:
+                server._do_interaction(*protohandler.process_stats())
+            else:
+                server._do_interaction(*protohandler.process_list_tube_used())
+        while True:
+            try:
+                _wait_for_replies(connected, deadline)
+                break
+            except protohandler.errors.NotConnected, e:
+                logger.warn("Lost %s while connecting", e[1])
+        answered = [s for s in connected if s.result is not None]
+        if connected and connected[0].result is not None:
+            protohandler.MAX_JOB_SIZE = \
+                connected[0].result['data']['max-job-size']
+        for server in connected:
+            if server.result is None:
+                self._eject(server)
+            else:
+                self.servers.append(server)
+        return len(answered)
+
+    def enable_metrics(self, hooks=()):
+        '''Collect per-command metrics on every server, including servers
+        added later. hooks are added to each server's Metrics.'''
+        self._metrics_hooks = list(hooks)
+        for server in self.servers:
+            server.enable_metrics(Metrics(transport.format_address(
+                                              server.server, server.port),
+                                          self._metrics_hooks))
+
+    def disable_metrics(self):
+        self._metrics_hooks = None
+        for server in self.servers:
+            server.disable_metrics()
+
+    def add_metrics_hook(self, hook):
+        if self._metrics_hooks is None:
+            raise ValueError('metrics are not enabled')
+        self._metrics_hooks.append(hook)
+        for server in self.servers:
+            server._metrics.add_hook(hook)
+
+    def metrics(self):
+        '''metrics per command, summed over all servers. Use the metrics()
+        method of the servers themselves for a per server view.'''
+        total = Metrics()
+        for server in self.servers:
+            if server._metrics is not None:
+                total.merge(server._metrics)
+        return total.snapshot()
+
+    def health(self):
+        """The state of every server, connected or not, by address: its
+        breaker's snapshot plus 'connected'.
+
+        """
+        result = {}
+        for server in self.servers + self._ejected:
+            state = server.breaker.snapshot()
+            state['connected'] = server._socket is not None
+            result[transport.format_address(server.server, server.port)] = state
+        return result
+
+    def _eject(self, server):
+        """Takes a server that lost its connection out of self.servers,
+        until a probe finds it healthy again.
+
+        """
+        logger.warn("Ejecting %s until it answers probes", server)
+        server.close()
+        # a command in flight is lost with the connection
+        server.line = None
+        server.waiting = False
+        if server not in self._ejected:
+            self._ejected.append(server)
+        self.servers[:] = [s for s in self.servers if s is not server]
+        # only now, so the prober this may start finds it
+        server.breaker.trip()
+
+    def _readmit(self, force=False):
+        """Reconnects the ejected servers whose breaker was half-opened by a
+        probe, and if force also those due for a probe, restoring the pool's
+        tube and watch list on each. A forced reconnect that fails counts as
+        a failed probe, so the next one waits longer.
+
+        """
+        now = time.time()
+        for server in list(self._ejected):
+            if not (server.breaker.state == HALF_OPEN or
+                    force and server.breaker.due(now)):
+                continue
+            logger.warn("Attempting to re-connect to: %s", server)
+            try:
+                server.connect()
+                if self._using is not None:
+                    server.use(self._using)
+                if self._watchlist is not None:
+                    server.watchlist = list(self._watchlist)
+            except (socket.error, protohandler.errors.NotConnected), e:
+                logger.warn("Could not re-connect to %s: %s", server, e)
+                server.close()
+                if server.breaker.state == OPEN:
+                    server.breaker.probed(False)
+                else:
+                    server.breaker.trip()
+                continue
+            # as good as a probe, the next call closes or opens it again
+            server.breaker.probed(True)
+            self._ejected.remove(server)
+            self.servers.append(server)
+
+    def _probe(self, server):
+        """True if the server answers a stats on a connection of its own,
+        in time for its breaker.
+
+        """
+        start = time.time()
+        try:
+            conn = ServerConn(server.server, server.port,
+                              socket_options=self.socket_options,
+                              timeout=PROBE_TIMEOUT)
+            try:
+                conn.stats()
+            finally:
+                conn.close()
+        except (socket.error, protohandler.errors.BeanStalkError), e:
+            logger.info("Probe of %s failed: %s", server, e)
+            return False
+        slow_call = server.breaker.slow_call
+        return slow_call is None or time.time() - start <= slow_call
+
+    def _start_probing(self, breaker=None):
+        with self._probe_lock:
+            if self._prober is None and not self._stop_probing.is_set():
+                self._prober = threading.Thread(target=self._probe_loop,
+                                                name='ServerPool prober')
+                self._prober.daemon = True
+                self._prober.start()
+
+    def _probe_loop(self):
+        # probes run on connections of their own, so they never touch the
+        # asyncore map the pool's caller is using. The thread ends when no
+        # breaker is open, and is started again when one opens.
+        while not self._stop_probing.is_set():
+            servers = self.servers + self._ejected
+            with self._probe_lock:
+                if not [s for s in servers if s.breaker.state == OPEN]:
+                    self._prober = None
+                    return
+            now = time.time()
+            for server in servers:
+                if server.breaker.due(now):
+                    server.breaker.probed(self._probe(server))
+            self._stop_probing.wait(PROBE_INTERVAL)
+
     def retry_until_succeeds(func):
         def retrier(self, *args, **kwargs):
+            attempt = 0
             while True:
+                if self._ejected:
+                    self._readmit(force=not self.healthy_servers())
                 try:
                     value = func(self, *args, **kwargs)
                 except ServerInUse, e:
@@ -367,22 +704,33 @@ class ServerPool(object):
                     # clean this up a bit?
                     raise
                 except protohandler.errors.Draining, e:
-                    # ignore
-                    pass
+                    # try again, but give the server time to drain
+                    if self.backoff.exhausted(attempt):
+                        raise
+                    time.sleep(self.backoff.delay(attempt))
+                    attempt += 1
                 except protohandler.errors.NotConnected, e:
+                    if len(e.args) < 2:
+                        # no server left to send to
+                        raise
                     # not connected..
                     logger.warning(e[0])
-                    server = e[1]
-                    self.remove_server(server.server, server.port)
-                    logger.warn("Attempting to re-connect to: %s", server)
-                    server.connect()
-                    self.servers.append(server)
+                    self._eject(e[1])
+                    cmd = args[0] if args else None
+                    if cmd is None or cmd.replace('_', '-') not in IDEMPOTENT:
+                        # the server may have acted on it before it was lost
+                        raise e
+                    if self.backoff.exhausted(attempt):
+                        raise e
+                    time.sleep(self.backoff.delay(attempt))
+                    attempt += 1
                 else:
                     return value
         return retrier
 
     def multi_interact(self, line, handler):
-        for server in self.servers:
+        servers = self.healthy_servers()
+        for server in servers:
             logger.warn("Sending %s to: %s", line, server)
             try:
                 server._do_interaction(line, handler.clone())
@@ -391,10 +739,8 @@ class ServerPool(object):
                 # ignore
                 pass
 
-        asyncore.loop(use_poll=True,
-                      timeout=ASYNCORE_TIMEOUT,
-                      count=ASYNCORE_COUNT)
-        results = filter(None, (s.result for s in self.servers))
+        _wait_for_replies(servers)
+        results = filter(None, (s.result for s in servers))
         return results
 
     @retry_until_succeeds
@@ -445,8 +791,113 @@ class ServerPool(object):
     def reserve_with_timeout(self, *args, **kwargs):
         return self._all_broadcast("reserve_with_timeout", *args, **kwargs)
 
-    def use(self, *args, **kwargs):
-        return self._all_broadcast("use", *args, **kwargs)
+    def _reserve_round(self, servers, timeout, lost):
+        """Send reserve-with-timeout to all of servers at once; returns the
+        (server, job) pairs of those that had one. Servers that lose their
+        connection meanwhile are ejected and added to the list lost."""
+        line, handler = protohandler.process_reserve_with_timeout(timeout)
+        servers = list(servers)
+        for server in servers:
+            server._do_interaction(line, handler.clone())
+        deadline = time.time() + timeout + RESERVE_MARGIN
+        while True:
+            try:
+                _wait_for_replies(servers, deadline)
+            except protohandler.errors.DeadlineSoon:
+                # that server has no job for us, the others may have
+                continue
+            except protohandler.errors.NotConnected, e:
+                if len(e.args) < 2:
+                    raise
+                # the others may still have a job for us
+                logger.warning(e[0])
+                self._eject(e[1])
+                servers.remove(e[1])
+                lost.append(e[1])
+                continue
+            break
+        return [(server, server.result) for server in servers
+                if server.result is not None and
+                not _timed_out(server.result)]
+
+    def reserve_batch(self, max_jobs, max_wait=0):
+        """Reserve up to max_jobs jobs from the healthy servers, waiting up
+        to max_wait seconds for them. Servers are asked all at once, each
+        for one job per round, as long as they have jobs ready; when none
+        has, the next round waits on all of them, as long as the batch is
+        not full and some of max_wait is left; jobs that came beyond
+        max_jobs are released. A job is a Job if the server has
+        a job class, or a dict with the server under 'conn' otherwise, so
+        that ack_batch and release_batch know where it came from.
+
+        A server that loses its connection is ejected, and its jobs are left
+        out: the server released them when the connection went. The jobs of
+        the other servers are returned as usual.
+
+        """
+        deadline = time.time() + max_wait
+        jobs = []
+        lost = []
+        ready = self.healthy_servers()
+        while len(jobs) < max_jobs:
+            random.shuffle(ready)
+            asked = ready[:max_jobs - len(jobs)]
+            if asked:
+                found = self._reserve_round(asked, 0, lost)
+            else:
+                # any of them may get the next job, so all of them wait
+                wait = int(math.ceil(deadline - time.time()))
+                asked = self.healthy_servers()
+                if wait < 1 or not asked:
+                    break
+                found = self._reserve_round(asked, wait, lost)
+            ready = [server for server, job in found]
+            for server, job in found:
+                if isinstance(job, dict):
+                    job['conn'] = server
+            room = max_jobs - len(jobs)
+            jobs.extend(job for server, job in found[:room])
+            if found[room:]:
+                # more servers had a job than there is room for
+                self.release_batch([job for server, job in found[room:]])
+        if lost:
+            jobs = [job for job in jobs
+                    if (getattr(job, 'Server', None) or job['conn'])
+                    not in lost]
+        return jobs
+
+    def _batch(self, jobs, apply):
+        results = []
+        for job in jobs:
+            server = getattr(job, 'Server', None) or job['conn']
+            try:
+                results.append(apply(server, job['jid']))
+            except protohandler.errors.BeanStalkError, e:
+                results.append(e)
+        return results
+
+    def ack_batch(self, jobs):
+        """Delete jobs, as returned by reserve_batch, on their servers.
+        Returns, for each, the reply or the error, e.g. errors.NotFound.
+
+        """
+        return self._batch(jobs, lambda server, jid: server.delete(jid))
+
+    def release_batch(self, jobs, pri=None, delay=0):
+        """Release jobs, as returned by reserve_batch, with priority pri, or
+        their own if None. Returns, for each, the reply or the error.
+
+        """
+        def release(server, jid):
+            p = pri
+            if p is None:
+                p = server.stats_job(jid)['data']['pri']
+            return server.release(jid, p, delay)
+        return self._batch(jobs, release)
+
+    def use(self, tube, *args, **kwargs):
+        self._using = tube
+        return self._all_broadcast("use", tube, *args, **kwargs)
 
     def peek(self, *args, **kwargs):
         return self._all_broadcast("peek", *args, **kwargs)
@@ -469,7 +920,7 @@ class ServerPool(object):
                 return {}
 
             # need to combine these results
-            result = dict(reduce(lambda x, y: x.items() + y.items(), returned))
+            result = dict(item for r in returned for item in r.items())
             # set-ify that which we want to add
             for a in appendables:
                 try:
@@ -492,7 +943,6 @@ class ServerPool(object):
     def stats_tube(self, *args, **kwargs):
         return self._all_broadcast("stats_tube", *args, **kwargs)
 
-    @retry_until_succeeds
     def apply_and_compact(func):
         """Applies func's func.__name__ to all servers in the server pool
         and tallies results into a dictionary.
@@ -503,7 +953,7 @@ class ServerPool(object):
         def generic_applier(self, *args, **kwargs):
             cmd = func.__name__
             results = {}
-            for server in self.servers:
+            for server in self.healthy_servers():
                 results[server] = getattr(server, cmd)(*args, **kwargs)
             return results
         return generic_applier
@@ -0,0 +1,348 @@
+"""
+Write-behind puts: BackgroundProducer takes jobs from any number of threads
+and puts them from a thread of its own, so callers never wait for the
+server.
+
+    producer = BackgroundProducer(ServerConn(host, port))
+    future = producer.submit(payload, tube='events', pri=10)
+    ...
+    future.result()     # the jid, or raises the put's error
+
+The sender thread takes whatever was submitted, waiting up to linger
+milliseconds for more to arrive, up to max_batch jobs. On a ServerConn the
+whole batch, the use commands for its tubes included, goes out in one write
+(see ServerConn.pipeline) and all the replies are read back together; other
+connections, such as a ServerPool, get the puts one by one.
+
+submit() returns a concurrent.futures.Future if the futures package is
+available (it is part of Python 3, and the "futures" backport on Python 2),
+and a compatible Future of this module otherwise. Either way result() and
+exception() raise this module's TimeoutError and CancelledError, which are
+those of concurrent.futures when it is there. Futures cancelled before
+their batch is sent are not put.
+
+Producers are flushed when the interpreter exits unless flush_on_exit is
+False; call close() to flush and stop one earlier.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+
+import errors
+import protohandler
+
+try:
+    from concurrent.futures import Future, TimeoutError, CancelledError
+except ImportError:
+    Future = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+if Future is None:
+    class TimeoutError(Exception): pass
+    class CancelledError(Exception): pass
+
+    class Future(object):
+        '''The part of the concurrent.futures.Future interface the producer
+        and its callers use.'''
+
+        def __init__(self):
+            self._cond = threading.Condition()
+            self._state = 'pending'
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+
+        def __repr__(self):
+            return '<%s %s>' % (self.__class__.__name__, self._state)
+
+        def cancel(self):
+            with self._cond:
+                if self._state in ('running', 'finished'):
+                    return False
+                if self._state != 'cancelled':
+                    self._state = 'cancelled'
+                    self._cond.notify_all()
+            self._run_callbacks()
+            return True
+
+        def cancelled(self):
+            return self._state == 'cancelled'
+
+        def running(self):
+            return self._state == 'running'
+
+        def done(self):
+            return self._state in ('cancelled', 'finished')
+
+        def set_running_or_notify_cancel(self):
+            with self._cond:
+                if self._state == 'cancelled':
+                    return False
+                self._state = 'running'
+                return True
+
+        def _wait(self, timeout):
+            with self._cond:
+                if not self.done():
+                    self._cond.wait(timeout)
+                if self._state == 'cancelled':
+                    raise CancelledError()
+                if self._state != 'finished':
+                    raise TimeoutError()
+
+        def result(self, timeout=None):
+            self._wait(timeout)
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+        def exception(self, timeout=None):
+            self._wait(timeout)
+            return self._exception
+
+        def add_done_callback(self, fn):
+            with self._cond:
+                if not self.done():
+                    self._callbacks.append(fn)
+                    return
+            fn(self)
+
+        def _finish(self, result, exception):
+            with self._cond:
+                self._result = result
+                self._exception = exception
+                self._state = 'finished'
+                self._cond.notify_all()
+            self._run_callbacks()
+
+        def set_result(self, result):
+            self._finish(result, None)
+
+        def set_exception(self, exception):
+            self._finish(None, exception)
+
+        def _run_callbacks(self):
+            for fn in self._callbacks:
+                try:
+                    fn(self)
+                except Exception:
+                    logger.exception('future callback %r failed', fn)
+            self._callbacks = []
+
+
+class _Put(object):
+    __slots__ = ('future', 'tube', 'args')
+
+    def __init__(self, future, tube, args):
+        self.future = future
+        self.tube = tube
+        self.args = args
+
+
+_producers = weakref.WeakSet() if hasattr(weakref, 'WeakSet') else None
+
+def _flush_all():
+    for producer in list(_producers or ()):
+        if producer.flush_on_exit:
+            producer.close()
+atexit.register(_flush_all)
+
+
+class BackgroundProducer(object):
+    '''Puts jobs on conn, a ServerConn or ServerPool, from a sender thread.
+    conn must not be used by anything else while the producer runs.
+
+    max_queue -- how many jobs may wait to be sent; submit() blocks while
+                 that many are waiting
+    linger -- milliseconds the sender waits for more jobs to fill a batch
+    max_batch -- the most jobs sent in one go
+    flush_on_exit -- close() the producer when the interpreter exits
+    '''
+
+    def __init__(self, conn, max_queue=10000, linger=5, max_batch=500,
+                 flush_on_exit=True):
+        self.conn = conn
+        self.max_queue = max_queue
+        self.linger = linger / 1000.0
+        self.max_batch = max_batch
+        self.flush_on_exit = flush_on_exit
+
+        self._queue = deque()
+        self._sending = 0
+        self._closed = False
+        self._using = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='BackgroundProducer')
+        self._thread.daemon = True
+        self._thread.start()
+        if _producers is not None:
+            _producers.add(self)
+
+    def __repr__(self):
+        return '<%s(%r) pending=%d>' % (self.__class__.__name__, self.conn,
+                                        self.pending)
+
+    @property
+    def pending(self):
+        '''the number of jobs submitted but not answered yet'''
+        return len(self._queue) + self._sending
+
+    def submit(self, data, tube='default', pri=1, delay=0, ttr=60,
+               block=True, timeout=None):
+        '''Queue a put of data into tube; returns a Future resolved with
+        the jid. While max_queue jobs are waiting this blocks, for at most
+        timeout seconds if given, or raises errors.QueueFull at once if
+        block is False.'''
+        # a bad name would leave the following puts in the wrong tube
+        protohandler.check_name(tube)
+        future = Future()
+        put = _Put(future, tube, (data, pri, delay, ttr))
+        with self._cond:
+            if self._closed:
+                raise errors.BeanStalkError('%r is closed' % (self,))
+            if len(self._queue) >= self.max_queue:
+                if not block:
+                    raise errors.QueueFull('%d jobs waiting' % len(self._queue))
+                deadline = None if timeout is None else time.time() + timeout
+                while len(self._queue) >= self.max_queue:
+                    wait = None
+                    if deadline is not None:
+                        wait = deadline - time.time()
+                        if wait <= 0:
+                            raise errors.QueueFull(
+                                '%d jobs waiting' % len(self._queue))
+                    self._cond.wait(wait)
+                    if self._closed:
+                        raise errors.BeanStalkError('%r is closed' % (self,))
+            self._queue.append(put)
+            self._cond.notify_all()
+        return future
+
+    def flush(self, timeout=None):
+        '''Wait until every job submitted so far was answered. Returns False
+        if timeout seconds passed first.'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queue or self._sending:
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        return False
+                self._cond.wait(wait)
+        return True
+
+    def close(self, timeout=None):
+        '''Stop taking jobs, send the ones waiting, and stop the sender.
+        Returns False if that took longer than timeout seconds.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    #
+    # the sender thread
+    #
+
+    def _take(self):
+        '''the next batch, or None once closed and drained'''
+        with self._cond:
+            while not self._queue:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            deadline = time.time() + self.linger
+            while len(self._queue) < self.max_batch and not self._closed:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                self._cond.wait(wait)
+            batch = []
+            while self._queue and len(batch) < self.max_batch:
+                batch.append(self._queue.popleft())
+            self._sending = len(batch)
+            # room for blocked submitters
+            self._cond.notify_all()
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            batch = [put for put in batch
+                     if put.future.set_running_or_notify_cancel()]
+            try:
+                if hasattr(self.conn, 'pipeline'):
+                    self._send_pipelined(batch)
+                else:
+                    self._send_each(batch)
+            except Exception, e:
+                # the connection failed, and with it what is left
+                logger.warning('%r: sending %d jobs failed: %s',
+                               self, len(batch), e)
+                self._using = None
+                for put in batch:
+                    if not put.future.done():
+                        put.future.set_exception(e)
+            with self._cond:
+                self._sending = 0
+                self._cond.notify_all()
+
+    def _by_tube(self, batch):
+        tubes = {}
+        order = []
+        for put in batch:
+            if put.tube not in tubes:
+                tubes[put.tube] = []
+                # the tube in use already goes first, saving a use
+                if put.tube == self._using:
+                    order.insert(0, put.tube)
+                else:
+                    order.append(put.tube)
+            tubes[put.tube].append(put)
+        return [(tube, tubes[tube]) for tube in order]
+
+    def _send_pipelined(self, batch):
+        commands = []
+        puts = []
+        for tube, group in self._by_tube(batch):
+            if tube != self._using:
+                commands.append(protohandler.process_use(tube))
+                puts.append(None)
+                self._using = tube
+            for put in group:
+                try:
+                    commands.append(protohandler.process_put(*put.args))
+                except errors.BeanStalkError, e:
+                    put.future.set_exception(e)
+                    continue
+                puts.append(put)
+        for put, res in zip(puts, self.conn.pipeline(commands)):
+            if put is None:
+                continue
+            if isinstance(res, Exception):
+                put.future.set_exception(res)
+            else:
+                put.future.set_result(res['jid'])
+
+    def _send_each(self, batch):
+        for tube, group in self._by_tube(batch):
+            if tube != self._using:
+                self.conn.use(tube)
+                self._using = tube
+            for put in group:
+                try:
+                    res = self.conn.put(*put.args)
+                except (errors.ProtoError, errors.ServerError), e:
+                    put.future.set_exception(e)
+                else:
+                    put.future.set_result(res['jid'])
@@ -31,6 +31,7 @@ my code...
 
 
 import StringIO
+import logging
 import re
 from itertools import izip, imap
 from functools import wraps
@@ -48,18 +49,46 @@ def load_yaml(yaml_string):
     return yaml.load(handler)
 
 
-def protProvider(cls):
+def _command_method(name, func, interaction, logger, options):
+    '''build the method protProvider adds for the protocol function func'''
+    # options the protocol function takes itself are left to it
+    own = tuple(k for k in options if k not in getattr(func, 'argnames', ()))
+    def method(self, *args, **kw):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Calling %s with: args(%s), kwargs(%s)",
+                         func.__name__, args, kw)
+        if not (own and kw):
+            return getattr(self, interaction)(*func(*args, **kw))
+        extra = dict((k, kw.pop(k)) for k in own if k in kw)
+        return getattr(self, interaction)(*func(*args, **kw), **extra)
+    method.__name__ = name
+    method.__doc__ = func.__doc__
+    return method
+
+def protProvider(cls, interaction='_do_interaction', options=()):
     ''' Class decorator to be applied to anything that we want to provide the
     beanstalk protocol (e.g. connections).  This will implement all the
     protocol functions (i.e. process_*) as methods in the class that is
     decorated. in ver < py2.6 this should be cls = protProvider(cls), in
     2.6 and higher, they got all nice and implemented the decorator sugar for
-    classes'''
+    classes
+
+    Each method passes the (line, handler) pair of its protocol function to
+    the method named by interaction, and returns what that returns. Keyword
+    arguments named in options are passed on to interaction as keywords
+    rather than to the protocol function, unless it has an argument of that
+    name itself. Calls are logged at debug level to
+    the logger of the class's module. Methods the class defines itself are
+    left alone.'''
+    logger = logging.getLogger(cls.__module__)
     for name, value in globals().items():
         if not name.startswith('process_'):
             continue
         name = name.partition('_')[2]
-        setattr(cls, name, staticmethod(value))
+        if name in cls.__dict__:
+            continue
+        setattr(cls, name,
+                _command_method(name, value, interaction, logger, options))
 
     return cls
 
@@ -110,11 +139,16 @@ class Handler(object):
     Handler: generic response consumer for beanstalk.
 
     Each handler object has a __call__ method, allowing it to be fed data.
+    The received attribute counts the bytes fed so far. Data fed past the
+    end of the reply (the start of the next one, when commands are
+    pipelined) is kept in the leftover attribute once the reply is complete.
     '''
     def __init__(self, *responses):
 
         self.lookup =  dict((r.word, r) for r in responses)
         self.remaining = 10
+        self.received = 0
+        self.leftover = ''
 
         h = self.handler()
         h.next()
@@ -130,6 +164,7 @@ class Handler(object):
         return Handler(*self.lookup.values())
 
     def __call__(self, val):
+        self.received += len(val)
         return self.__h(val)
 
     # Note: this takes advanage of 2.5+ style generators. The syntax:
@@ -150,6 +185,7 @@ class Handler(object):
             response += (yield None)
             response, sep, data = response.partition(eol)
 
+        self.leftover = data
         checkError(response)
 
         response = response.split(' ')
@@ -162,7 +198,7 @@ class Handler(object):
             errstr = "Response was: %s %s" % (word, ' '.join(response))
         elif len(response) != len(resp.args):
             errstr = "Response %s had wrong # args, got %s (expected %s)"
-            errstr %= (word, response, args)
+            errstr %= (word, response, resp.args)
         else: # all good
             errstr = ''
 
@@ -176,20 +212,94 @@ class Handler(object):
             yield reply
             return
 
-        self.remaining = (reply['bytes'] + 2) - len(data)
+        # collect the body in a list and join it once, instead of copying
+        # everything received so far for every chunk
+        size = reply['bytes'] + 2
+        got = len(data)
+        chunks = [data]
+        self.remaining = size - got
 
         while self.remaining > 0:
             newdata = (yield None)
-            self.remaining -= len(newdata)
-            data += newdata
+            chunks.append(newdata)
+            got += len(newdata)
+            self.remaining = size - got
+
+        if len(chunks) > 1:
+            data = ''.join(chunks)
+        self.remaining = 0
+        self.leftover = data[size:] if got > size else ''
 
-        if not data.endswith(eol) or not (len(data) == reply['bytes']+2):
+        if data[size - 2:size] != eol:
             raise errors.ExpectedCrlf('Data not properly sent from server')
 
         reply['data'] = resp.parsefunc(data[:reply['bytes']])
         yield reply
         return
 
+class ReplyReader(object):
+    '''
+    ReplyReader: splits a stream of pipelined replies between the commands
+    they answer.
+
+    feed(data, pending) takes the commands waiting for replies, oldest first,
+    in the deque pending; each has a handler attribute (a Handler). It
+    generates (command, result, error) for every reply completed by data,
+    popping the command off pending first, so callers may issue new commands
+    in between. Data not handled yet (an incomplete reply line, or replies
+    left when the caller stopped iterating) is kept for the next call.
+
+    Rather than splitting off one line or body at a time (copying the rest
+    of the data every time), it walks through the data with an offset:
+    every reply line and body is sliced out once, and a body that is all of
+    data is passed on as is.
+    '''
+    def __init__(self):
+        # the data fed last, and how far into it the replies were handled
+        self._data = ''
+        self._pos = 0
+        self.raw = False
+
+    def buffered(self):
+        '''the number of bytes received but not handled yet'''
+        return len(self._data) - self._pos
+
+    def feed(self, data, pending):
+        if self._pos < len(self._data):
+            data = self._data[self._pos:] + data
+        pos, end = 0, len(data)
+        self._data, self._pos = data, 0
+        while pos < end and pending:
+            command = pending[0]
+            handler = command.handler
+            if self.raw:
+                take = handler.remaining
+                if pos == 0 and take >= end:
+                    chunk = data
+                else:
+                    chunk = data[pos:pos + take]
+            else:
+                eol = data.find('\r\n', pos)
+                if eol < 0:
+                    break
+                chunk = data[pos:eol + 2]
+            # kept up to date before every yield, so that the caller
+            # may stop at any reply and feed more data later
+            pos = self._pos = pos + len(chunk)
+            try:
+                res = handler(chunk)
+            except Exception, e:
+                self.raw = False
+                pending.popleft()
+                yield command, None, e
+                continue
+            if res is None: # there is more data, its a job or something
+                self.raw = True
+                continue
+            self.raw = False
+            pending.popleft()
+            yield command, res, None
+
 # since the beanstalk protocol uses a simple command-response structure,
 # this decorator makes life easy.  The function it wraps corresponds to a
 # beanstalk command, and returns the appropriate command text.
@@ -212,6 +322,8 @@ def interaction(*responses):
             line = func(*args, **kw)
             handler = Handler(*responses)
             return (line, handler)
+        code = func.func_code
+        newfunc.argnames = code.co_varnames[:code.co_argcount]
         return newfunc
     return deco
 
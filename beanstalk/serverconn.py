@@ -1,15 +1,56 @@
 import socket
 import select
+import time
+from collections import deque
 import protohandler
+import transport
 import logging
+import backoff
+from metrics import Metrics, command_name, reply_state
+from acks import AckBatcher
 
-_debug = False
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# how much longer than its server side timeout a reserve-with-timeout may
+# take before the client gives up on it
+RESERVE_MARGIN = 1.0
+
+# commands that may be sent again after the connection was lost before their
+# reply came. The reserves are safe since the server releases the jobs of a
+# lost connection; put, delete and the like might have happened already.
+IDEMPOTENT = frozenset(['stats', 'stats-job', 'stats-tube', 'peek',
+                        'peek-ready', 'peek-delayed', 'peek-buried',
+                        'list-tubes', 'list-tube-used', 'list-tubes-watched',
+                        'use', 'watch', 'ignore', 'reserve',
+                        'reserve-with-timeout'])
+
+# how many times an idempotent command is sent on fresh connections
+MAX_REPLAYS = 3
+
+# the commands that change what reconnect() restores
+_TUBE_COMMANDS = ('use ', 'watch ', 'ignore ')
+_RESERVES = ('reserve', 'reserve-with-timeout')
+
 class ConnectionError(Exception): pass
 
 
+class _Pipelined(object):
+    __slots__ = ('line', 'handler')
+
+    def __init__(self, line, handler):
+        self.line = line
+        self.handler = handler
+
+
+def _timed_out(res):
+    '''whether res is the reply to a reserve that timed out'''
+    return isinstance(res, dict) and 'jid' not in res
+
+def _jid(job):
+    return job if isinstance(job, (int, long)) else job['jid']
+
+
 class ServerConn(object):
     """ServerConn is a simple, single thread single connection serialized
     beanstalk connection.  This class is meant to be used as is, or be the base
@@ -23,33 +64,60 @@ class ServerConn(object):
     to be used as a callback. This should greatly simplify the writing of a
     twisted or libevent serverconn class
 
+    Per-command metrics are collected if metrics is True or a
+    metrics.Metrics instance, see enable_metrics().
+
+    The server may also be given as one address string, leaving out the
+    port, e.g. 'unix:/tmp/beanstalkd.sock'. socket_options is a
+    transport.SocketOptions or the name of a profile, see the transport
+    module.
+
+    timeout, if given, bounds (in seconds) connecting and every command,
+    sending it and reading its reply. Each command also takes a timeout
+    keyword to override it for one call, e.g. conn.put(data, timeout=0.05).
+    A plain reserve only gets a deadline when given one explicitly, and
+    reserve_with_timeout always gets its own timeout plus RESERVE_MARGIN.
+    When a command times out errors.CommandTimeout is raised and the
+    connection is closed, since a late reply would be taken for the reply
+    to the next command.
+
+    reconnect, if given, is a backoff.Backoff (or True, for the default one)
+    used to connect again when the connection is lost: the next command
+    reconnects, waiting between attempts, and restores the tube in use and
+    the watch list. A command in flight when the connection is lost is sent
+    again if it is in IDEMPOTENT; otherwise errors.ConnectionLost is raised,
+    since the server may have acted on it. Jobs reserved over the lost
+    connection are released by the server.
+
     """
-    def __init__(self, server, port, job = False):
+    def __init__(self, server, port = None, job = False, metrics = None,
+                 socket_options = None, timeout = None, reconnect = None):
         self.poller = getattr(select, 'poll', lambda : None)()
         self.job = job
         self.server = server
         self.port = port
+        self.socket_options = socket_options
+        self.timeout = timeout
+        self._timeout_mode = False
+        self.backoff = backoff.Backoff() if reconnect is True else reconnect
+        self._using = 'default'
+        self._watching = set(['default'])
+
+        self._metrics = None
+        if metrics:
+            self.enable_metrics(None if metrics is True else metrics)
+        # an AckBatcher, see enable_ack_batching
+        self.acks = None
 
         self._socket  = None
         self.__makeConn()
 
     def __repr__(self):
-        s = "<[%(active)s]%(class)s(%(ip)s:%(port)s)>"
+        s = "<[%(active)s]%(class)s(%(address)s)>"
         active_ = "Open" if self._socket else "Closed"
-        return s % {"class" : self.__class__.__name__,
-                    "active" : active_, "ip" : self.server, "port" : self.port}
-
-    def __getattribute__(self, attr):
-        logger.debug("Fetching: %s", attr)
-        res = super(ServerConn, self).__getattribute__(attr)
-        logger.debug("Attribute found: %s...", res)
-        if not hasattr(res, "__name__") or not res.__name__.startswith('process_'):
-            return res
-        def caller(*args, **kw):
-            logger.info("Calling %s with: args(%s), kwargs(%s)",
-                         res.__name__, args, kw)
-            return self._do_interaction(*res(*args, **kw))
-        return caller
+        return s % {"class" : self.__class__.__name__, "active" : active_,
+                    "address" : transport.format_address(self.server,
+                                                         self.port)}
 
     def __eq__(self, comparable):
         # for unit testing
@@ -58,35 +126,112 @@ class ServerConn(object):
                         cmp(self.port, comparable.port)])
 
     def __makeConn(self):
-        self._socket = socket.socket()
-        self._socket.connect((self.server, self.port))
+        self._socket = transport.connect(self.server, self.port,
+                                         self.socket_options, self.timeout)
+        self._timeout_mode = False
         if self.poller:
             self.poller.register(self._socket, select.POLLIN)
-        protohandler.MAX_JOB_SIZE = self.stats()['data']['max-job-size']
-
-    def __writeline(self, line):
+        stats = self._interact(*protohandler.process_stats())
+        protohandler.MAX_JOB_SIZE = stats['data']['max-job-size']
+
+    def __restore(self):
+        if self._using != 'default':
+            self._interact(*protohandler.process_use(self._using))
+        for tube in self._watching - set(['default']):
+            self._interact(*protohandler.process_watch(tube))
+        if 'default' not in self._watching:
+            self._interact(*protohandler.process_ignore('default'))
+
+    def __track(self, line):
+        name, tube = line.split()
+        if name == 'use':
+            self._using = tube
+        elif name == 'watch':
+            self._watching.add(tube)
+        else:
+            self._watching.discard(tube)
+
+    def reconnect(self):
+        '''Close the connection, if open, and connect again, then restore
+        the tube in use and the watch list. Attempts are spaced out by the
+        connection's backoff, or there is one attempt if it has none.
+        Raises errors.NotConnected if no attempt succeeds.'''
+        self.close()
+        address = transport.format_address(self.server, self.port)
+        error = None
+        for delay in (self.backoff or backoff.ONCE).delays():
+            time.sleep(delay)
+            try:
+                self.__makeConn()
+                self.__restore()
+                return
+            except (socket.error, protohandler.errors.ConnectionLost,
+                    protohandler.errors.CommandTimeout), e:
+                self.close()
+                error = e
+                logger.warning("Reconnecting to %s failed: %s", address, e)
+        raise protohandler.errors.NotConnected(
+            '%s: could not reconnect: %s' % (address, error))
+
+    def __lost(self, reason):
+        self.close()
+        raise protohandler.errors.ConnectionLost(
+            "Remote server %s: %s" % (transport.format_address(self.server,
+                                                                self.port),
+                                      reason))
+
+    def _deadline(self, line, timeout):
+        '''when the command line must have been answered, or None'''
+        if timeout is None:
+            if line.startswith('reserve-with-timeout '):
+                return time.time() + int(line.split()[1]) + RESERVE_MARGIN
+            if self.timeout is None or line == 'reserve\r\n':
+                return None
+            timeout = self.timeout
+        return time.time() + timeout
+
+    def __set_deadline(self, deadline):
+        if deadline is None:
+            if self._timeout_mode:
+                self._socket.settimeout(None)
+                self._timeout_mode = False
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('timed out')
+        self._socket.settimeout(remaining)
+        self._timeout_mode = True
+
+    def __timed_out(self, line):
+        self.close()
+        raise protohandler.errors.CommandTimeout(
+            '%s: %s got no reply in time, connection closed'
+            % (transport.format_address(self.server, self.port),
+               command_name(line)))
+
+    def __writeline(self, line, deadline=None):
         try:
+            self.__set_deadline(deadline)
             self._socket.sendall(line)
+        except socket.timeout:
+            self.__timed_out(line)
+        except socket.error, e:
+            self.__lost(e)
         except:
             raise protohandler.errors.ProtoError
 
-    def _get_response(self, handler):
-        data = ''
-        pcount = 0
+    def _get_response(self, handler, deadline=None):
         while True:
-            if _debug and self.poller and not self.poller.poll(1):
-                pcount += 1
-                if pcount >= 20:
-                    raise Exception('poller timeout %s times in a row' % (pcount,))
-                else: continue
-            pcount = 0
-            recv = self._socket.recv(handler.remaining)
+            if deadline is not None:
+                self.__set_deadline(deadline)
+            try:
+                recv = self._socket.recv(handler.remaining)
+            except socket.timeout:
+                raise
+            except socket.error, e:
+                self.__lost(e)
             if not recv:
-                closedmsg = "Remote server %(server)s:%(port)s has "\
-                            "closed connection" % { "server" : self.server,
-                                                    "port" : self.port}
-                self.close()
-                raise protohandler.errors.ProtoError(closedmsg)
+                self.__lost("has closed connection")
             res = handler(recv)
             if res: break
 
@@ -94,9 +239,222 @@ class ServerConn(object):
             res = self.job(conn=self,**res)
         return res
 
-    def _do_interaction(self, line, handler):
-        self.__writeline(line)
-        return self._get_response(handler)
+    def __ensure_connected(self):
+        if self._socket is None:
+            if self.backoff is None:
+                raise protohandler.errors.NotConnected('%r is closed' % (self,))
+            self.reconnect()
+
+    def _do_interaction(self, line, handler, timeout=None):
+        self.__ensure_connected()
+        if self.acks is not None and self.acks.pending and \
+                not self.acks.flushing:
+            if command_name(line) in _RESERVES:
+                try:
+                    # the deletes go in the same write
+                    return self.acks.flush((line, handler), timeout)
+                except protohandler.errors.ConnectionLost:
+                    # the deletes were reported, the reserve is replayed
+                    # like any other
+                    if self.backoff is None:
+                        raise
+                    return self.__replay(line, handler, timeout)
+            self.acks.flush(timeout=timeout)
+            # which may have lost the connection
+            self.__ensure_connected()
+        try:
+            res = self._interact(line, handler, timeout)
+        except protohandler.errors.ConnectionLost:
+            if self.backoff is None or command_name(line) not in IDEMPOTENT:
+                raise
+            res = self.__replay(line, handler, timeout)
+        if line.startswith(_TUBE_COMMANDS):
+            self.__track(line)
+        return res
+
+    def __replay(self, line, handler, timeout):
+        for attempt in xrange(1, MAX_REPLAYS + 1):
+            logger.warning("Connection to %s lost, sending %s again",
+                           transport.format_address(self.server, self.port),
+                           command_name(line))
+            self.reconnect()
+            try:
+                return self._interact(line, handler.clone(), timeout)
+            except protohandler.errors.ConnectionLost:
+                if attempt == MAX_REPLAYS:
+                    raise
+
+    def _interact(self, line, handler, timeout=None):
+        deadline = self._deadline(line, timeout)
+        if self._metrics is not None:
+            return self._measured_interaction(line, handler, deadline)
+        self.__writeline(line, deadline)
+        if deadline is None:
+            return self._get_response(handler)
+        try:
+            return self._get_response(handler, deadline)
+        except socket.timeout:
+            self.__timed_out(line)
+
+    def _measured_interaction(self, line, handler, deadline=None):
+        start = time.time()
+        try:
+            self.__writeline(line, deadline)
+            try:
+                res = self._get_response(handler, deadline)
+            except socket.timeout:
+                self.__timed_out(line)
+        except Exception, e:
+            self._metrics.record(command_name(line), time.time() - start,
+                                 len(line), handler.received, error=e)
+            raise
+        self._metrics.record(command_name(line), time.time() - start,
+                             len(line), handler.received,
+                             state=reply_state(res))
+        return res
+
+    def pipeline(self, commands, timeout=None):
+        '''Send commands, (line, handler) pairs as returned by the
+        protohandler process_* functions, in one write, and read all their
+        replies in order. Returns a list holding, for each command, its
+        result or the error the server answered with, e.g. errors.NotFound.
+
+        timeout bounds the whole exchange; by default it is the one of the
+        last command, as for a single command, so a pipeline ending with a
+        reserve may wait for a job. Losing the connection or running out of
+        time raises as for a single command; nothing is replayed, since any
+        of the commands may have been acted upon. The tube used and the
+        ones watched are kept track of, and restored on reconnect, as for
+        single commands.'''
+        if not commands:
+            return []
+        if self._socket is None:
+            if self.backoff is None:
+                raise protohandler.errors.NotConnected('%r is closed' % (self,))
+            self.reconnect()
+        deadline = self._deadline(commands[-1][0], timeout)
+
+        pending = deque(_Pipelined(line, handler) for line, handler in commands)
+        reader = protohandler.ReplyReader()
+        results = []
+        start = time.time()
+        self.__writeline(''.join([c.line for c in pending]), deadline)
+        try:
+            while pending:
+                self.__set_deadline(deadline)
+                try:
+                    recv = self._socket.recv(65536)
+                except socket.timeout:
+                    raise
+                except socket.error, e:
+                    self.__lost(e)
+                if not recv:
+                    self.__lost("has closed connection")
+                for command, res, e in reader.feed(recv, pending):
+                    if e is None and self.job and 'jid' in res:
+                        res = self.job(conn=self, **res)
+                    if self._metrics is not None:
+                        self._metrics.record(command_name(command.line),
+                                             time.time() - start,
+                                             len(command.line),
+                                             command.handler.received,
+                                             state=reply_state(res), error=e)
+                    if e is None and command.line.startswith(_TUBE_COMMANDS):
+                        self.__track(command.line)
+                    results.append(res if e is None else e)
+        except socket.timeout:
+            self.__timed_out(pending[0].line)
+        if reader.buffered():
+            self.close()
+            raise protohandler.errors.UnexpectedResponse(
+                'Unexpected data from %r, connection closed' % (self,))
+        return results
+
+    def reserve_batch(self, max_jobs, max_wait=0):
+        '''Reserve up to max_jobs jobs, waiting up to max_wait seconds for
+        them. Once a job came, as many reserve-with-timeout 0 as there is
+        room left for are pipelined, taking the jobs that are ready without
+        waiting for each; while the batch is not full and a second or more
+        of max_wait is left, the next reserve waits again. Returns the list
+        of jobs, empty if none came in time.'''
+        deadline = time.time() + max_wait
+        jobs = []
+        wait = max_wait
+        while len(jobs) < max_jobs:
+            try:
+                res = self.reserve_with_timeout(int(wait))
+            except protohandler.errors.DeadlineSoon:
+                if not jobs:
+                    raise
+                break
+            if _timed_out(res):
+                break
+            jobs.append(res)
+            more = [protohandler.process_reserve_with_timeout(0)
+                    for i in xrange(max_jobs - len(jobs))]
+            jobs.extend(res for res in self.pipeline(more)
+                        if not isinstance(res, Exception) and
+                        not _timed_out(res))
+            wait = deadline - time.time()
+            if wait < 1:
+                break
+        return jobs
+
+    def ack_batch(self, jobs):
+        '''Delete jobs (jobs or jids) in one pipelined write. Returns, for
+        each, the reply or the error, e.g. errors.NotFound.'''
+        return self.pipeline([protohandler.process_delete(_jid(job))
+                              for job in jobs])
+
+    def release_batch(self, jobs, pri=None, delay=0):
+        '''Release jobs (jobs or jids) in one pipelined write, with priority
+        pri, or each job's own priority, which is looked up with stats-job
+        in another pipelined write, if None. Returns, for each, the reply or
+        the error.'''
+        jids = [_jid(job) for job in jobs]
+        if pri is None:
+            found = self.pipeline([protohandler.process_stats_job(jid)
+                                   for jid in jids])
+        else:
+            found = [{'data': {'pri': pri}}] * len(jids)
+        releases = [protohandler.process_release(jid, res['data']['pri'],
+                                                 delay)
+                    for jid, res in zip(jids, found)
+                    if not isinstance(res, Exception)]
+        released = iter(self.pipeline(releases))
+        return [res if isinstance(res, Exception) else released.next()
+                for res in found]
+
+    def enable_metrics(self, metrics=None):
+        '''Start collecting per-command metrics, into metrics if given (it
+        may be shared between connections) or into a new Metrics object.
+        Returns the Metrics object in use.'''
+        if metrics is None:
+            metrics = Metrics(transport.format_address(self.server,
+                                                       self.port))
+        self._metrics = metrics
+        return metrics
+
+    def disable_metrics(self):
+        self._metrics = None
+
+    def enable_ack_batching(self, max_acks=100, linger=20, on_error=None):
+        '''Make Job.Finish() queue its delete, to be sent with others later,
+        instead of waiting for it; see the acks module. Returns the
+        acks.AckBatcher, also available as self.acks.'''
+        self.acks = AckBatcher(self, max_acks, linger, on_error)
+        return self.acks
+
+    def disable_ack_batching(self):
+        if self.acks is not None:
+            self.acks.flush()
+        self.acks = None
+
+    def metrics(self):
+        '''a snapshot of the metrics per command, empty if not enabled'''
+        if self._metrics is None:
+            return {}
+        return self._metrics.snapshot()
 
     def _get_watchlist(self):
         return self.list_tubes_watched()['data']
@@ -122,14 +480,23 @@ class ServerConn(object):
         return self.list_tube_used()['tube']
 
     def close(self):
-        self.poller.unregister(self._socket)
+        if self._socket is None:
+            return
+        if self.acks is not None and self.acks.pending:
+            self.acks.flush()
+            if self._socket is None:
+                # lost while flushing
+                return
+        if self.poller:
+            self.poller.unregister(self._socket)
         self._socket.close()
+        self._socket = None
 
     def fileno(self):
         return self._socket.fileno()
 
 
-ServerConn = protohandler.protProvider(ServerConn)
+ServerConn = protohandler.protProvider(ServerConn, options=('timeout',))
 
 
 class ThreadedConn(ServerConn):
@@ -178,9 +545,4 @@ class ThreadedConnPool(object):
         self.useme.release()
 
 
-try:
-    from _libeventconn import LibeventConn
-except ImportError:
-    # most likely no libevent or pyevent. Thats fine, dont cause problems
-    # for such cases
-    pass
+from eventconn import EventConn
@@ -0,0 +1,471 @@
+"""
+A local disk spool for puts the servers cannot take right now.
+
+A Spool is an append-only journal of puts in a directory, split in segment
+files of segment_size bytes that are memory-mapped while in use. Records are
+read back from a checkpoint, which is only moved forward, and written to
+disk, once the jobs it covers were put; segments entirely behind the
+checkpoint are deleted. The spool never holds more than max_bytes of
+segments: appending beyond that raises errors.QueueFull.
+
+A Spooler puts jobs through a connection, and spools them instead when the
+servers are draining, out of memory or unreachable. Once anything is spooled
+later puts are spooled too, keeping their order, and a replay thread sends
+the spool back, pipelined on a ServerConn, as soon as the servers take puts
+again:
+
+    spooler = Spooler(ServerConn(host, port, reconnect=Backoff()),
+                      Spool('/var/spool/myapp'))
+    spooler.put(payload, tube='events')     # the jid, or None if spooled
+    ...
+    spooler.close()
+
+Delivery is at least once: a job the server took just before the connection
+was lost, or behind a failed put in the same pipelined batch, is put again.
+Give a ServerPool backoff=backoff.ONCE so that it does not wait out draining
+servers before the job is spooled.
+
+Every record is a header
+
+    'J', crc32, tube length, pri, delay, ttr, data length
+
+in network byte order, followed by the tube name and the job data; the crc
+covers everything after it. A record that is cut short or fails its crc ends
+its segment, which is how a record torn by a crash is found on restart.
+Records are in the operating system's hands as soon as they are appended, so
+they survive the process crashing; pass sync=True to flush them to disk as
+well, at the cost of a flush per put.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import errors
+import protohandler
+from backoff import Backoff
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAGIC = 'J'
+_header = struct.Struct('!cIHIIII')
+# the header fields after the crc
+_fields = struct.Struct('!HIIII')
+
+CHECKPOINT = 'checkpoint'
+SUFFIX = '.spool'
+
+# errors that get a put spooled rather than raised
+SPOOLED_ERRORS = (errors.Draining, errors.OutOfMemory, errors.NotConnected,
+                  errors.ConnectionLost)
+
+
+def _record(tube, data, pri, delay, ttr):
+    fields = _fields.pack(len(tube), pri, delay, ttr, len(data))
+    crc = zlib.crc32(data, zlib.crc32(tube, zlib.crc32(fields))) & 0xffffffff
+    return ''.join([MAGIC, struct.pack('!I', crc), fields, tube, data])
+
+
+class Spool(object):
+    '''An append-only journal of puts in directory, created if missing.
+
+    segment_size -- bytes per segment file, the largest record included
+    max_bytes -- the most bytes of segments kept on disk
+    sync -- flush every record and checkpoint to disk before returning
+    '''
+
+    def __init__(self, directory, segment_size=16 * 2 ** 20,
+                 max_bytes=256 * 2 ** 20, sync=False):
+        if segment_size > max_bytes:
+            raise ValueError('segment_size is larger than max_bytes')
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.sync = sync
+
+        self.appended = 0
+        self.committed = 0
+        self._lock = threading.Lock()
+        self._segments = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.checkpoint = self._load_checkpoint()
+        found = sorted(int(name[:-len(SUFFIX)])
+                       for name in os.listdir(directory)
+                       if name.endswith(SUFFIX))
+        for seq in found:
+            if seq < self.checkpoint[0]:
+                os.unlink(self._path(seq))
+            else:
+                self._open_segment(seq)
+        if not self._segments:
+            self._open_segment(self.checkpoint[0])
+        self._write_seq = max(self._segments)
+        self._write_pos = self._recover(self._write_seq)
+        self._pending = sum(1 for r in self._scan(self.checkpoint))
+
+    def __repr__(self):
+        return '<%s(%r) pending=%d>' % (self.__class__.__name__,
+                                        self.directory, self._pending)
+
+    def __len__(self):
+        '''the number of records not committed yet'''
+        return self._pending
+
+    def empty(self):
+        return self._pending == 0
+
+    def stats(self):
+        return {
+            'pending': self._pending,
+            'segments': len(self._segments),
+            'bytes': len(self._segments) * self.segment_size,
+            'max-bytes': self.max_bytes,
+            'appended': self.appended,
+            'committed': self.committed,
+        }
+
+    def _path(self, seq):
+        return os.path.join(self.directory, '%016d%s' % (seq, SUFFIX))
+
+    def _load_checkpoint(self):
+        try:
+            f = open(os.path.join(self.directory, CHECKPOINT))
+        except IOError:
+            return (0, 0)
+        try:
+            seq, pos = f.read().split()
+            return (int(seq), int(pos))
+        finally:
+            f.close()
+
+    def _open_segment(self, seq):
+        f = open(self._path(seq), 'a+b')
+        try:
+            f.truncate(self.segment_size)
+            self._segments[seq] = (f, mmap.mmap(f.fileno(), self.segment_size))
+        except:
+            f.close()
+            raise
+
+    def _close_segment(self, seq, unlink=False):
+        f, mm = self._segments.pop(seq)
+        mm.close()
+        f.close()
+        if unlink:
+            os.unlink(self._path(seq))
+
+    def _recover(self, seq):
+        '''the end of the last valid record in segment seq; whatever follows
+        it, such as a torn record, is zeroed'''
+        pos = 0
+        for start, end in self._records(seq, 0):
+            pos = end
+        mm = self._segments[seq][1]
+        if mm[pos:pos + 1] not in ('', '\0'):
+            logger.warning('%s: discarding a torn record at %d',
+                           self._path(seq), pos)
+            mm[pos:] = '\0' * (self.segment_size - pos)
+        return pos
+
+    def _records(self, seq, pos, limit=None):
+        '''(start, end) of the valid records of segment seq from pos on,
+        stopping at limit'''
+        mm = self._segments[seq][1]
+        size = self.segment_size if limit is None else limit
+        while pos + _header.size <= size:
+            magic, crc, tlen, pri, delay, ttr, dlen = \
+                _header.unpack_from(mm, pos)
+            end = pos + _header.size + tlen + dlen
+            if magic != MAGIC or end > size:
+                return
+            if zlib.crc32(mm[pos + 5:end]) & 0xffffffff != crc:
+                if seq != self._write_seq:
+                    logger.error('%s: bad record at %d, skipping the rest of '
+                                 'the segment', self._path(seq), pos)
+                return
+            yield pos, end
+            pos = end
+
+    def _scan(self, position, count=None):
+        '''(start, next position) of the records from position on'''
+        seq, pos = position
+        n = 0
+        while seq in self._segments:
+            limit = self._write_pos if seq == self._write_seq else None
+            for start, end in self._records(seq, pos, limit):
+                if count is not None and n >= count:
+                    return
+                n += 1
+                yield (seq, start), (seq, end)
+            if seq >= self._write_seq:
+                return
+            seq, pos = seq + 1, 0
+
+    def _roll(self):
+        if (len(self._segments) + 1) * self.segment_size > self.max_bytes:
+            raise errors.QueueFull('spool %s is full (%d bytes)' %
+                                   (self.directory, self.max_bytes))
+        self._open_segment(self._write_seq + 1)
+        if self.sync:
+            self._segments[self._write_seq][1].flush()
+        self._write_seq += 1
+        self._write_pos = 0
+
+    def append(self, tube, data, pri=1, delay=0, ttr=60):
+        '''Add a put of data into tube. Raises errors.QueueFull if the spool
+        has no room left.'''
+        record = _record(tube, data, pri, delay, ttr)
+        if len(record) > self.segment_size:
+            raise errors.JobTooBig('%d bytes do not fit a spool segment' %
+                                   len(record))
+        with self._lock:
+            if self._write_pos + len(record) > self.segment_size:
+                self._roll()
+            mm = self._segments[self._write_seq][1]
+            end = self._write_pos + len(record)
+            mm[self._write_pos:end] = record
+            if self.sync:
+                mm.flush()
+            self._write_pos = end
+            self._pending += 1
+            self.appended += 1
+
+    def read(self, position=None, count=100):
+        '''Up to count records from position, by default the checkpoint, as
+        a list of (next position, (tube, data, pri, delay, ttr)).'''
+        records = []
+        with self._lock:
+            for (seq, start), after in self._scan(position or self.checkpoint,
+                                                  count):
+                mm = self._segments[seq][1]
+                magic, crc, tlen, pri, delay, ttr, dlen = \
+                    _header.unpack_from(mm, start)
+                pos = start + _header.size
+                tube = mm[pos:pos + tlen]
+                data = mm[pos + tlen:pos + tlen + dlen]
+                records.append((after, (tube, data, pri, delay, ttr)))
+        return records
+
+    def commit(self, position):
+        '''Move the checkpoint to position, as returned by read(), and drop
+        the segments behind it.'''
+        with self._lock:
+            done = 0
+            for start, after in self._scan(self.checkpoint):
+                if after > position:
+                    break
+                done += 1
+            seq, pos = position
+            if seq < self._write_seq and pos and \
+                    not any(self._records(seq, pos)):
+                # the end of a full segment
+                seq, pos = seq + 1, 0
+            path = os.path.join(self.directory, CHECKPOINT)
+            f = open(path + '.tmp', 'w')
+            try:
+                f.write('%d %d\n' % (seq, pos))
+                if self.sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(path + '.tmp', path)
+            self.checkpoint = (seq, pos)
+            for old in [s for s in self._segments if s < seq]:
+                self._close_segment(old, unlink=True)
+            self._pending -= done
+            self.committed += done
+
+    def close(self):
+        with self._lock:
+            for seq in list(self._segments):
+                self._segments[seq][1].flush()
+                self._close_segment(seq)
+
+
+class Spooler(object):
+    '''Puts jobs through conn, a ServerConn or ServerPool, spooling them in
+    spool while the servers do not take them, and replaying the spool from
+    a thread of its own. conn must not be used by anything else.
+
+    backoff -- spaces out replay attempts while the servers still fail
+    max_batch -- the most records replayed in one go
+    '''
+
+    def __init__(self, conn, spool, backoff=None, max_batch=500):
+        self.conn = conn
+        self.spool = spool
+        self.backoff = backoff or Backoff(initial=0.1, maximum=10.0,
+                                          retries=None)
+        self.max_batch = max_batch
+        self.tube = 'default'
+
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self._using = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._replay_loop,
+                                        name='Spooler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return '<%s(%r, %r)>' % (self.__class__.__name__, self.conn,
+                                 self.spool)
+
+    def stats(self):
+        stats = self.spool.stats()
+        stats.update(spooled=self.spooled, replayed=self.replayed,
+                     dropped=self.dropped)
+        return stats
+
+    def use(self, tube):
+        '''the tube later puts go to'''
+        protohandler.check_name(tube)
+        self.tube = tube
+
+    def put(self, data, pri=1, delay=0, ttr=60, tube=None):
+        '''Put data into tube, by default the one in use. Returns the jid,
+        or None if the job was spooled.'''
+        tube = tube or self.tube
+        # under the lock a replay holds, so nothing is put directly ahead of
+        # what is spooled, nor spooled while another put goes direct
+        with self._lock:
+            if self.spool.empty():
+                try:
+                    return self._put(tube, data, pri, delay, ttr)['jid']
+                except SPOOLED_ERRORS, e:
+                    logger.warning('%r: spooling puts: %s', self, e)
+            self.spool.append(tube, data, pri, delay, ttr)
+            self.spooled += 1
+        self._wake.set()
+        return None
+
+    def _put(self, tube, data, pri, delay, ttr):
+        try:
+            if tube != self._using:
+                self.conn.use(tube)
+                self._using = tube
+            return self.conn.put(data, pri, delay, ttr)
+        except (errors.NotConnected, errors.ConnectionLost):
+            self._using = None
+            raise
+
+    def replay(self):
+        '''Send the next batch of the spool. Returns how many records were
+        replayed; raises what the connection raised, if anything.'''
+        with self._lock:
+            records = self.spool.read(count=self.max_batch)
+            if not records:
+                return 0
+            if hasattr(self.conn, 'pipeline'):
+                done, count = self._replay_pipelined(records)
+            else:
+                done, count = self._replay_each(records)
+            if done is not None:
+                self.spool.commit(done)
+                self.replayed += count
+            return count
+
+    def _replay_pipelined(self, records):
+        commands = []
+        # (position, tube, index of the put's reply or None if not sent)
+        puts = []
+        for position, (tube, data, pri, delay, ttr) in records:
+            if tube != self._using:
+                commands.append(protohandler.process_use(tube))
+                self._using = tube
+            try:
+                commands.append(protohandler.process_put(data, pri, delay,
+                                                         ttr))
+            except errors.BeanStalkError, e:
+                self._drop(tube, e)
+                puts.append((position, tube, None))
+            else:
+                puts.append((position, tube, len(commands) - 1))
+        try:
+            results = self.conn.pipeline(commands)
+        except Exception:
+            self._using = None
+            raise
+        done, count = None, 0
+        for position, tube, index in puts:
+            if index is not None:
+                res = results[index]
+                if isinstance(res, errors.ServerError):
+                    # the server cannot take puts yet, try again later
+                    break
+                if isinstance(res, errors.BeanStalkError):
+                    self._drop(tube, res)
+            done = position
+            count += 1
+        return done, count
+
+    def _replay_each(self, records):
+        done, count = None, 0
+        for position, (tube, data, pri, delay, ttr) in records:
+            try:
+                self._put(tube, data, pri, delay, ttr)
+            except SPOOLED_ERRORS:
+                if done is None:
+                    raise
+                break
+            except errors.BeanStalkError, e:
+                self._drop(tube, e)
+            done = position
+            count += 1
+        return done, count
+
+    def _drop(self, tube, e):
+        self.dropped += 1
+        logger.error('%r: dropping a spooled put into %s: %s', self, tube, e)
+
+    def _replay_loop(self):
+        attempt = 0
+        while not self._stopping:
+            if self.spool.empty():
+                self._wake.wait(1.0)
+                self._wake.clear()
+                continue
+            try:
+                if self.replay():
+                    attempt = 0
+                    continue
+                error = 'no record replayed'
+            except SPOOLED_ERRORS, e:
+                error = e
+                if hasattr(self.conn, 'reconnect') and \
+                        isinstance(e, (errors.NotConnected,
+                                       errors.ConnectionLost)):
+                    self._reconnect()
+            except Exception, e:
+                logger.exception('%r: replay failed', self)
+                error = e
+            logger.info('%r: replay: %s', self, error)
+            self._wake.wait(self.backoff.delay(attempt))
+            self._wake.clear()
+            attempt += 1
+
+    def _reconnect(self):
+        with self._lock:
+            try:
+                self.conn.reconnect()
+            except errors.NotConnected, e:
+                logger.info('%r: %s', self, e)
+
+    def close(self, timeout=None):
+        '''Stop the replay thread; what is still spooled stays on disk for
+        the next Spooler on the same directory.'''
+        self._stopping = True
+        self._wake.set()
+        self._thread.join(timeout)
+        self.spool.close()
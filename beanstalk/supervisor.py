@@ -0,0 +1,318 @@
+"""
+A consumer supervisor: worker threads reserving jobs from a set of tubes,
+as many of them as the backlog calls for.
+
+    def handle(job):
+        process(job['data'])
+
+    supervisor = ConsumerSupervisor(lambda: ServerConn(host, port), handle,
+                                    tubes=['emails'], max_workers=16,
+                                    target_wait=2.0)
+    supervisor.start()
+    ...
+    supervisor.stop()
+
+Each worker has a connection of its own, made by calling connect. A job is
+deleted once handler returned, and released, error_delay seconds later,
+if handler raised.
+
+Every interval seconds the supervisor samples the servers: the ready jobs
+and the waiting connections of its tubes from stats-tube, and the rate of
+reserves from the growth of cmd-reserve and cmd-reserve-with-timeout in
+stats (which counts the reserves of every client of the server, not only
+those of these tubes). The ready jobs divided by that rate estimate how long
+a job waits to be reserved. Above target_wait the supervisor adds workers,
+in proportion to the excess; below half of it, with workers of its own
+idle, it stops one. Both must hold for up_after, respectively down_after,
+samples in a row, so that bursts do not make the pool flap.
+
+A worker that is stopped finishes the job it is handling, releases the ones
+it prefetched, and exits. A worker that fails, e.g. on a lost connection,
+releases its prefetched jobs if it still can and exits too; the supervisor
+starts new ones at its next sample if fewer than min_workers are left. Prefetching (prefetch > 1) saves round trips for
+short jobs, but the jobs' time to run starts when they are reserved.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+import errors
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RESERVE_STATS = ('cmd-reserve', 'cmd-reserve-with-timeout')
+
+
+class _Worker(threading.Thread):
+    def __init__(self, supervisor, number):
+        threading.Thread.__init__(self, name='ConsumerWorker-%d' % number)
+        self.daemon = True
+        self.supervisor = supervisor
+        self.stopping = False
+        self.busy = False
+        self.handled = 0
+
+    def run(self):
+        supervisor = self.supervisor
+        conn = None
+        prefetched = deque()
+        try:
+            conn = supervisor.connect()
+            for tube in supervisor.tubes:
+                conn.watch(tube)
+            if 'default' not in supervisor.tubes:
+                conn.ignore('default')
+            while not self.stopping:
+                if not prefetched:
+                    self._reserve(conn, prefetched)
+                    continue
+                self._handle(conn, prefetched.popleft())
+            self._release_prefetched(conn, prefetched)
+        except Exception:
+            logger.exception('%s failed', self.name)
+            if prefetched:
+                try:
+                    self._release_prefetched(conn, prefetched)
+                except Exception, e:
+                    # if the connection is gone, so are the reservations
+                    logger.warning('%s: could not release %d jobs: %s',
+                                   self.name, len(prefetched), e)
+        finally:
+            if conn is not None:
+                conn.close()
+            supervisor._exited(self)
+
+    def _release_prefetched(self, conn, prefetched):
+        while prefetched:
+            self.supervisor._release(conn, prefetched[0]['jid'], 0)
+            prefetched.popleft()
+
+    def _reserve(self, conn, prefetched):
+        timeout = self.supervisor.poll
+        while len(prefetched) < self.supervisor.prefetch:
+            try:
+                job = conn.reserve_with_timeout(timeout)
+            except errors.DeadlineSoon:
+                break
+            if 'jid' not in job:
+                break
+            prefetched.append(job)
+            # only wait for the first one
+            timeout = 0
+
+    def _handle(self, conn, job):
+        self.busy = True
+        try:
+            self.supervisor.handler(job)
+        except Exception:
+            logger.exception('%s: job %s failed', self.name, job['jid'])
+            self.supervisor._release(conn, job['jid'],
+                                     self.supervisor.error_delay)
+        else:
+            try:
+                conn.delete(job['jid'])
+            except errors.NotFound:
+                # its time to run was up, it is someone else's now
+                logger.warning('%s: job %s was lost', self.name, job['jid'])
+        finally:
+            self.busy = False
+        self.handled += 1
+
+
+class ConsumerSupervisor(object):
+    '''Runs between min_workers and max_workers threads calling handler with
+    the jobs reserved from tubes, on connections made by connect().
+
+    target_wait -- seconds a job should wait to be reserved
+    interval -- seconds between samples of the backlog
+    up_after, down_after -- samples in a row calling for more, respectively
+                            fewer, workers before the pool is resized
+    prefetch -- jobs a worker reserves at a time
+    poll -- how long a worker waits for a job before checking whether it
+            should stop
+    error_delay -- delay of the jobs handler failed on
+    '''
+
+    def __init__(self, connect, handler, tubes=('default',), min_workers=1,
+                 max_workers=8, target_wait=1.0, interval=1.0, up_after=2,
+                 down_after=5, prefetch=1, poll=1, error_delay=5):
+        self.connect = connect
+        self.handler = handler
+        self.tubes = list(tubes)
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_wait = target_wait
+        self.interval = interval
+        self.up_after = up_after
+        self.down_after = down_after
+        self.prefetch = prefetch
+        self.poll = poll
+        self.error_delay = error_delay
+
+        self.last_sample = None
+        self.resizes = 0
+        # by the workers that exited
+        self._handled = 0
+        self._workers = []
+        self._numbered = 0
+        self._up = self._down = 0
+        self._previous = None
+        self._conn = None
+        self._stopping = threading.Event()
+        self._scaler = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s %r workers=%d>' % (self.__class__.__name__, self.tubes,
+                                       self.workers)
+
+    @property
+    def workers(self):
+        '''the number of workers not told to stop'''
+        with self._lock:
+            return sum(1 for w in self._workers if not w.stopping)
+
+    @property
+    def idle(self):
+        '''the number of workers not handling a job'''
+        with self._lock:
+            return sum(1 for w in self._workers
+                       if not w.stopping and not w.busy)
+
+    def stats(self):
+        with self._lock:
+            handled = self._handled + sum(w.handled for w in self._workers)
+        return {
+            'workers': self.workers,
+            'resizes': self.resizes,
+            'handled': handled,
+            'sample': self.last_sample,
+        }
+
+    def start(self):
+        self.resize(self.min_workers)
+        self._scaler = threading.Thread(target=self._scale_loop,
+                                        name='ConsumerSupervisor')
+        self._scaler.daemon = True
+        self._scaler.start()
+
+    def stop(self, timeout=None):
+        '''Stop scaling and all workers, waiting for them for at most
+        timeout seconds. Returns False if some workers are still running.'''
+        self._stopping.set()
+        if self._scaler is not None:
+            self._scaler.join(timeout)
+        with self._lock:
+            workers = list(self._workers)
+            for worker in workers:
+                worker.stopping = True
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in workers:
+            worker.join(None if deadline is None
+                        else max(0, deadline - time.time()))
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        return not any(w.is_alive() for w in workers)
+
+    def resize(self, count):
+        '''Start or stop workers to have count of them.'''
+        count = max(self.min_workers, min(self.max_workers, count))
+        with self._lock:
+            running = [w for w in self._workers if not w.stopping]
+            for worker in running[count:]:
+                worker.stopping = True
+            for i in xrange(count - len(running)):
+                self._numbered += 1
+                worker = _Worker(self, self._numbered)
+                self._workers.append(worker)
+                worker.start()
+        if count != len(running):
+            logger.info('%r: %d workers, was %d', self, count, len(running))
+            self.resizes += 1
+
+    def _exited(self, worker):
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+                self._handled += worker.handled
+
+    def _release(self, conn, jid, delay):
+        try:
+            pri = conn.stats_job(jid)['data']['pri']
+            conn.release(jid, pri, delay)
+        except errors.NotFound:
+            pass
+
+    def sample(self):
+        '''The backlog of the tubes, as a dict; wait is None on the first
+        sample, with no reserve rate to go by yet.'''
+        if self._conn is None:
+            self._conn = self.connect()
+        now = time.time()
+        ready = waiting = 0
+        for tube in self.tubes:
+            try:
+                data = self._conn.stats_tube(tube)['data']
+            except errors.NotFound:
+                continue
+            ready += data['current-jobs-ready']
+            waiting += data['current-waiting']
+        stats = self._conn.stats()['data']
+        reserves = sum(stats.get(name, 0) for name in RESERVE_STATS)
+
+        rate = wait = None
+        if self._previous is not None:
+            then, before = self._previous
+            rate = (reserves - before) / max(now - then, 1e-6)
+            if ready == 0:
+                wait = 0.0
+            elif rate > 0:
+                wait = ready / rate
+            else:
+                wait = float('inf')
+        self._previous = (now, reserves)
+        self.last_sample = {'ready': ready, 'waiting': waiting,
+                            'idle': self.idle, 'rate': rate, 'wait': wait}
+        return self.last_sample
+
+    def scale(self, sample):
+        '''Resize the pool for a sample, as returned by sample().'''
+        wait = sample['wait']
+        if wait is None:
+            return
+        workers = self.workers
+        if wait > self.target_wait:
+            self._up, self._down = self._up + 1, 0
+            if self._up >= self.up_after:
+                self._up = 0
+                if math.isinf(wait):
+                    wanted = workers * 2
+                else:
+                    wanted = int(math.ceil(workers * wait / self.target_wait))
+                self.resize(max(workers + 1, wanted))
+        elif wait < self.target_wait / 2 and sample['idle']:
+            self._up, self._down = 0, self._down + 1
+            if self._down >= self.down_after:
+                self._down = 0
+                self.resize(workers - 1)
+        else:
+            self._up = self._down = 0
+
+    def _scale_loop(self):
+        while not self._stopping.wait(self.interval):
+            if self.workers < self.min_workers:
+                # workers failed, e.g. on a lost connection; replacing them
+                # once an interval spaces out the reconnects
+                self.resize(self.min_workers)
+            try:
+                self.scale(self.sample())
+            except Exception:
+                logger.exception('%r: sampling failed', self)
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
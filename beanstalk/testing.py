@@ -0,0 +1,696 @@
+"""
+A pure-Python stand-in for beanstalkd, for tests and benchmarks.
+
+FakeServer speaks the part of the beanstalk protocol that protohandler
+implements: put and use, the reserve variants, delete, release, bury, touch,
+watch and ignore, the peek variants, kick, the stats commands and the list
+commands. Tubes, priorities, delays, time-to-run (including DEADLINE_SOON)
+and per-connection reservations behave like the real server, closely enough
+for client testing; durability, binlogs and pause-tube do not exist.
+
+    server = FakeServer()           # 127.0.0.1, on a free port
+    server.start()
+    conn = ServerConn(*server.address)
+    ...
+    server.stop()
+
+or, as a context manager:
+
+    with FakeServer('/tmp/beanstalk.sock') as server:
+        ...
+
+Every client connection is served by its own thread. The following knobs
+may be given to the constructor or changed on a running server, to exercise
+latency and failure handling in clients:
+
+    latency     seconds to wait before each reply. Either a number, or a
+                dict mapping wire command names (e.g. 'put', 'stats-tube')
+                to seconds.
+    chunk_size  if set, replies are written in pieces of this many bytes,
+                chunk_delay seconds apart, so clients see partial reads.
+    drop_after  if set, each connection is closed when it sends its
+                drop_after-th command, without a reply.
+    put_error   if set, every put is answered with this reply word instead,
+                e.g. 'DRAINING' or 'OUT_OF_MEMORY'.
+
+drop_connections() closes every connection that is currently open.
+"""
+
+import heapq
+import os
+import socket
+import threading
+import time
+
+SAFETY_MARGIN = 1.0
+URGENT_PRI = 1024
+MAX_LINE = 224
+
+
+class _Job(object):
+    __slots__ = ('id', 'tube', 'pri', 'delay', 'ttr', 'body', 'state',
+                 'created', 'ready_at', 'deadline', 'reserver', 'reserves',
+                 'timeouts', 'releases', 'buries', 'kicks')
+
+    def __init__(self, jid, tube, pri, delay, ttr, body):
+        self.id = jid
+        self.tube = tube
+        self.pri = pri
+        self.delay = delay
+        self.ttr = ttr
+        self.body = body
+        self.state = None
+        self.created = time.time()
+        self.ready_at = 0
+        self.deadline = 0
+        self.reserver = None
+        self.reserves = self.timeouts = self.releases = 0
+        self.buries = self.kicks = 0
+
+
+class _Tube(object):
+    def __init__(self, name):
+        self.name = name
+        self.ready = []
+        self.buried = []
+        self.jobs = set()
+        self.total_jobs = 0
+        self.cmd_delete = 0
+
+
+class _Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.used = 'default'
+        self.watching = ['default']
+        self.reserved = set()
+        self.commands = 0
+        self.waiting = False
+        self.producer = False
+        self.worker = False
+        self.closed = False
+        self.thread = None
+
+
+def _scalar(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, basestring):
+        return '"%s"' % (value.replace('\\', '\\\\').replace('"', '\\"'),)
+    return str(value)
+
+def _yaml(obj):
+    if isinstance(obj, dict):
+        lines = ['%s: %s\n' % (k, _scalar(v)) for k, v in sorted(obj.items())]
+    else:
+        lines = ['- %s\n' % (_scalar(v),) for v in obj]
+    return '---\n' + ''.join(lines)
+
+def _int(value, maximum=2**32 - 1):
+    if not value.isdigit():
+        raise ValueError(value)
+    value = int(value)
+    if value > maximum:
+        raise ValueError(value)
+    return value
+
+
+class FakeServer(object):
+
+    def __init__(self, address=('127.0.0.1', 0), max_job_size=2**16 - 1,
+                 latency=0, chunk_size=None, chunk_delay=0.001,
+                 drop_after=None, put_error=None):
+        self.max_job_size = max_job_size
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.drop_after = drop_after
+        self.put_error = put_error
+
+        self._requested = address
+        self.address = None
+        self._listener = None
+        self._thread = None
+        self._stopped = True
+        self._cond = threading.Condition()
+        self._reset()
+
+    def __repr__(self):
+        return '<%s(%s)>' % (self.__class__.__name__, self.address)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _reset(self):
+        self._jobs = {}
+        self._tubes = {'default': _Tube('default')}
+        self._delayed = []
+        self._deadlines = []
+        self._clients = set()
+        self._next_id = 1
+        self._counters = {}
+        self._total_connections = 0
+        self._job_timeouts = 0
+        self._started = time.time()
+
+    #
+    # listening and connection threads
+    #
+
+    def start(self):
+        if isinstance(self._requested, basestring):
+            if os.path.exists(self._requested):
+                os.unlink(self._requested)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self._requested)
+        sock.listen(128)
+        sock.settimeout(0.05)
+        self.address = sock.getsockname()
+        self._listener = sock
+        self._stopped = False
+        self._thread = threading.Thread(target=self._accept_loop,
+                                        name='FakeServer %s' % (self.address,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        self._thread.join()
+        self._listener.close()
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.unlink(self.address)
+        with self._cond:
+            clients = list(self._clients)
+            self._cond.notify_all()
+        for client in clients:
+            self._close(client)
+            client.thread.join(1)
+
+    def drop_connections(self):
+        with self._cond:
+            clients = list(self._clients)
+        for client in clients:
+            self._close(client)
+
+    def _accept_loop(self):
+        while not self._stopped:
+            try:
+                sock, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self._stopped:
+                    break
+                raise
+            sock.settimeout(None)
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(sock)
+            with self._cond:
+                self._clients.add(client)
+                self._total_connections += 1
+            client.thread = threading.Thread(target=self._serve, args=(client,))
+            client.thread.daemon = True
+            client.thread.start()
+
+    def _close(self, client):
+        with self._cond:
+            if client.closed:
+                return
+            client.closed = True
+            self._clients.discard(client)
+            for jid in list(client.reserved):
+                self._make_ready(self._jobs[jid])
+            client.reserved.clear()
+            self._cond.notify_all()
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        client.sock.close()
+
+    def _read(self, client, size):
+        while len(client.buf) < size:
+            data = client.sock.recv(65536)
+            if not data:
+                raise EOFError
+            client.buf += data
+        data, client.buf = client.buf[:size], client.buf[size:]
+        return data
+
+    def _readline(self, client):
+        while True:
+            line, sep, rest = client.buf.partition('\r\n')
+            if sep:
+                client.buf = rest
+                return line
+            if len(client.buf) > MAX_LINE:
+                client.buf = ''
+                return None
+            data = client.sock.recv(65536)
+            if not data:
+                raise EOFError
+            client.buf += data
+
+    def _serve(self, client):
+        try:
+            while not client.closed:
+                line = self._readline(client)
+                client.commands += 1
+                if self.drop_after and client.commands >= self.drop_after:
+                    break
+                if line is None:
+                    reply = 'BAD_FORMAT\r\n'
+                    name = None
+                else:
+                    name = line.split(' ', 1)[0]
+                    reply = self._dispatch(client, name, line)
+                if reply is None:
+                    break
+                self._delay(name)
+                self._write(client, reply)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self._close(client)
+
+    def _delay(self, name):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, 0)
+        if latency:
+            time.sleep(latency)
+
+    def _write(self, client, reply):
+        if not self.chunk_size:
+            client.sock.sendall(reply)
+            return
+        for i in xrange(0, len(reply), self.chunk_size):
+            client.sock.sendall(reply[i:i + self.chunk_size])
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+
+    def _dispatch(self, client, name, line):
+        args = line.split(' ')[1:]
+        func = getattr(self, '_cmd_%s' % (name.replace('-', '_'),), None)
+        if func is None:
+            return 'UNKNOWN_COMMAND\r\n'
+        if name == 'quit':
+            return None
+        key = 'cmd-%s' % (name,)
+        with self._cond:
+            self._counters[key] = self._counters.get(key, 0) + 1
+        try:
+            return func(client, *args)
+        except (TypeError, ValueError):
+            return 'BAD_FORMAT\r\n'
+
+    #
+    # job state, all of these require self._cond to be held
+    #
+
+    def _tube(self, name):
+        tube = self._tubes.get(name)
+        if tube is None:
+            tube = self._tubes[name] = _Tube(name)
+        return tube
+
+    def _make_ready(self, job):
+        job.state = 'ready'
+        job.reserver = None
+        heapq.heappush(self._tubes[job.tube].ready, (job.pri, job.id))
+        self._cond.notify_all()
+
+    def _make_delayed(self, job, delay):
+        job.state = 'delayed'
+        job.delay = delay
+        job.reserver = None
+        job.ready_at = time.time() + delay
+        heapq.heappush(self._delayed, (job.ready_at, job.id))
+
+    def _unreserve(self, job):
+        if job.reserver is not None:
+            job.reserver.reserved.discard(job.id)
+            job.reserver = None
+
+    def _remove(self, job):
+        self._unreserve(job)
+        tube = self._tubes[job.tube]
+        tube.jobs.discard(job.id)
+        if job.state == 'buried':
+            tube.buried.remove(job.id)
+        job.state = 'deleted'
+        del self._jobs[job.id]
+
+    def _update(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            ready_at, jid = heapq.heappop(self._delayed)
+            job = self._jobs.get(jid)
+            if job and job.state == 'delayed' and job.ready_at == ready_at:
+                self._make_ready(job)
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, jid = heapq.heappop(self._deadlines)
+            job = self._jobs.get(jid)
+            if job and job.state == 'reserved' and job.deadline == deadline:
+                job.timeouts += 1
+                self._job_timeouts += 1
+                self._unreserve(job)
+                self._make_ready(job)
+
+    def _top_ready(self, tube):
+        '''the best ready job in tube, dropping stale heap entries'''
+        heap = tube.ready
+        while heap:
+            pri, jid = heap[0]
+            job = self._jobs.get(jid)
+            if job and job.state == 'ready' and job.pri == pri:
+                return job
+            heapq.heappop(heap)
+        return None
+
+    def _next_event(self, client, now):
+        times = []
+        if self._delayed:
+            times.append(self._delayed[0][0])
+        if self._deadlines:
+            times.append(self._deadlines[0][0])
+        for jid in client.reserved:
+            times.append(self._jobs[jid].deadline - SAFETY_MARGIN)
+        return min(times) - now if times else None
+
+    def _deadline_soon(self, client, now):
+        for jid in client.reserved:
+            if self._jobs[jid].deadline - now <= SAFETY_MARGIN:
+                return True
+        return False
+
+    def _found(self, word, job):
+        return '%s %s %s\r\n%s\r\n' % (word, job.id, len(job.body), job.body)
+
+    def _ok(self, obj):
+        data = _yaml(obj)
+        return 'OK %s\r\n%s\r\n' % (len(data), data)
+
+    def _job_for_client(self, client, jid):
+        '''a job reserved by client, or None'''
+        job = self._jobs.get(_int(jid, 2**64))
+        if job and job.state == 'reserved' and job.reserver is client:
+            return job
+        return None
+
+    #
+    # commands
+    #
+
+    def _cmd_quit(self, client):
+        return None
+
+    def _cmd_put(self, client, pri, delay, ttr, size):
+        pri, delay, ttr, size = _int(pri), _int(delay), _int(ttr), _int(size)
+        body = self._read(client, size + 2)
+        if size > self.max_job_size:
+            return 'JOB_TOO_BIG\r\n'
+        if not body.endswith('\r\n'):
+            return 'EXPECTED_CRLF\r\n'
+        if self.put_error:
+            return '%s\r\n' % (self.put_error,)
+        with self._cond:
+            client.producer = True
+            job = _Job(self._next_id, client.used, pri, delay, max(ttr, 1),
+                       body[:-2])
+            self._next_id += 1
+            self._jobs[job.id] = job
+            tube = self._tube(job.tube)
+            tube.jobs.add(job.id)
+            tube.total_jobs += 1
+            if delay:
+                self._make_delayed(job, delay)
+            else:
+                self._make_ready(job)
+            return 'INSERTED %s\r\n' % (job.id,)
+
+    def _cmd_use(self, client, tube):
+        with self._cond:
+            self._tube(tube)
+            client.used = tube
+        return 'USING %s\r\n' % (tube,)
+
+    def _cmd_reserve(self, client):
+        return self._reserve(client, None)
+
+    def _cmd_reserve_with_timeout(self, client, timeout):
+        return self._reserve(client, _int(timeout))
+
+    def _reserve(self, client, timeout):
+        start = time.time()
+        with self._cond:
+            client.worker = True
+            client.waiting = True
+            try:
+                while True:
+                    now = time.time()
+                    self._update(now)
+                    jobs = filter(None, [self._top_ready(self._tube(t))
+                                         for t in client.watching])
+                    if jobs:
+                        job = min(jobs, key=lambda j: (j.pri, j.id))
+                        heapq.heappop(self._tubes[job.tube].ready)
+                        job.state = 'reserved'
+                        job.reserver = client
+                        job.reserves += 1
+                        job.deadline = now + job.ttr
+                        heapq.heappush(self._deadlines, (job.deadline, job.id))
+                        client.reserved.add(job.id)
+                        return self._found('RESERVED', job)
+                    if self._deadline_soon(client, now):
+                        return 'DEADLINE_SOON\r\n'
+                    if timeout is not None and now - start >= timeout:
+                        return 'TIMED_OUT\r\n'
+                    if client.closed or self._stopped:
+                        return None
+                    wait = 0.1
+                    if timeout is not None:
+                        wait = min(wait, start + timeout - now)
+                    event = self._next_event(client, now)
+                    if event is not None:
+                        wait = min(wait, event)
+                    self._cond.wait(max(wait, 0.001))
+            finally:
+                client.waiting = False
+
+    def _cmd_delete(self, client, jid):
+        with self._cond:
+            job = self._jobs.get(_int(jid, 2**64))
+            if job is None or (job.state == 'reserved' and
+                               job.reserver is not client):
+                return 'NOT_FOUND\r\n'
+            self._tubes[job.tube].cmd_delete += 1
+            self._remove(job)
+        return 'DELETED\r\n'
+
+    def _cmd_release(self, client, jid, pri, delay):
+        pri, delay = _int(pri), _int(delay)
+        with self._cond:
+            job = self._job_for_client(client, jid)
+            if job is None:
+                return 'NOT_FOUND\r\n'
+            self._unreserve(job)
+            job.pri = pri
+            job.releases += 1
+            if delay:
+                self._make_delayed(job, delay)
+            else:
+                self._make_ready(job)
+        return 'RELEASED\r\n'
+
+    def _cmd_bury(self, client, jid, pri):
+        pri = _int(pri)
+        with self._cond:
+            job = self._job_for_client(client, jid)
+            if job is None:
+                return 'NOT_FOUND\r\n'
+            self._unreserve(job)
+            job.pri = pri
+            job.buries += 1
+            job.state = 'buried'
+            self._tubes[job.tube].buried.append(job.id)
+        return 'BURIED\r\n'
+
+    def _cmd_touch(self, client, jid):
+        with self._cond:
+            job = self._job_for_client(client, jid)
+            if job is None:
+                return 'NOT_FOUND\r\n'
+            job.deadline = time.time() + job.ttr
+            heapq.heappush(self._deadlines, (job.deadline, job.id))
+        return 'TOUCHED\r\n'
+
+    def _cmd_watch(self, client, tube):
+        with self._cond:
+            self._tube(tube)
+            if tube not in client.watching:
+                client.watching.append(tube)
+            self._cond.notify_all()
+            return 'WATCHING %s\r\n' % (len(client.watching),)
+
+    def _cmd_ignore(self, client, tube):
+        with self._cond:
+            if client.watching == [tube]:
+                return 'NOT_IGNORED\r\n'
+            if tube in client.watching:
+                client.watching.remove(tube)
+            return 'WATCHING %s\r\n' % (len(client.watching),)
+
+    def _cmd_peek(self, client, jid):
+        with self._cond:
+            job = self._jobs.get(_int(jid, 2**64))
+            if job is None:
+                return 'NOT_FOUND\r\n'
+            return self._found('FOUND', job)
+
+    def _cmd_peek_ready(self, client):
+        with self._cond:
+            self._update(time.time())
+            job = self._top_ready(self._tube(client.used))
+            if job is None:
+                return 'NOT_FOUND\r\n'
+            return self._found('FOUND', job)
+
+    def _delayed_in(self, tube):
+        return sorted((self._jobs[jid] for jid in tube.jobs
+                       if self._jobs[jid].state == 'delayed'),
+                      key=lambda j: (j.ready_at, j.id))
+
+    def _cmd_peek_delayed(self, client):
+        with self._cond:
+            self._update(time.time())
+            jobs = self._delayed_in(self._tube(client.used))
+            if not jobs:
+                return 'NOT_FOUND\r\n'
+            return self._found('FOUND', jobs[0])
+
+    def _cmd_peek_buried(self, client):
+        with self._cond:
+            tube = self._tube(client.used)
+            if not tube.buried:
+                return 'NOT_FOUND\r\n'
+            return self._found('FOUND', self._jobs[tube.buried[0]])
+
+    def _cmd_kick(self, client, bound):
+        bound = _int(bound)
+        with self._cond:
+            self._update(time.time())
+            tube = self._tube(client.used)
+            if tube.buried:
+                jobs = [self._jobs[jid] for jid in tube.buried[:bound]]
+                del tube.buried[:len(jobs)]
+            else:
+                jobs = self._delayed_in(tube)[:bound]
+            for job in jobs:
+                job.kicks += 1
+                self._make_ready(job)
+            return 'KICKED %s\r\n' % (len(jobs),)
+
+    def _job_counts(self, jobs, now):
+        counts = dict.fromkeys(['ready', 'urgent', 'reserved', 'delayed',
+                                'buried'], 0)
+        for job in jobs:
+            counts[job.state] += 1
+            if job.state == 'ready' and job.pri < URGENT_PRI:
+                counts['urgent'] += 1
+        return dict(('current-jobs-%s' % k, v) for k, v in counts.items())
+
+    def _cmd_stats(self, client):
+        with self._cond:
+            now = time.time()
+            self._update(now)
+            stats = self._job_counts(self._jobs.itervalues(), now)
+            for name in ('put', 'peek', 'peek-ready', 'peek-delayed',
+                         'peek-buried', 'reserve', 'reserve-with-timeout',
+                         'delete', 'release', 'use', 'watch', 'ignore', 'bury',
+                         'kick', 'touch', 'stats', 'stats-job', 'stats-tube',
+                         'list-tubes', 'list-tube-used', 'list-tubes-watched'):
+                key = 'cmd-%s' % (name,)
+                stats[key] = self._counters.get(key, 0)
+            stats.update({
+                'job-timeouts': self._job_timeouts,
+                'total-jobs': self._next_id - 1,
+                'max-job-size': self.max_job_size,
+                'current-tubes': len(self._tubes),
+                'current-connections': len(self._clients),
+                'current-producers': sum(c.producer for c in self._clients),
+                'current-workers': sum(c.worker for c in self._clients),
+                'current-waiting': sum(c.waiting for c in self._clients),
+                'total-connections': self._total_connections,
+                'pid': os.getpid(),
+                'version': 'fake',
+                'uptime': int(now - self._started),
+                'draining': self.put_error == 'DRAINING',
+            })
+            return self._ok(stats)
+
+    def _cmd_stats_job(self, client, jid):
+        with self._cond:
+            now = time.time()
+            self._update(now)
+            job = self._jobs.get(_int(jid, 2**64))
+            if job is None:
+                return 'NOT_FOUND\r\n'
+            if job.state == 'reserved':
+                left = job.deadline - now
+            elif job.state == 'delayed':
+                left = job.ready_at - now
+            else:
+                left = 0
+            return self._ok({
+                'id': job.id, 'tube': job.tube, 'state': job.state,
+                'pri': job.pri, 'age': int(now - job.created),
+                'delay': job.delay, 'ttr': job.ttr,
+                'time-left': max(int(left), 0), 'file': 0,
+                'reserves': job.reserves, 'timeouts': job.timeouts,
+                'releases': job.releases, 'buries': job.buries,
+                'kicks': job.kicks})
+
+    def _cmd_stats_tube(self, client, name):
+        with self._cond:
+            now = time.time()
+            self._update(now)
+            tube = self._tubes.get(name)
+            if tube is None:
+                return 'NOT_FOUND\r\n'
+            stats = self._job_counts((self._jobs[j] for j in tube.jobs), now)
+            stats.update({
+                'name': name,
+                'total-jobs': tube.total_jobs,
+                'current-using': sum(c.used == name for c in self._clients),
+                'current-watching': sum(name in c.watching
+                                        for c in self._clients),
+                'current-waiting': sum(c.waiting and name in c.watching
+                                       for c in self._clients),
+                'cmd-delete': tube.cmd_delete,
+                'cmd-pause-tube': 0,
+                'pause': 0,
+                'pause-time-left': 0,
+            })
+            return self._ok(stats)
+
+    def _cmd_list_tubes(self, client):
+        with self._cond:
+            return self._ok(sorted(self._tubes))
+
+    def _cmd_list_tube_used(self, client):
+        return 'USING %s\r\n' % (client.used,)
+
+    def _cmd_list_tubes_watched(self, client):
+        return self._ok(list(client.watching))
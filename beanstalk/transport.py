@@ -0,0 +1,219 @@
+"""
+Server addresses and socket options, shared by all connection types.
+
+An address is given to a connection as its server and port arguments, as
+before: ('localhost', 11300). It may also be one string, with the port left
+out (None):
+
+    'localhost:11300'    TCP
+    '[::1]:11300'        TCP over IPv6
+    'localhost'          TCP, on DEFAULT_PORT
+    'unix:/tmp/beanstalkd.sock'
+                         a unix domain socket, see beanstalkd -l unix:...
+
+Socket options are set with a SocketOptions instance, or the name of one of
+the PROFILES:
+
+    conn = ServerConn('queue.example.com:11300', socket_options='remote')
+
+The 'default' profile leaves the system defaults alone. TCP-only options are
+skipped for unix domain sockets.
+"""
+
+import errno
+import os
+import select
+import socket
+import time
+
+DEFAULT_PORT = 11300
+UNIX_PREFIX = 'unix:'
+
+
+def parse_address(server, port=None):
+    '''(family, sockaddr) for a server and port given to a connection'''
+    if port is not None:
+        return _inet(server, int(port))
+    if isinstance(server, tuple):
+        return _inet(server[0], int(server[1]))
+    if server.startswith(UNIX_PREFIX):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('unix domain sockets are not supported here')
+        return socket.AF_UNIX, server[len(UNIX_PREFIX):]
+    host, sep, port = server.rpartition(':')
+    if not sep or (':' in host and not host.startswith('[')):
+        # no port, or an IPv6 address without brackets
+        return _inet(server.strip('[]'), DEFAULT_PORT)
+    return _inet(host.strip('[]'), int(port))
+
+def _inet(host, port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return family, (host, port)
+
+def format_address(server, port=None):
+    '''the address as a string, e.g. for logs and metrics names'''
+    family, sockaddr = parse_address(server, port)
+    if family == getattr(socket, 'AF_UNIX', None):
+        return UNIX_PREFIX + sockaddr
+    if family == socket.AF_INET6:
+        return '[%s]:%s' % sockaddr
+    return '%s:%s' % sockaddr
+
+
+class SocketOptions(object):
+    '''Options set on a connection's socket before it connects.
+
+    nodelay -- set TCP_NODELAY, so small commands are sent at once rather
+               than held back by Nagle's algorithm while earlier (pipelined)
+               ones are unacknowledged
+    keepalive -- set SO_KEEPALIVE, to notice dead peers on idle connections.
+                 keepidle, keepintvl and keepcnt tune it where the platform
+                 supports TCP_KEEPIDLE and friends
+    sndbuf, rcvbuf -- SO_SNDBUF and SO_RCVBUF, in bytes
+
+    Options left at None are not touched.
+    '''
+
+    def __init__(self, nodelay=None, keepalive=None, keepidle=None,
+                 keepintvl=None, keepcnt=None, sndbuf=None, rcvbuf=None):
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+    def __repr__(self):
+        set_ = ', '.join('%s=%r' % item for item in sorted(vars(self).items())
+                         if item[1] is not None)
+        return '%s(%s)' % (self.__class__.__name__, set_)
+
+    def apply(self, sock, family):
+        if self.sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        if self.nodelay is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                            int(self.nodelay))
+        if self.keepalive is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                            int(self.keepalive))
+        for name in ('keepidle', 'keepintvl', 'keepcnt'):
+            value = getattr(self, name)
+            option = getattr(socket, 'TCP_' + name.upper(), None)
+            if value is not None and option is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+
+PROFILES = {
+    'default': SocketOptions(),
+    # same host or network: don't delay pipelined commands
+    'low-latency': SocketOptions(nodelay=True),
+    # across networks: also detect dead peers, and keep more in flight
+    'remote': SocketOptions(nodelay=True, keepalive=True, keepidle=60,
+                            keepintvl=10, keepcnt=5, sndbuf=256 * 1024,
+                            rcvbuf=256 * 1024),
+}
+
+def get_options(options):
+    '''a SocketOptions from a SocketOptions, a profile name, a dict of
+    SocketOptions arguments, or None for the default profile'''
+    if options is None:
+        return PROFILES['default']
+    if isinstance(options, SocketOptions):
+        return options
+    if isinstance(options, basestring):
+        try:
+            return PROFILES[options]
+        except KeyError:
+            raise ValueError('unknown socket options profile %r' % (options,))
+    return SocketOptions(**options)
+
+def make_socket(server, port=None, options=None):
+    '''a new stream socket for the address, with options applied, and the
+    address to connect it to'''
+    family, sockaddr = parse_address(server, port)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        get_options(options).apply(sock, family)
+    except:
+        sock.close()
+        raise
+    return sock, sockaddr
+
+def connect(server, port=None, options=None, timeout=None):
+    '''a (blocking) socket connected to the address, with options applied,
+    giving up after timeout seconds if given'''
+    sock, sockaddr = make_socket(server, port, options)
+    try:
+        if timeout is not None:
+            sock.settimeout(timeout)
+        sock.connect(sockaddr)
+        sock.settimeout(None)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def connect_all(addresses, options=None, timeout=None):
+    '''Connect to all (server, port) addresses at once, rather than one
+    after the other. Returns a list with, for each address, a (blocking)
+    connected socket or the socket.error it failed with; addresses that did
+    not connect within timeout seconds get a socket.timeout.'''
+    results = [None] * len(addresses)
+    pending = {}
+    for i, (server, port) in enumerate(addresses):
+        try:
+            sock, sockaddr = make_socket(server, port, options)
+        except socket.error, e:
+            results[i] = e
+            continue
+        sock.setblocking(False)
+        err = sock.connect_ex(sockaddr)
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            pending[sock.fileno()] = (i, sock)
+        elif err:
+            sock.close()
+            results[i] = socket.error(err, os.strerror(err))
+        else:
+            sock.setblocking(True)
+            results[i] = sock
+
+    deadline = None if timeout is None else time.time() + timeout
+    poller = getattr(select, 'poll', lambda : None)()
+    if poller:
+        for fd in pending:
+            poller.register(fd, select.POLLOUT)
+    while pending:
+        wait = None
+        if deadline is not None:
+            wait = deadline - time.time()
+            if wait <= 0:
+                break
+        if poller:
+            ready = [fd for fd, mask in
+                     poller.poll(None if wait is None else wait * 1000)]
+        else:
+            socks = [sock for i, sock in pending.values()]
+            r, w, x = select.select([], socks, socks, wait)
+            ready = set(sock.fileno() for sock in w + x)
+        for fd in ready:
+            i, sock = pending.pop(fd)
+            if poller:
+                poller.unregister(fd)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                sock.close()
+                results[i] = socket.error(err, os.strerror(err))
+            else:
+                sock.setblocking(True)
+                results[i] = sock
+
+    for i, sock in pending.values():
+        sock.close()
+        results[i] = socket.timeout('timed out')
+    return results
@@ -1,7 +1,13 @@
-from twisted.protocols import basic
-from twisted.internet import defer, protocol
+import socket
+import time
+
+from twisted.application import service
+from twisted.internet import defer, protocol, task
 from twisted.logger import Logger
+import errors
 import protohandler
+import transport
+from metrics import Metrics, command_name, reply_state
 
 # Stolen from memcached protocol
 try:
@@ -39,6 +45,7 @@ class Command(object):
         """
         self.command = command
         self.handler = handler
+        self.started = None
         self._deferred = defer.Deferred()
         for k, v in kwargs.items():
             setattr(self, k, v)
@@ -60,16 +67,57 @@ class Command(object):
         self._deferred.errback(error)
 
 
-class Beanstalk(basic.LineReceiver):
+class Beanstalk(protocol.Protocol):
+    """
+    The beanstalk client protocol. Every command returns a L{Deferred}, fired
+    with the reply. Commands need not wait for earlier replies: they are
+    pipelined on the connection, and replies are matched to them in order,
+    however they are split up or bunched together in TCP segments.
+
+    @ivar max_in_flight: the most commands sent and not yet answered, or
+        C{None} for no limit. Commands issued beyond it are held back locally
+        and sent as replies come in. Once the limit is reached, registered
+        producers are paused (see L{registerProducer}) until the outstanding
+        commands drop to half the limit; L{whenReady} gives a L{Deferred} for
+        the same moment.
+    @type max_in_flight: C{int}
+
+    @ivar socket_options: options for the connection's socket, set once it
+        is connected; see L{transport.SocketOptions}.
+    """
 
     logger = Logger()
 
-    def __init__(self):
+    def __init__(self, max_in_flight=None, socket_options=None):
+        self.max_in_flight = max_in_flight
+        self.socket_options = socket_options
         self._current = deque()
+        self._backlog = deque()
+        self._reader = protohandler.ReplyReader()
+        self._paused = False
+        self._producers = []
+        self._waiting = []
+        self._metrics = None
 
     def connectionMade(self):
         self.logger.debug("{msg}", msg="Connected.")
-        self.setLineMode()
+        if self.socket_options is not None:
+            handle = self.transport.getHandle()
+            transport.get_options(self.socket_options).apply(handle,
+                                                             handle.family)
+
+    def connectionLost(self, reason):
+        pending = list(self._current) + list(self._backlog)
+        self._current.clear()
+        self._backlog.clear()
+        for cmdObj in pending:
+            self._fail(cmdObj, reason)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(reason)
+        for producer in self._producers:
+            producer.stopProducing()
+        self._producers = []
 
     def __getattr__(self, attr):
         def caller(*args, **kw):
@@ -81,53 +129,128 @@ class Beanstalk(basic.LineReceiver):
         except:
            raise AttributeError(attr)
 
+    def enable_metrics(self, metrics=None):
+        '''Start collecting per-command metrics, see serverconn.ServerConn'''
+        if metrics is None:
+            peer = self.transport.getPeer() if self.transport else None
+            metrics = Metrics(str(peer) if peer else None)
+        self._metrics = metrics
+        return metrics
+
+    def disable_metrics(self):
+        self._metrics = None
+
+    def metrics(self):
+        if self._metrics is None:
+            return {}
+        return self._metrics.snapshot()
+
+    def pending(self):
+        '''the number of commands not yet answered, held back ones included'''
+        return len(self._current) + len(self._backlog)
+
+    def registerProducer(self, producer):
+        """
+        Pause C{producer} (an L{IPushProducer}) whenever L{max_in_flight} is
+        reached, and resume it once enough replies came in. It is stopped
+        when the connection is lost.
+        """
+        self._producers.append(producer)
+        if self._paused:
+            producer.pauseProducing()
+
+    def unregisterProducer(self, producer):
+        self._producers.remove(producer)
+
+    def whenReady(self):
+        """
+        A L{Deferred} that fires with this protocol as soon as there is room
+        for more commands, which is right away unless L{max_in_flight} was
+        reached.
+        """
+        if not self._paused:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
     def __cmd(self, command, full_command, handler):
+        cmdObj = Command(command, handler, line=full_command)
+        limit = self.max_in_flight
+        # once anything is held back, everything after it is too, so the
+        # commands still go out in the order they were issued
+        if self._backlog or (limit is not None and len(self._current) >= limit):
+            self._backlog.append(cmdObj)
+        else:
+            self._send(cmdObj)
+        if (limit is not None and not self._paused and
+                len(self._current) + len(self._backlog) >= limit):
+            self._pause()
+        return cmdObj._deferred
+
+    def _send(self, cmdObj):
         # Note here: the protohandler already inserts the \r\n, so
         # it would be an error to do self.sendline()
-        self.transport.write(full_command)
-        cmdObj = Command(command, handler)
+        if self._metrics is not None:
+            cmdObj.started = time.time()
         self._current.append(cmdObj)
-        return cmdObj._deferred
+        self.transport.write(cmdObj.line)
 
-    def lineReceived(self, line):
+    def _pause(self):
+        self._paused = True
+        for producer in list(self._producers):
+            producer.pauseProducing()
+
+    def _resume(self):
+        self._paused = False
+        for producer in list(self._producers):
+            producer.resumeProducing()
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self)
+
+    def _replied(self):
         """
-        Receive line commands from the server.
+        The oldest command got its reply: send what was held back, and let
+        the callers go again if enough room was made.
         """
-        pending = self._current.popleft()
-        try:
-            # this is a bit silly as twisted is so nice as to remove the
-            # eol from the line, but protohandler.Handler needs it...
-            # the reason its needed is that protohandler needs to work
-            # in situations without twisted where things aren't so nice
-            res = pending.handler(line + "\r\n")
-        except Exception, e:
-            pending.fail(e)
-        else:
-            if res is not None: # we have a result!
-                pending.success(res)
-            else: # there is more data, its a job or something...
-                # push the pending command back on the stack
-                self._current.appendleft(pending)
-                self.setRawMode()
-
-    def rawDataReceived(self, data):
-        pending = self._current.popleft()
-        if len(data) >= pending.handler.remaining:
-            rem = data[pending.handler.remaining:]
-            data = data[:pending.handler.remaining]
-        else:
-            rem = None
+        backlog = self._backlog
+        while backlog and len(self._current) < self.max_in_flight:
+            self._send(backlog.popleft())
+        if (self._paused and
+                len(self._current) + len(backlog) <= self.max_in_flight // 2):
+            self._resume()
 
-        try:
-            res = pending.handler(data)
-        except Exception, e:
-            pending.fail(e)
-            self.setLineMode(rem)
-        if res:
-            pending.success(res)
-            self.setLineMode(rem)
-        else:
-            self._current.appendleft(pending)
+    def _record(self, pending, res=None, error=None):
+        self._metrics.record(command_name(pending.line),
+                             time.time() - pending.started, len(pending.line),
+                             pending.handler.received, reply_state(res), error)
+
+    def _succeed(self, pending, res):
+        if pending.started is not None and self._metrics is not None:
+            self._record(pending, res=res)
+        pending.success(res)
+
+    def _fail(self, pending, e):
+        if pending.started is not None and self._metrics is not None:
+            self._record(pending, error=e)
+        pending.fail(e)
+
+    def dataReceived(self, data):
+        """
+        Feed the replies in C{data} to the handlers of the pending commands,
+        see L{protohandler.ReplyReader}.
+        """
+        for pending, res, e in self._reader.feed(data, self._current):
+            self._replied()
+            if e is None:
+                self._succeed(pending, res)
+            else:
+                self._fail(pending, e)
+        if self._reader.buffered() and not self._current:
+            self.logger.error("{msg}", msg="Unexpected data from server.")
+            self._reader = protohandler.ReplyReader()
+            self.transport.loseConnection()
 
 
 class BeanstalkClientFactory(protocol.ClientFactory):
@@ -137,12 +260,319 @@ class BeanstalkClientFactory(protocol.ClientFactory):
     def startedConnecting(self, connector):
         self.logger.debug("{msg}", msg="Started to connect.")
 
+    # passed on to every Beanstalk protocol built
+    max_in_flight = None
+    socket_options = None
+
     def buildProtocol(self, addr):
         self.logger.debug("{msg}", msg="Connected.")
-        return Beanstalk()
+        return Beanstalk(max_in_flight=self.max_in_flight,
+                         socket_options=self.socket_options)
 
     def clientConnectionLost(self, connector, reason):
-        self.logger.debug("{msg}", msg="Lost connection, reason: " % reason)
+        self.logger.debug("{msg}", msg="Lost connection, reason: %s" % reason)
 
     def clientConnectionFailed(self, connector, reason):
-        self.logger.debug("{msg}", msg="Connection failed, reason: " % reason)
+        self.logger.debug("{msg}", msg="Connection failed, reason: %s" % reason)
+
+
+class ReconnectingBeanstalkFactory(protocol.ReconnectingClientFactory,
+                                   BeanstalkClientFactory):
+    """
+    A client factory that reconnects after a lost or failed connection, with
+    exponential backoff (see L{protocol.ReconnectingClientFactory} for the
+    initialDelay, factor, maxDelay and jitter attributes). The delay starts
+    over once a connection is made.
+    """
+
+    protocol = Beanstalk
+
+    def buildProtocol(self, addr):
+        self.logger.debug("{msg}", msg="Connected.")
+        self.resetDelay()
+        p = self.protocol(max_in_flight=self.max_in_flight,
+                          socket_options=self.socket_options)
+        p.factory = self
+        return p
+
+    def clientConnectionLost(self, connector, reason):
+        BeanstalkClientFactory.clientConnectionLost(self, connector, reason)
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        BeanstalkClientFactory.clientConnectionFailed(self, connector, reason)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+
+class _PooledBeanstalk(Beanstalk):
+    """
+    A Beanstalk protocol that tells its pool when it comes and goes.
+    """
+
+    def connectionMade(self):
+        Beanstalk.connectionMade(self)
+        self.factory.pool._connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.pool._disconnected(self)
+        Beanstalk.connectionLost(self, reason)
+
+
+class BeanstalkPool(object):
+    """
+    Keeps C{size} connections to each of C{servers} (a list of (host, port)
+    pairs, or address strings like 'unix:/tmp/beanstalkd.sock', see
+    L{transport}), reconnecting lost ones with backoff. C{socket_options}
+    apply to every connection.
+
+    Commands called on the pool go to the connection with the fewest
+    commands pending, taking turns between equally busy ones:
+
+        pool = BeanstalkPool([('localhost', 11300)], size=4).start()
+        pool.put('data')
+
+    Every connection uses the tube C{use} and watches the tubes in C{watch}
+    (set up again after a reconnect). A connection can also be taken out of
+    the rotation with L{acquire}, e.g. to block on a reserve, and put back
+    with L{release}.
+    """
+
+    logger = Logger()
+
+    def __init__(self, servers, size=1, max_in_flight=None, use=None,
+                 watch=(), maxDelay=30, socket_options=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.servers = list(servers)
+        self.size = size
+        self.max_in_flight = max_in_flight
+        self.use = use
+        self.watch = tuple(watch)
+        self.maxDelay = maxDelay
+        self.socket_options = socket_options
+        self.factories = []
+        self._protocols = []
+        self._busy = set()
+        self._waiting = []
+        self._connecting = []
+        self._closing = []
+        self._turn = 0
+
+    def start(self):
+        for server in self.servers:
+            family, address = transport.parse_address(server)
+            for i in xrange(self.size):
+                factory = ReconnectingBeanstalkFactory()
+                factory.protocol = _PooledBeanstalk
+                factory.max_in_flight = self.max_in_flight
+                factory.socket_options = self.socket_options
+                factory.maxDelay = self.maxDelay
+                factory.pool = self
+                self.factories.append(factory)
+                if family == getattr(socket, 'AF_UNIX', None):
+                    self.reactor.connectUNIX(address, factory)
+                else:
+                    self.reactor.connectTCP(address[0], address[1], factory)
+        return self
+
+    def stop(self):
+        """
+        Stop reconnecting and close all connections. Returns a L{Deferred}
+        that fires once they are all closed.
+        """
+        for factory in self.factories:
+            factory.stopTrying()
+        self.factories = []
+        closing = []
+        for p in list(self._protocols):
+            d = defer.Deferred()
+            self._closing.append((p, d))
+            closing.append(d)
+            p.transport.loseConnection()
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(errors.NotConnected('pool stopped'))
+        return defer.DeferredList(closing)
+
+    def whenConnected(self):
+        """
+        A L{Deferred} that fires with the pool once any connection is up.
+        """
+        if self._protocols:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._connecting.append(d)
+        return d
+
+    def connections(self):
+        '''the connected protocols'''
+        return list(self._protocols)
+
+    def pick(self):
+        """
+        The connection with the fewest commands pending, among those not
+        acquired. Raises L{errors.NotConnected} if there is none.
+        """
+        free = [p for p in self._protocols if p not in self._busy]
+        if not free:
+            raise errors.NotConnected('no connection available')
+        n = len(free)
+        start = self._turn % n
+        self._turn += 1
+        best = None
+        for i in xrange(n):
+            p = free[(start + i) % n]
+            depth = p.pending()
+            if best is None or depth < best_depth:
+                best, best_depth = p, depth
+        return best
+
+    def acquire(self):
+        """
+        A L{Deferred} firing with a connection for the caller's exclusive
+        use, as soon as one is free. Hand it back with L{release}. Cancel
+        the L{Deferred} to stop waiting.
+        """
+        for p in self._protocols:
+            if p not in self._busy:
+                self._busy.add(p)
+                return defer.succeed(p)
+        d = defer.Deferred(self._waiting.remove)
+        self._waiting.append(d)
+        return d
+
+    def release(self, p):
+        """
+        Put an acquired connection back. Connections lost in the meantime
+        are simply forgotten.
+        """
+        self._busy.discard(p)
+        if p in self._protocols:
+            self._hand_out(p)
+
+    def __getattr__(self, attr):
+        getattr(protohandler, 'process_%s' % (attr,))
+        def caller(*args, **kw):
+            return getattr(self.pick(), attr)(*args, **kw)
+        return caller
+
+    def _hand_out(self, p):
+        if self._waiting and p not in self._busy:
+            self._busy.add(p)
+            self._waiting.pop(0).callback(p)
+
+    def _connected(self, p):
+        if self.use:
+            p.use(self.use)
+        for tube in self.watch:
+            p.watch(tube)
+        if self.watch and 'default' not in self.watch:
+            p.ignore('default')
+        self._protocols.append(p)
+        connecting, self._connecting = self._connecting, []
+        for d in connecting:
+            d.callback(self)
+        self._hand_out(p)
+
+    def _disconnected(self, p):
+        if p in self._protocols:
+            self._protocols.remove(p)
+        self._busy.discard(p)
+        for item in self._closing[:]:
+            if item[0] is p:
+                self._closing.remove(item)
+                item[1].callback(None)
+
+
+class ConsumerService(service.Service):
+    """
+    Runs C{concurrency} consumer loops over a started L{BeanstalkPool}. Each
+    loop acquires its own connection, reserves a job (waiting at most
+    C{timeout} seconds at a time) and calls C{process(conn, job)}, where job
+    is the reserve reply. If process returns (or its L{Deferred} fires) the
+    job is deleted; if it fails, the job is released with C{retry_delay},
+    keeping its priority.
+
+    At most C{concurrency} jobs are processed at once, and no more than the
+    pool has connections: a loop waits until one is free.
+    """
+
+    logger = Logger()
+
+    def __init__(self, pool, process, concurrency=1, timeout=1,
+                 retry_delay=0):
+        self.pool = pool
+        self.process = process
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.processed = 0
+        self.failed = 0
+        self._loops = []
+        self._acquiring = set()
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loops = [self._loop() for i in xrange(self.concurrency)]
+
+    def stopService(self):
+        """
+        Stop the loops once their current job is done; the returned
+        L{Deferred} fires when they all are.
+        """
+        service.Service.stopService(self)
+        for d in list(self._acquiring):
+            d.cancel()
+        loops, self._loops = self._loops, []
+        return defer.DeferredList(loops)
+
+    @defer.inlineCallbacks
+    def _loop(self):
+        while self.running:
+            acquiring = self.pool.acquire()
+            self._acquiring.add(acquiring)
+            try:
+                conn = yield acquiring
+            except (errors.NotConnected, defer.CancelledError):
+                return
+            finally:
+                self._acquiring.discard(acquiring)
+            try:
+                yield self._consume(conn)
+            except Exception, e:
+                # most likely the connection was lost, don't spin on it
+                self.logger.error("{msg}", msg="Consumer error: %s" % (e,))
+                yield task.deferLater(self.pool.reactor, 1, lambda: None)
+            finally:
+                self.pool.release(conn)
+
+    @defer.inlineCallbacks
+    def _consume(self, conn):
+        try:
+            job = yield conn.reserve_with_timeout(self.timeout)
+        except errors.DeadlineSoon:
+            return
+        if job['state'] != 'ok':
+            return
+        try:
+            yield defer.maybeDeferred(self.process, conn, job)
+        except Exception, e:
+            self.failed += 1
+            self.logger.error("{msg}", msg="Job %s failed: %s"
+                              % (job['jid'], e))
+            yield self._release(conn, job['jid'])
+        else:
+            self.processed += 1
+            yield conn.delete(job['jid'])
+
+    @defer.inlineCallbacks
+    def _release(self, conn, jid):
+        try:
+            stats = yield conn.stats_job(jid)
+            yield conn.release(jid, stats['data']['pri'], self.retry_delay)
+        except errors.NotFound:
+            # its time to run was up, it is someone else's now
+            pass
@@ -0,0 +1,145 @@
+"""
+Benchmarks for pybeanstalk.
+
+Run them from the top of the source tree:
+
+    python -m benchmarks                      # every suite
+    python -m benchmarks protocol job         # only some suites
+    python -m benchmarks -o before.json       # save the results
+    python -m benchmarks -o after.json -c before.json
+
+Each suite is a module named bench_<suite> in this package, with a function
+run(runner). Micro benchmarks are timed with timeit: the number of loops is
+calibrated so that one repetition takes at least MIN_TIME seconds, and the
+best of REPEAT repetitions is kept. Throughput benchmarks time a whole batch
+of operations themselves and record the result.
+
+End-to-end suites start a beanstalk.testing.FakeServer unless a server is
+given with --server host:port, so they run anywhere. Numbers against the fake
+server are dominated by the fake server itself, they are only useful for
+comparing client side changes with each other.
+
+Results are written as JSON, so runs can be compared between commits with
+--compare.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+SUITES = ['protocol', 'job', 'dispatch', 'throughput', 'transport', 'startup']
+
+MIN_TIME = 0.2
+REPEAT = 5
+
+
+class Runner(object):
+
+    def __init__(self, server=None, quick=False, out=sys.stdout):
+        self.server = server
+        self.quick = quick
+        self.out = out
+        self.results = {}
+        self._fakes = []
+
+    def servers(self, count=1):
+        '''addresses of the servers end-to-end benchmarks should use: the one
+        given on the command line, else count fresh fake servers'''
+        if self.server:
+            return [self.server]
+        from beanstalk.testing import FakeServer
+        fakes = [FakeServer().start() for i in range(count)]
+        self._fakes.extend(fakes)
+        return [fake.address for fake in fakes]
+
+    def close(self):
+        for fake in self._fakes:
+            fake.stop()
+        del self._fakes[:]
+
+    def _report(self, name, result):
+        self.results[name] = result
+        if 'per_op' in result:
+            line = '%-50s %12.3f us/op' % (name, result['per_op'] * 1e6)
+        else:
+            line = '%-50s %12.1f ops/s' % (name, result['ops_per_sec'])
+        print >>self.out, line
+        self.out.flush()
+
+    def bench(self, name, func, number=None):
+        '''time func(), which is called without arguments'''
+        timer = timeit.Timer(func)
+        repeat = 1 if self.quick else REPEAT
+        if number is None:
+            number = 1
+            while True:
+                elapsed = timer.timeit(number)
+                if elapsed >= (0.01 if self.quick else MIN_TIME):
+                    break
+                number *= 10
+        best = min(timer.repeat(repeat, number))
+        self._report(name, {'per_op': best / number, 'number': number,
+                            'repeat': repeat})
+
+    def record(self, name, seconds, ops):
+        '''record a throughput benchmark that did ops operations in seconds'''
+        self._report(name, {'ops_per_sec': ops / seconds, 'ops': ops,
+                            'seconds': seconds})
+
+
+def _git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=here,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def metadata():
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'revision': _git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def run(suites=None, server=None, quick=False, out=sys.stdout):
+    runner = Runner(server, quick, out)
+    try:
+        for suite in suites or SUITES:
+            module = __import__('benchmarks.bench_%s' % (suite,),
+                                fromlist=['run'])
+            print >>out, '# %s' % (suite,)
+            module.run(runner)
+    finally:
+        runner.close()
+    return {'meta': metadata(), 'results': runner.results}
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def _cost(result):
+    '''seconds per operation, lower is better'''
+    if 'per_op' in result:
+        return result['per_op']
+    return 1.0 / result['ops_per_sec']
+
+def compare(old, new, out=sys.stdout):
+    '''print the change in cost per operation of every benchmark both runs
+    have in common. Positive changes are slowdowns.'''
+    print >>out, '%-50s %10s' % ('benchmark', 'change')
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before = _cost(old['results'][name])
+        after = _cost(new['results'][name])
+        print >>out, '%-50s %+9.1f%%' % (name, (after - before) / before * 100)
@@ -0,0 +1,36 @@
+import argparse
+import sys
+
+import benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Run pybeanstalk benchmarks.')
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help='suites to run (default: %s)' %
+                             ' '.join(benchmarks.SUITES))
+    parser.add_argument('-o', '--output', help='write results as JSON here')
+    parser.add_argument('-c', '--compare', metavar='JSON',
+                        help='compare the results with an earlier run')
+    parser.add_argument('-s', '--server', metavar='HOST:PORT',
+                        help='run end-to-end suites against this beanstalkd '
+                             'instead of a fake server')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='fewer and shorter repetitions, for smoke tests')
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        server = (host, int(port))
+
+    results = benchmarks.run(args.suites, server, args.quick)
+    if args.output:
+        benchmarks.save(results, args.output)
+    if args.compare:
+        print
+        benchmarks.compare(benchmarks.load(args.compare), results)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""
+Client side cost of issuing a command, without any I/O: the connection's
+interaction method is replaced by one that returns at once, so what is left
+is attribute lookup, building the command line and handler, and logging.
+"""
+
+from beanstalk import protohandler
+from beanstalk import serverconn
+from beanstalk import multiserverconn
+
+
+def _unconnected(cls, **attrs):
+    '''an instance of cls that was never connected'''
+    conn = cls.__new__(cls)
+    conn.__dict__.update(attrs)
+    return conn
+
+def run(runner):
+    runner.bench('dispatch.baseline.process_delete',
+                 lambda: protohandler.process_delete(1))
+
+    offline = type('OfflineServerConn', (serverconn.ServerConn,),
+                   {'_do_interaction': lambda self, line, handler: handler})
+    conn = _unconnected(offline, _socket=None, job=False, _metrics=None)
+    runner.bench('dispatch.ServerConn.delete', lambda: conn.delete(1))
+    runner.bench('dispatch.ServerConn.put', lambda: conn.put('x' * 100))
+    runner.bench('dispatch.ServerConn.attribute', lambda: conn._socket)
+
+    pooled = _unconnected(multiserverconn.AsyncServerConn, server='localhost')
+    runner.bench('dispatch.AsyncServerConn.attribute', lambda: pooled.server)
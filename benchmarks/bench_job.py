@@ -0,0 +1,21 @@
+"""
+Job benchmarks: constructing jobs from reserve replies, and serializing them.
+"""
+
+from beanstalk import job
+
+
+class DummyConn(object):
+    def __str__(self):
+        return 'DummyConn'
+
+REPLY = {'jid': 12345, 'bytes': 100, 'state': 'ok', 'data': 'x' * 100}
+
+def run(runner):
+    conn = DummyConn()
+    for cls in (job.Job, job.SlimJob):
+        name = cls.__name__
+        runner.bench('construct.%s' % (name,),
+                     lambda: cls(conn=conn, **REPLY))
+        instance = cls(conn=conn, **REPLY)
+        runner.bench('serialize.%s' % (name,), instance._serialize)
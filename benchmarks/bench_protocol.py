@@ -0,0 +1,75 @@
+"""
+protohandler benchmarks: building command lines, feeding replies through
+Handler in chunks of different sizes, and parsing yaml stats.
+"""
+
+from beanstalk import protohandler
+
+# arguments for every process_* function
+COMMANDS = {
+    'put': ('x' * 100, 0, 0, 60),
+    'use': ('tube',),
+    'reserve': (),
+    'reserve_with_timeout': (1,),
+    'delete': (12345,),
+    'release': (12345, 10, 0),
+    'bury': (12345, 10),
+    'watch': ('tube',),
+    'ignore': ('tube',),
+    'peek': (12345,),
+    'peek_ready': (),
+    'peek_delayed': (),
+    'peek_buried': (),
+    'kick': (10,),
+    'touch': (12345,),
+    'stats': (),
+    'stats_job': (12345,),
+    'stats_tube': ('tube',),
+    'list_tubes': (),
+    'list_tube_used': (),
+    'list_tubes_watched': (),
+}
+
+STATS = ''.join('%s: %s\n' % (k, i) for i, k in enumerate(
+    ['current-jobs-urgent', 'current-jobs-ready', 'current-jobs-reserved',
+     'current-jobs-delayed', 'current-jobs-buried', 'cmd-put', 'cmd-peek',
+     'cmd-peek-ready', 'cmd-peek-delayed', 'cmd-peek-buried', 'cmd-reserve',
+     'cmd-use', 'cmd-watch', 'cmd-ignore', 'cmd-delete', 'cmd-release',
+     'cmd-bury', 'cmd-kick', 'cmd-stats', 'cmd-stats-job', 'cmd-stats-tube',
+     'cmd-list-tubes', 'cmd-list-tube-used', 'cmd-list-tubes-watched',
+     'job-timeouts', 'total-jobs', 'max-job-size', 'current-tubes',
+     'current-connections', 'current-producers', 'current-workers',
+     'current-waiting', 'total-connections', 'pid', 'uptime']))
+STATS = '---\n' + STATS + 'version: 1.10\n'
+
+# (name, command, reply)
+REPLIES = [
+    ('inserted', 'put', 'INSERTED 12345\r\n'),
+    ('reserved_100b', 'reserve', 'RESERVED 12345 100\r\n%s\r\n' % ('x' * 100,)),
+    ('reserved_64k', 'reserve',
+     'RESERVED 12345 65000\r\n%s\r\n' % ('x' * 65000,)),
+    ('stats', 'stats', 'OK %s\r\n%s\r\n' % (len(STATS), STATS)),
+]
+
+
+def _feed(command, reply, chunk):
+    line, handler = getattr(protohandler, 'process_%s' % (command,))(
+        *COMMANDS[command])
+    for i in xrange(0, len(reply), chunk):
+        res = handler(reply[i:i + chunk])
+        if res:
+            return res
+    raise AssertionError('handler did not finish')
+
+def run(runner):
+    for name in sorted(COMMANDS):
+        func = getattr(protohandler, 'process_%s' % (name,))
+        args = COMMANDS[name]
+        runner.bench('encode.%s' % (name,), lambda: func(*args))
+
+    for name, command, reply in REPLIES:
+        for chunk in (16, 4096, 65536):
+            runner.bench('parse.%s.chunk%s' % (name, chunk),
+                         lambda: _feed(command, reply, chunk))
+
+    runner.bench('load_yaml.stats', lambda: protohandler.load_yaml(STATS))
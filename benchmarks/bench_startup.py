@@ -0,0 +1,57 @@
+"""
+ServerPool startup time against many local fake servers, each answering
+after a simulated network round trip. "sequential" adds the servers one by
+one, as the constructor used to; "parallel" is the constructor, connecting
+to all of them at once.
+
+With --server there is only the one server, so this measures the connection
+overhead only.
+"""
+
+import time
+
+from beanstalk import multiserverconn
+
+COUNT = 40
+# seconds added before each reply, standing in for a remote network
+RTT = 0.02
+
+
+def _servers(runner, count):
+    if runner.server:
+        return [runner.server]
+    addresses = runner.servers(count)
+    for fake in runner._fakes[-count:]:
+        fake.latency = RTT
+    return addresses
+
+def _time(make_pool, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        pool = make_pool()
+        elapsed = time.time() - start
+        pool.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(runner):
+    count = 10 if runner.quick else COUNT
+    repeat = 1 if runner.quick else 3
+    serverlist = [(host, port, False)
+                  for host, port in _servers(runner, count)]
+
+    def sequential():
+        pool = multiserverconn.ServerPool([])
+        for ip, port, job in serverlist:
+            pool.add_server(ip, port, job)
+        return pool
+
+    def parallel():
+        return multiserverconn.ServerPool(serverlist, connect_timeout=10)
+
+    for name, make_pool in (('sequential', sequential),
+                            ('parallel', parallel)):
+        seconds = _time(make_pool, repeat)
+        runner.record('startup.%s.x%d' % (name, len(serverlist)), seconds,
+                      len(serverlist))
@@ -0,0 +1,202 @@
+"""
+End-to-end throughput: put, then reserve and delete, a batch of jobs through
+each client type.
+"""
+
+import threading
+import time
+
+from beanstalk import eventconn
+from beanstalk import serverconn
+from beanstalk import multiserverconn
+from beanstalk import multiplexconn
+from beanstalk import producer
+from beanstalk import protohandler
+
+PAYLOAD = 'x' * 100
+
+
+def _put_reserve_delete(runner, name, conn, count):
+    start = time.time()
+    for i in xrange(count):
+        conn.put(PAYLOAD)
+    runner.record('%s.put' % (name,), time.time() - start, count)
+
+    start = time.time()
+    for i in xrange(count):
+        job = conn.reserve()
+        conn.delete(job['jid'])
+    runner.record('%s.reserve_delete' % (name,), time.time() - start, count)
+
+def bench_serverconn(runner):
+    conn = serverconn.ServerConn(*runner.servers()[0])
+    try:
+        _put_reserve_delete(runner, 'ServerConn', conn,
+                            200 if runner.quick else 5000)
+    finally:
+        conn.close()
+
+def bench_batches(runner):
+    count = 200 if runner.quick else 5000
+    conn = serverconn.ServerConn(*runner.servers()[0])
+    try:
+        conn.pipeline([protohandler.process_put(PAYLOAD)
+                       for i in xrange(count)])
+        start = time.time()
+        done = 0
+        while done < count:
+            jobs = conn.reserve_batch(256)
+            conn.ack_batch(jobs)
+            done += len(jobs)
+        runner.record('ServerConn.reserve_batch_ack_batch',
+                      time.time() - start, count)
+    finally:
+        conn.close()
+
+def bench_serverpool(runner):
+    pool = multiserverconn.ServerPool([addr + (False,)
+                                       for addr in runner.servers(2)])
+    count = 5 if runner.quick else 20
+    try:
+        start = time.time()
+        for i in xrange(count):
+            pool.put(PAYLOAD)
+        runner.record('ServerPool.put', time.time() - start, count)
+
+        start = time.time()
+        done = 0
+        while done < count:
+            for res in pool.reserve_with_timeout(0):
+                if res['state'] != 'ok':
+                    continue
+                for server in pool.servers:
+                    if server.result is res:
+                        server.delete(res['jid'])
+                done += 1
+        runner.record('ServerPool.reserve_delete', time.time() - start, count)
+    finally:
+        pool.close()
+
+def bench_producer(runner):
+    count = 200 if runner.quick else 5000
+    conn = serverconn.ServerConn(*runner.servers()[0])
+    background = producer.BackgroundProducer(conn, flush_on_exit=False)
+    try:
+        start = time.time()
+        futures = [background.submit(PAYLOAD) for i in xrange(count)]
+        runner.record('BackgroundProducer.submit', time.time() - start, count)
+        background.flush()
+        runner.record('BackgroundProducer.put', time.time() - start, count)
+        for future in futures:
+            future.result()
+    finally:
+        background.close()
+        conn.close()
+
+def bench_multiplexed(runner):
+    threads = 16
+    count = (10 if runner.quick else 300) * threads
+    address = runner.servers()[0]
+
+    def put(conn, n):
+        for i in xrange(n):
+            conn.put(PAYLOAD)
+
+    for name, shared in (('ServerConn per thread', False),
+                         ('MultiplexedConn', True)):
+        if shared:
+            conns = [multiplexconn.MultiplexedConn(*address)] * threads
+        else:
+            conns = [serverconn.ServerConn(*address) for i in xrange(threads)]
+        workers = [threading.Thread(target=put,
+                                    args=(conn, count // threads))
+                   for conn in conns]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        runner.record('%s.put x%d threads' % (name, threads),
+                      time.time() - start, count)
+        for conn in set(conns):
+            conn.close()
+
+def bench_eventconn(runner):
+    count = 200 if runner.quick else 5000
+    host, port = runner.servers()[0]
+    loop = eventconn.EventLoop()
+    jobs = []
+    def failed(eclass, e, tb):
+        raise e
+    conn = eventconn.EventConn(host, port, loop=loop,
+                               result_callback=jobs.append,
+                               error_callback=failed)
+    try:
+        # like the twisted benchmark: pipelined puts, then reserve + delete
+        start = time.time()
+        for i in xrange(count):
+            conn.put(PAYLOAD)
+        loop.run()
+        runner.record('EventConn.put', time.time() - start, count)
+
+        def reserved(job):
+            conn.delete(job['jid'], result_callback=deleted)
+        def deleted(res):
+            jobs.append(res)
+            if len(jobs) < count:
+                conn.reserve(result_callback=reserved)
+        del jobs[:]
+        start = time.time()
+        conn.reserve(result_callback=reserved)
+        loop.run()
+        runner.record('EventConn.reserve_delete', time.time() - start, count)
+    finally:
+        loop.close()
+
+def bench_twisted(runner):
+    try:
+        from twisted.internet import reactor, protocol, defer
+        from beanstalk.twisted_client import Beanstalk
+    except ImportError:
+        print >>runner.out, 'Twisted is not installed, skipping'
+        return
+
+    count = 200 if runner.quick else 5000
+    host, port = runner.servers()[0]
+    failures = []
+
+    @defer.inlineCallbacks
+    def go(conn):
+        # all puts are pipelined, then every reserve is followed by a delete
+        start = time.time()
+        yield defer.gatherResults([conn.put(PAYLOAD) for i in xrange(count)])
+        runner.record('twisted.put', time.time() - start, count)
+
+        start = time.time()
+        for i in xrange(count):
+            job = yield conn.reserve()
+            yield conn.delete(job['jid'])
+        runner.record('twisted.reserve_delete', time.time() - start, count)
+        conn.transport.loseConnection()
+
+    def done(result):
+        if result is not None:
+            failures.append(result)
+        reactor.stop()
+
+    creator = protocol.ClientCreator(reactor, Beanstalk)
+    d = creator.connectTCP(host, port).addCallback(go)
+    d.addBoth(done)
+    reactor.run()
+    if failures:
+        failures[0].raiseException()
+
+def run(runner):
+    bench_serverconn(runner)
+    bench_batches(runner)
+    bench_serverpool(runner)
+    bench_producer(runner)
+    bench_multiplexed(runner)
+    bench_eventconn(runner)
+    # the reactor can only run once, keep this last
+    bench_twisted(runner)
@@ -0,0 +1,62 @@
+"""
+Per-command latency over each transport: TCP with each socket options
+profile, and a unix domain socket. Both a strict request/reply command and a
+pipelined batch of puts are timed, the latter being where TCP_NODELAY
+matters.
+"""
+
+import os
+import shutil
+import tempfile
+
+from beanstalk import eventconn
+from beanstalk import serverconn
+from beanstalk import transport
+
+BATCH = 50
+
+
+def _transports(runner):
+    '''(name, server, port, socket options) for every transport to time'''
+    host, port = runner.servers()[0]
+    for profile in sorted(transport.PROFILES):
+        yield 'tcp.%s' % (profile,), host, port, profile
+    if runner.server:
+        print >>runner.out, 'a server was given, skipping unix sockets'
+        return
+    from beanstalk.testing import FakeServer
+    directory = tempfile.mkdtemp()
+    fake = FakeServer(os.path.join(directory, 'beanstalkd.sock')).start()
+    try:
+        yield 'unix', transport.UNIX_PREFIX + fake.address, None, None
+    finally:
+        fake.stop()
+        shutil.rmtree(directory)
+
+def _pipelined_puts(server, port, options):
+    loop = eventconn.EventLoop()
+    def failed(eclass, e, tb):
+        raise e
+    conn = eventconn.EventConn(server, port, loop=loop,
+                               result_callback=lambda res: None,
+                               error_callback=failed, socket_options=options)
+    def batch():
+        for i in xrange(BATCH):
+            conn.put('x' * 100)
+        loop.run()
+    return loop, batch
+
+def run(runner):
+    for name, server, port, options in _transports(runner):
+        conn = serverconn.ServerConn(server, port, socket_options=options)
+        try:
+            runner.bench('transport.%s.list_tube_used' % (name,),
+                         conn.list_tube_used)
+        finally:
+            conn.close()
+
+        loop, batch = _pipelined_puts(server, port, options)
+        try:
+            runner.bench('transport.%s.put_x%d' % (name, BATCH), batch)
+        finally:
+            loop.close()
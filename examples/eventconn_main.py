@@ -1,5 +1,5 @@
-''' libevent_main.py
-A simple example for using the LibeventConn connection type. This just pulls
+''' eventconn_main.py
+A simple example for using the EventConn connection type. This just pulls
 jobs and deletes them, but shows how to set up callbacks and whatnot. A few
 varibales for your tweaking pleasure are:
 SERVER and PORT -- set these to your beanstalkd
@@ -10,7 +10,6 @@ FIX_ERROR -- If an error is encounterd handle it well and fix it. Otherwise,
 '''
 
 import beanstalk
-import event
 
 SERVER = '127.0.0.1'
 PORT = 11300
@@ -27,7 +26,7 @@ def got_response(response, conn):
     if 'jid' in response:
         if response['data'] == 'stop':
             print 'finishing'
-            event.abort()
+            conn.loop.stop()
             return
         print 'got a response!', response
         MRJ = response
@@ -45,7 +44,7 @@ def got_error(eclass, e, tb):
             result_callback_args = (CONN,))
         return
     print 'aborting now'
-    event.abort()
+    CONN.loop.stop()
 
 def start(conn):
     print 'start called'
@@ -55,7 +54,7 @@ def start(conn):
 def main():
     global CONN
     # setup the connection
-    myconn = beanstalk.serverconn.LibeventConn(SERVER, PORT)
+    myconn = beanstalk.serverconn.EventConn(SERVER, PORT)
     #setup callbacks
     myconn.result_callback_args = (myconn,)
     myconn.result_callback = got_response
@@ -65,8 +64,7 @@ def main():
     start(myconn)
     CONN = myconn
     print 'dispatching'
-    event.dispatch()
+    myconn.loop.run()
 
 if __name__ == '__main__':
-    event.init()
     main()
@@ -5,34 +5,25 @@ import sys
 sys.path.append("..")
 sys.path.append(os.path.join(sys.path[0], '..'))
 
-from twisted.internet import reactor, protocol, defer, task
+from twisted.internet import reactor
 
 import beanstalk
+from beanstalk.twisted_client import BeanstalkPool, ConsumerService
 
 def executor(bs, jobdata):
     print "Running job %s" % `jobdata`
-    bs.touch(jobdata['jid'])
-    bs.delete(jobdata['jid'])
+    # returning the deferred makes the consumer wait for the touch before
+    # it deletes the job
+    return bs.touch(jobdata['jid'])
 
-def error_handler(e):
-    print "Got an error", e
+# four connections, each running one reserve -> execute -> delete loop
+pool = BeanstalkPool([(sys.argv[1], 11300)], size=4, watch=["myqueue"])
+consumer = ConsumerService(pool, executor, concurrency=4)
 
-def executionGenerator(bs):
-    while True:
-        print "Waiting for a job..."
-        yield bs.reserve().addCallback(lambda v: executor(bs, v)).addErrback(
-            error_handler)
+def worker(pool):
+    consumer.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', consumer.stopService)
 
-def worker(bs):
-    bs.watch("myqueue")
-    bs.ignore("default")
-
-    coop = task.Cooperator()
-    coop.coiterate(executionGenerator(bs))
-
-d=protocol.ClientCreator(reactor,
-    beanstalk.twisted_client.Beanstalk).connectTCP(sys.argv[1], 11300)
-d.addCallback(worker)
+pool.start().whenConnected().addCallback(worker)
 
 reactor.run()
-
@@ -47,7 +47,8 @@ setup(name='pybeanstalk',
         'Topic :: System'],
       packages=['beanstalk'],
       install_requires=["pyaml"],
-      extras_require={'twisted': ["zope.interface", "Twisted>=15.2.1"]},
+      extras_require={'twisted': ["zope.interface", "Twisted>=15.2.1"],
+                      'futures': ["futures"]},
       tests_require=["nose", "tox"],
       include_package_data=True,
       zip_safe=False
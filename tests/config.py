@@ -20,3 +20,8 @@ def get_config(section_name, configfile="tests.cfg"):
     else:
         raise Exception("cannot find the test config file")
     return ConfigWrapper(configfile, section_name)
+
+def use_fake_server(config):
+    """true when the configured beanstalkd binary isn't installed, in which
+    case the tests run against beanstalk.testing.FakeServer instead"""
+    return not os.path.isfile(os.path.join(config.BPATH, config.BEANSTALKD))
@@ -0,0 +1,195 @@
+"""
+Ack batching tests, against the in-process fake server.
+"""
+
+import shutil
+import tempfile
+import time
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import backoff
+from beanstalk import claimcheck
+from beanstalk import errors
+from beanstalk import serverconn
+from beanstalk.job import Job
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+def _put(count):
+    conn = serverconn.ServerConn(*server.address)
+    jids = [conn.put('job %d' % i)['jid'] for i in range(count)]
+    conn.close()
+    return jids
+
+def _stats():
+    conn = serverconn.ServerConn(*server.address)
+    try:
+        return conn.stats()['data']
+    finally:
+        conn.close()
+
+def _deletes(conn):
+    return conn.metrics().get('delete', {}).get('count', 0)
+
+
+@with_setup(_setup, _teardown)
+def test_finish_is_deferred():
+    jids = _put(3)
+    conn = serverconn.ServerConn(*server.address, job=Job)
+    conn.enable_metrics()
+    conn.enable_ack_batching(linger=60000)
+    job = conn.reserve()
+    assert job.Finish()
+    assert _deletes(conn) == 0 and conn.acks.pending == 1
+    assert _stats()['current-jobs-reserved'] == 1
+
+    # sent with the next reserve
+    job = conn.reserve()
+    assert job.jid == jids[1]
+    assert _deletes(conn) == 1 and conn.acks.pending == 0
+    assert _stats()['cmd-delete'] == 1
+
+    # and before any other command
+    job.Finish()
+    assert conn.stats_tube('default')['data']['current-jobs-reserved'] == 0
+    assert conn.acks.sent == 2
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_max_acks_and_linger():
+    _put(5)
+    conn = serverconn.ServerConn(*server.address, job=Job)
+    conn.enable_metrics()
+    acks = conn.enable_ack_batching(max_acks=3, linger=100)
+    jobs = conn.reserve_batch(5)
+    for job in jobs[:3]:
+        job.Finish()
+    assert _deletes(conn) == 3 and acks.pending == 0
+
+    jobs[3].Finish()
+    acks.poll()
+    assert acks.pending == 1
+    time.sleep(0.15)
+    acks.poll()
+    assert acks.pending == 0 and _deletes(conn) == 4
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_failed_deletes():
+    jids = _put(1)
+    conn = serverconn.ServerConn(*server.address, job=Job)
+    failed = []
+    acks = conn.enable_ack_batching(
+        linger=60000, on_error=lambda jid, e: failed.append((jid, e)))
+    job = conn.reserve()
+    job.Finish()
+    acks.add(12345)
+    assert conn.reserve_with_timeout(0)['state'] == 'timeout'
+    assert [jid for jid, e in failed] == [12345]
+    assert isinstance(failed[0][1], errors.NotFound)
+    assert acks.sent == 2 and acks.failed == 1
+    assert _stats()['current-jobs-ready'] == 0
+    # a failed delete is reported once, not retried
+    acks.add(jids[0])
+    acks.flush()
+    assert [jid for jid, e in failed] == [12345, jids[0]]
+    assert acks.failed == 2
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_close_flushes():
+    _put(2)
+    conn = serverconn.ServerConn(*server.address, job=Job)
+    conn.enable_ack_batching(linger=60000)
+    for job in conn.reserve_batch(2):
+        job.Finish()
+    conn.close()
+    stats = _stats()
+    assert stats['cmd-delete'] == 2 and stats['current-jobs-ready'] == 0
+
+    conn = serverconn.ServerConn(*server.address, job=Job)
+    conn.enable_ack_batching(linger=60000)
+    jid = _put(1)[0]
+    conn.reserve().Finish()
+    conn.disable_ack_batching()
+    assert conn.acks is None
+    try:
+        conn.stats_job(jid)
+    except errors.NotFound:
+        pass
+    else:
+        assert False, 'the job was not deleted'
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_claim_check_blob_outlives_a_failed_delete():
+    directory = tempfile.mkdtemp()
+    try:
+        class Job(claimcheck.ClaimCheckJob):
+            __slots__ = ()
+            blobstore = claimcheck.LocalBlobStore(directory)
+
+        conn = serverconn.ServerConn(*server.address, job=Job)
+        acks = conn.enable_ack_batching(linger=60000, on_error=lambda *a: 0)
+        ref = claimcheck.offload('b' * 10, Job.blobstore, threshold=5)
+        key = claimcheck.reference_key(ref)
+        conn.put(ref)
+        job = conn.reserve()
+        job.Finish()
+        # not deleted yet, neither is the blob
+        assert Job.blobstore.get(key) == 'b' * 10
+        acks.flush()
+        assert_raises(KeyError, Job.blobstore.get, key)
+
+        # a delete that fails keeps the blob the job still refers to
+        ref = claimcheck.offload('c' * 10, Job.blobstore, threshold=5)
+        key = claimcheck.reference_key(ref)
+        lost = Job(conn=conn, jid=12345, data=ref)
+        lost.Finish()
+        acks.flush()
+        assert acks.failed == 1
+        assert Job.blobstore.get(key) == 'c' * 10
+        conn.close()
+    finally:
+        shutil.rmtree(directory)
+
+@with_setup(_setup, _teardown)
+def test_reserve_with_deletes_is_replayed():
+    jids = _put(1)
+    failed = []
+    conn = serverconn.ServerConn(*server.address, job=Job,
+                                 reconnect=backoff.Backoff(initial=0.01,
+                                                           retries=3))
+    conn.enable_ack_batching(linger=60000,
+                             on_error=lambda jid, e: failed.append(e))
+    conn.reserve().Finish()
+    server.drop_connections()
+    # the delete is lost with the connection, so the job is back
+    job = conn.reserve_with_timeout(1)
+    assert job.jid == jids[0]
+    assert len(failed) == 1
+    assert isinstance(failed[0], errors.ConnectionLost)
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_reserve_with_deletes_keeps_its_timeout():
+    _put(1)
+    conn = serverconn.ServerConn(*server.address, job=Job)
+    conn.enable_ack_batching(linger=60000, on_error=lambda *a: 0)
+    conn.reserve().Finish()
+    start = time.time()
+    # no job comes, and the reserve that carries the delete gives up
+    assert_raises(errors.CommandTimeout, conn.reserve, timeout=0.3)
+    assert time.time() - start < 2
+    assert _stats()['cmd-delete'] == 1
+    conn.close()
@@ -0,0 +1,147 @@
+"""
+Micro-batching tests, against a recording dummy connection.
+"""
+
+import sys
+import time
+sys.path.append('..')
+
+from nose.tools import assert_raises
+
+from beanstalk import batching
+from beanstalk import errors
+from beanstalk import serverconn
+from beanstalk.testing import FakeServer
+
+
+class DummyConn(object):
+    def __init__(self):
+        self.calls = []
+        self.tube = 'default'
+
+    def use(self, tube):
+        self.calls.append(('use', tube))
+        self.tube = tube
+        return {'state': 'ok', 'tube': tube}
+
+    def put(self, data, pri=1, delay=0, ttr=60):
+        self.calls.append(('put', self.tube, data, pri, ttr))
+        return {'state': 'ok', 'jid': len(self.calls)}
+
+    def delete(self, jid):
+        self.calls.append(('delete', jid))
+        return {'state': 'ok'}
+
+    def stats_job(self, jid):
+        return {'state': 'ok', 'data': {'tube': 'events', 'pri': 5,
+                                        'ttr': 30}}
+
+    def puts(self):
+        return [c for c in self.calls if c[0] == 'put']
+
+
+def test_envelope_roundtrip():
+    messages = ['a', '', 'b' * 1000, '\r\n']
+    body = batching.pack(messages)
+    assert batching.is_batch(body)
+    assert batching.unpack(body) == messages
+    assert batching.unpack(batching.pack([])) == []
+
+def test_truncated_envelope():
+    body = batching.pack(['abc', 'def'])
+    assert_raises(errors.JobError, batching.unpack, body[:-1])
+    assert_raises(errors.JobError, batching.unpack, 'not a batch')
+
+def test_producer_closes_on_count():
+    conn = DummyConn()
+    producer = batching.BatchProducer(conn, max_messages=3, linger=10000)
+    for i in range(7):
+        producer.add(str(i), tube='events')
+    puts = conn.puts()
+    assert len(puts) == 2
+    assert batching.unpack(puts[0][2]) == ['0', '1', '2']
+    assert producer.pending == 1
+    producer.close()
+    assert batching.unpack(conn.puts()[-1][2]) == ['6']
+    # only one use for the tube
+    assert conn.calls.count(('use', 'events')) == 1
+
+def test_producer_closes_on_size():
+    conn = DummyConn()
+    producer = batching.BatchProducer(conn, max_messages=100, max_bytes=35,
+                                      linger=10000)
+    producer.add('x' * 10)
+    producer.add('y' * 10)
+    assert conn.puts() == []
+    producer.add('z' * 10)
+    assert len(conn.puts()) == 1
+    assert len(conn.puts()[0][2]) <= 35
+
+def test_producer_refuses_oversized_messages():
+    conn = DummyConn()
+    producer = batching.BatchProducer(conn, max_messages=100, max_bytes=35,
+                                      linger=10000)
+    producer.add('x' * 10)
+    # 4 magic + 4 length + 27 fits exactly, 28 never would
+    assert_raises(errors.JobTooBig, producer.add, 'y' * 28)
+    assert producer.pending == 1 and conn.puts() == []
+    producer.add('y' * 27)
+    assert len(conn.puts()) == 1
+    assert producer.pending == 1
+    producer.close()
+    assert [len(p[2]) for p in conn.puts()] == [18, 35]
+
+def test_producer_linger_and_tubes():
+    conn = DummyConn()
+    producer = batching.BatchProducer(conn, max_messages=100, linger=1)
+    producer.add('a', tube='one')
+    producer.add('b', tube='two')
+    time.sleep(0.01)
+    producer.poll()
+    tubes = sorted(p[1] for p in conn.puts())
+    assert tubes == ['one', 'two']
+    assert producer.pending == 0
+
+def test_failed_flush_keeps_the_batch():
+    server = FakeServer(put_error='DRAINING').start()
+    try:
+        conn = serverconn.ServerConn(*server.address)
+        producer = batching.BatchProducer(conn, max_messages=3, linger=10000)
+        producer.add('a', tube='events')
+        producer.add('b', tube='events')
+        assert_raises(errors.Draining, producer.add, 'c', tube='events')
+        assert producer.pending == 3
+
+        server.put_error = None
+        producer.flush()
+        assert producer.pending == 0
+        conn.watch('events')
+        job = conn.reserve_with_timeout(0)
+        assert batching.unpack(job['data']) == ['a', 'b', 'c']
+        conn.close()
+    finally:
+        server.stop()
+
+def test_batch_job_requeues_failures():
+    conn = DummyConn()
+    body = batching.pack(['m0', 'm1', 'm2'])
+    job = batching.BatchJob(conn=conn, jid=42, data=body)
+    assert list(job) == ['m0', 'm1', 'm2']
+    job.fail(1)
+    assert_raises(IndexError, job.fail, 3)
+    assert job.Finish()
+
+    put = conn.puts()[0]
+    assert put[1] == 'events'
+    assert batching.unpack(put[2]) == ['m1']
+    assert put[3:] == (5, 30)
+    assert conn.calls[-1] == ('delete', 42)
+    # used tube is restored
+    assert conn.tube == 'default'
+
+def test_batch_job_plain_body():
+    conn = DummyConn()
+    job = batching.BatchJob(conn=conn, jid=1, data='plain')
+    assert list(job) == ['plain']
+    assert job.Finish()
+    assert conn.puts() == []
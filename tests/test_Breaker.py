@@ -0,0 +1,152 @@
+"""
+Circuit breaker tests, and ServerPool health handling against in-process
+fake servers.
+"""
+
+import time
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import backoff
+from beanstalk import breaker
+from beanstalk import errors
+from beanstalk import multiserverconn
+from beanstalk import serverconn
+from beanstalk import transport
+from beanstalk.testing import FakeServer
+
+servers = []
+quick = backoff.Backoff(initial=0.05, maximum=0.1, jitter=0, retries=None)
+
+
+def _setup():
+    servers[:] = [FakeServer().start(), FakeServer().start()]
+
+def _teardown():
+    for server in servers:
+        server.stop()
+
+def _pool(**breaker_options):
+    breaker_options.setdefault('backoff', quick)
+    return multiserverconn.ServerPool([s.address + (False,) for s in servers],
+                                      breaker=breaker_options)
+
+def _name(server):
+    return transport.format_address(*server.address)
+
+
+def test_error_rate():
+    b = breaker.CircuitBreaker(window=4, min_calls=4, error_rate=0.5,
+                               backoff=quick)
+    for error in (True, False, False):
+        b.record(0.001, error)
+    assert b.state == breaker.CLOSED and b.allow()
+    b.record(0.001, True)
+    assert b.state == breaker.OPEN and not b.allow()
+    assert b.snapshot()['trips'] == 1
+    assert not b.due(time.time())
+    assert b.due(time.time() + 0.05)
+
+def test_slow_calls():
+    b = breaker.CircuitBreaker(min_calls=2, slow_call=0.1)
+    b.record(0.2)
+    b.record(0.01)
+    assert b.state == breaker.OPEN
+
+def test_probes():
+    b = breaker.CircuitBreaker(backoff=quick)
+    b.trip()
+    b.probed(False)
+    # the second failed probe in a row waits for longer
+    assert b.retry_at - time.time() > 0.09
+    b.probed(True)
+    assert b.state == breaker.HALF_OPEN and b.allow()
+    b.record(0.001, error=True)
+    assert b.state == breaker.OPEN
+
+    b.probed(True)
+    b.record(0.001)
+    assert b.state == breaker.CLOSED
+    assert b.snapshot()['calls'] == 0
+
+@with_setup(_setup, _teardown)
+def test_lost_server_is_ejected_and_readmitted():
+    pool = _pool()
+    pool.use('tube')
+    down = servers[1]
+    port = down.address[1]
+    down.stop()
+
+    assert pool.stats()['data']['current-connections'] == 1
+    health = pool.health()
+    assert health[_name(servers[1])]['state'] == breaker.OPEN
+    assert not health[_name(servers[1])]['connected']
+    assert health[_name(servers[0])]['state'] == breaker.CLOSED
+    # puts only go to the live server now
+    for i in range(3):
+        pool.put('job')
+    conn = serverconn.ServerConn(*servers[0].address)
+    assert conn.stats_tube('tube')['data']['current-jobs-ready'] == 3
+    conn.close()
+
+    servers[1] = FakeServer(('127.0.0.1', port)).start()
+    time.sleep(multiserverconn.PROBE_INTERVAL + 0.3)
+    pool.stats()
+    health = pool.health()
+    assert health[_name(servers[1])]['state'] == breaker.CLOSED
+    assert health[_name(servers[1])]['connected']
+    # the pool's tube was restored on the readmitted server
+    used = [r['tube'] for r in pool.list_tube_used().values()]
+    assert used == ['tube', 'tube']
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_slow_server_gets_no_commands():
+    servers[1].latency = {'stats': 0.2}
+    pool = _pool(slow_call=0.1, min_calls=2)
+    pool.enable_metrics()
+    # with the stats sent when connecting, that makes two slow calls
+    pool.stats()
+    slow = [s for s in pool.servers if s.port == servers[1].address[1]][0]
+    assert pool.health()[_name(servers[1])]['state'] == breaker.OPEN
+    assert pool.health()[_name(servers[1])]['connected']
+
+    pool.stats()
+    pool.stats()
+    assert slow.metrics()['stats']['count'] == 1
+    assert pool.metrics()['stats']['count'] == 4
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_no_server_left():
+    pool = _pool()
+    for server in servers:
+        server.stop()
+    assert_raises(errors.NotConnected, pool.put, 'job')
+    assert_raises(errors.NotConnected, pool.put, 'job')
+    assert all(not h['connected'] for h in pool.health().values())
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_no_server_left_waits_for_the_breakers():
+    pool = _pool(backoff=backoff.Backoff(initial=0.5, maximum=1.0, jitter=0,
+                                         retries=None))
+    for server in servers:
+        server.stop()
+    assert_raises(errors.NotConnected, pool.put, 'job')
+    assert_raises(errors.NotConnected, pool.put, 'job')
+    connects = []
+    for server in pool._ejected:
+        server.connect = lambda: connects.append(1)
+    # not due yet, so not reconnected to on every call
+    for i in range(5):
+        assert_raises(errors.NotConnected, pool.put, 'job')
+    assert not connects
+
+    lost = pool._ejected[0]
+    del lost.connect
+    lost.breaker.retry_at = time.time()
+    assert_raises(errors.NotConnected, pool.put, 'job')
+    # a failed reconnect is a failed probe: the next one waits longer
+    assert lost.breaker.retry_at - time.time() > 0.75
+    pool.close()
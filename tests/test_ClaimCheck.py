@@ -0,0 +1,103 @@
+"""
+Claim-check tests. They only need a scratch directory, no server.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+sys.path.append('..')
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import claimcheck
+from beanstalk import errors
+from beanstalk import protohandler
+
+tmpdir = None
+store = None
+
+
+class DummyConn(object):
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, jid):
+        self.deleted.append(jid)
+        return {'state': 'ok'}
+
+
+def _setup():
+    global tmpdir, store
+    tmpdir = tempfile.mkdtemp()
+    store = claimcheck.LocalBlobStore(tmpdir)
+
+def _teardown():
+    shutil.rmtree(tmpdir)
+
+def _blobs():
+    objects = os.path.join(tmpdir, 'objects')
+    return [f for f in os.listdir(objects) if not f.startswith('.')]
+
+
+@with_setup(_setup, _teardown)
+def test_store_roundtrip():
+    key = store.put('x' * 100000)
+    assert store.get(key) == 'x' * 100000
+    blob = store.open(key)
+    assert blob[:3] == 'xxx'
+    blob.close()
+    store.delete(key)
+    assert_raises(KeyError, store.get, key)
+    assert _blobs() == []
+
+@with_setup(_setup, _teardown)
+def test_store_shares_identical_payloads():
+    k1 = store.put('same')
+    k2 = store.put('same')
+    assert k1 != k2
+    assert len(_blobs()) == 1
+    store.delete(k1)
+    assert store.get(k2) == 'same'
+    store.delete(k2)
+    assert _blobs() == []
+
+@with_setup(_setup, _teardown)
+def test_store_empty_blob():
+    key = store.put('')
+    assert store.get(key) == ''
+
+@with_setup(_setup, _teardown)
+def test_offload_only_big_payloads():
+    assert claimcheck.offload('small', store) == 'small'
+    big = 'a' * protohandler.MAX_JOB_SIZE
+    ref = claimcheck.offload(big, store)
+    assert len(ref) < 100
+    assert claimcheck.reference_key(ref) is not None
+    # the reference itself can be put
+    protohandler.process_put(ref)
+
+@with_setup(_setup, _teardown)
+def test_job_resolves_and_collects_blob():
+    class Job(claimcheck.ClaimCheckJob):
+        __slots__ = ()
+        blobstore = store
+
+    conn = DummyConn()
+    ref = claimcheck.offload('b' * 10, store, threshold=5)
+    job = Job(conn=conn, jid=7, data=ref)
+    assert job.body == ref
+    assert job.data == 'b' * 10
+    assert job.Finish()
+    assert conn.deleted == [7]
+    assert _blobs() == []
+
+    plain = Job(conn=conn, jid=8, data='plain')
+    assert plain.data == 'plain'
+    assert plain.Finish()
+
+@with_setup(_setup, _teardown)
+def test_job_without_store():
+    ref = claimcheck.offload('b' * 10, store, threshold=5)
+    job = claimcheck.ClaimCheckJob(conn=DummyConn(), jid=7, data=ref)
+    assert_raises(errors.JobError, getattr, job, 'data')
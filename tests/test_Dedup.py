@@ -0,0 +1,102 @@
+"""
+Deduplication cache tests, against the in-process fake server.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import with_setup
+
+from beanstalk import dedup
+from beanstalk import serverconn
+from beanstalk.testing import FakeServer
+
+server = None
+directory = None
+
+
+def _setup():
+    global server, directory
+    server = FakeServer().start()
+    directory = tempfile.mkdtemp()
+
+def _teardown():
+    server.stop()
+    shutil.rmtree(directory)
+
+
+def test_job_key():
+    assert dedup.job_key('a', 'data') == dedup.job_key('a', 'data')
+    assert dedup.job_key('a', 'data') != dedup.job_key('b', 'data')
+    assert dedup.job_key('a', 'data', 'key') == dedup.job_key('a', 'other',
+                                                              'key')
+    assert dedup.job_key('a', 'key') != dedup.job_key('a', None, 'key')
+
+def test_lru_and_ttl():
+    cache = dedup.DedupCache(max_entries=2, ttl=0.1)
+    for i in range(3):
+        cache.add('key%d' % i, i)
+    assert cache.get('key0') is None
+    assert cache.get('key1') == 1
+    cache.add('key3', 3)
+    # key1 was used last, key2 goes
+    assert cache.get('key2') is None
+    assert cache.get('key1') == 1
+    time.sleep(0.15)
+    assert cache.get('key1') is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 3
+    assert stats['hit-rate'] == 0.4
+    assert stats['evictions'] == 2 and stats['expirations'] == 1
+    assert stats['entries'] == 1 and stats['bytes'] > 0
+
+@with_setup(_setup, _teardown)
+def test_shared_table():
+    path = os.path.join(directory, 'dedup')
+    one = dedup.SharedTable(path, slots=16)
+    other = dedup.SharedTable(path, slots=1024)
+    assert other.slots == 16
+    key = dedup.job_key('tube', 'data')
+    one.set(key, 42, time.time() + 60)
+    assert other.get(key) == 42
+    other.set(dedup.job_key('tube', 'gone'), 43, time.time() - 1)
+    assert other.get(dedup.job_key('tube', 'gone')) is None
+    assert one.entries() == 1
+
+    # full: the entry expiring first is replaced
+    for i in range(20):
+        one.set(dedup.job_key('tube', str(i)), i, time.time() + 100 + i)
+    assert one.entries() == 16
+    assert one.get(dedup.job_key('tube', '19')) == 19
+    one.close()
+    other.close()
+
+@with_setup(_setup, _teardown)
+def test_dedup_producer():
+    conn = serverconn.ServerConn(*server.address)
+    producer = dedup.DedupProducer(conn)
+    jid = producer.put('payload', tube='orders', key='request-1')
+    assert producer.put('payload', tube='orders', key='request-1') == jid
+    assert producer.put('payload', tube='orders') != jid
+    assert producer.put('payload', tube='other', key='request-1') != jid
+    assert conn.stats_tube('orders')['data']['current-jobs-ready'] == 2
+    assert producer.cache.stats()['hits'] == 1
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_dedup_between_processes():
+    path = os.path.join(directory, 'dedup')
+    conns = [serverconn.ServerConn(*server.address) for i in range(2)]
+    producers = [dedup.DedupProducer(conn, dedup.DedupCache(
+                     shared=dedup.SharedTable(path))) for conn in conns]
+    jid = producers[0].put('payload')
+    assert producers[1].put('payload') == jid
+    stats = producers[1].cache.stats()
+    assert stats['shared-hits'] == 1 and stats['shared-entries'] == 1
+    assert conns[0].stats_tube('default')['data']['current-jobs-ready'] == 1
+    for producer in producers:
+        producer.cache.shared.close()
+        producer.conn.close()
@@ -0,0 +1,118 @@
+"""
+EventConn tests, using the in-process fake server.
+"""
+
+import socket
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import errors
+from beanstalk import eventconn
+from beanstalk.job import Job
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+
+class Recorder(object):
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+    def result(self, res, *args):
+        self.results.append((res,) + args)
+
+    def error(self, eclass, e, tb):
+        self.errors.append(eclass)
+
+def _conn(loop, recorder, **kw):
+    return eventconn.EventConn(server.address[0], server.address[1],
+                               loop=loop, result_callback=recorder.result,
+                               error_callback=recorder.error, **kw)
+
+@with_setup(_setup, _teardown)
+def test_pipelined_callbacks():
+    loop = eventconn.EventLoop()
+    r = Recorder()
+    conn = _conn(loop, r)
+    conn.put('hello')
+    conn.reserve()
+    conn.delete(99)
+    conn.stats_tube('default', result_callback=r.result,
+                    result_callback_args=('tube',))
+    assert conn.pending() == 4
+    loop.run(timeout=5)
+    assert not loop.busy()
+    assert [res[0]['state'] for res in r.results] == ['ok', 'ok', 'ok']
+    assert r.results[1][0]['data'] == 'hello'
+    assert r.results[2][1] == 'tube'
+    assert r.errors == [errors.NotFound]
+    loop.close()
+
+@with_setup(_setup, _teardown)
+def test_many_connections():
+    loop = eventconn.EventLoop()
+    r = Recorder()
+    conns = [_conn(loop, r) for i in range(50)]
+    for i, conn in enumerate(conns):
+        for j in range(20):
+            conn.put('job %d %d' % (i, j))
+    loop.run(timeout=10)
+    assert len(r.results) == 1000 and not r.errors
+    # jids are handed out in order per connection
+    for conn in conns:
+        conn.reserve_with_timeout(0)
+    loop.run(timeout=10)
+    assert len(r.results) == 1050
+    loop.close()
+
+@with_setup(_setup, _teardown)
+def test_partial_writes():
+    loop = eventconn.EventLoop()
+    r = Recorder()
+    conn = _conn(loop, r, job=Job)
+    conn._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    data = 'x' * 60000
+    for i in range(5):
+        conn.put(data)
+    conn.reserve()
+    loop.run(timeout=10)
+    assert len(r.results) == 6 and not r.errors
+    job = r.results[-1][0]
+    assert isinstance(job, Job) and job.data == data
+    loop.close()
+
+@with_setup(_setup, _teardown)
+def test_lost_connection():
+    loop = eventconn.EventLoop()
+    r = Recorder()
+    conn = _conn(loop, r)
+    conn.stats()
+    loop.run(timeout=5)
+    conn.reserve()
+    conn.reserve()
+    loop.run(timeout=0.2)
+    server.drop_connections()
+    loop.run(timeout=5)
+    assert r.errors == [errors.ProtoError, errors.ProtoError]
+    assert conn.pending() == 0
+    assert_raises(errors.NotConnected, conn.stats)
+
+@with_setup(_setup, _teardown)
+def test_callbacks_missing():
+    loop = eventconn.EventLoop()
+    conn = eventconn.EventConn(server.address[0], server.address[1],
+                               loop=loop)
+    assert_raises(errors.BeanStalkError, conn.stats)
+    conn.stats(result_callback=lambda res: None,
+               error_callback=lambda *exc_info: None)
+    assert conn.pending() == 1
+    loop.close()
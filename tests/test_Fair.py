@@ -0,0 +1,112 @@
+"""
+Weighted fair consumer tests, against the in-process fake server.
+"""
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import backoff
+from beanstalk import errors
+from beanstalk import serverconn
+from beanstalk.fair import FairConsumer
+from beanstalk.testing import FakeServer
+
+server = None
+conn = None
+
+
+def _setup():
+    global server, conn
+    server = FakeServer().start()
+    conn = serverconn.ServerConn(*server.address)
+
+def _teardown():
+    conn.close()
+    server.stop()
+
+def _put(tube, count, pri):
+    producer = serverconn.ServerConn(*server.address)
+    producer.use(tube)
+    for i in range(count):
+        producer.put('%s %d' % (tube, i), pri)
+    producer.close()
+
+def _take(consumer, count):
+    tubes = []
+    for i in range(count):
+        job = consumer.reserve(timeout=0)
+        if job is None:
+            break
+        tubes.append(job['data'].split()[0])
+        conn.delete(job['jid'])
+    return tubes
+
+
+@with_setup(_setup, _teardown)
+def test_weighted_shares():
+    # by priority alone, quiet would wait for all of noisy
+    _put('noisy', 30, 0)
+    _put('quiet', 10, 100)
+    consumer = FairConsumer(conn, [('noisy', 3), ('quiet', 1)])
+    assert _take(consumer, 8) == ['noisy'] * 3 + ['quiet'] + \
+                                 ['noisy'] * 3 + ['quiet']
+    assert consumer.received == {'noisy': 6, 'quiet': 2}
+    assert consumer.stats()['share']['quiet'] == 0.25
+
+@with_setup(_setup, _teardown)
+def test_watch_changes_only_on_turns():
+    _put('a', 4, 0)
+    _put('b', 4, 0)
+    conn.enable_metrics()
+    consumer = FairConsumer(conn, [('a', 2), ('b', 2)])
+    assert _take(consumer, 8) == ['a', 'a', 'b', 'b'] * 2
+    metrics = conn.metrics()
+    # a watch on every turn, and the default tube ignored once
+    assert metrics['watch']['count'] == 4
+    assert metrics['ignore']['count'] == 4
+    # one round trip per job
+    assert consumer.round_trips == 8
+
+@with_setup(_setup, _teardown)
+def test_empty_tubes():
+    _put('b', 2, 0)
+    consumer = FairConsumer(conn, {'a': 1, 'b': 1, 'c': 1})
+    assert _take(consumer, 5) == ['b', 'b']
+    assert consumer.reserve(timeout=0) is None
+    assert sorted(conn.list_tubes_watched()['data']) == ['a', 'b', 'c']
+
+    # fractional weights still take turns
+    _put('c', 1, 0)
+    consumer = FairConsumer(conn, {'a': 0.1, 'c': 0.5})
+    assert _take(consumer, 2) == ['c']
+
+@with_setup(_setup, _teardown)
+def test_wait_any():
+    consumer = FairConsumer(conn, {'a': 1, 'b': 1})
+    assert consumer.reserve(timeout=0) is None
+    _put('b', 1, 0)
+    job = consumer.reserve(timeout=1)
+    assert job['data'] == 'b 0'
+    assert consumer.received == {'a': 0, 'b': 1}
+
+@with_setup(_setup, _teardown)
+def test_lost_connection():
+    _put('a', 2, 0)
+    _put('b', 1, 0)
+    conn = serverconn.ServerConn(*server.address,
+                                 reconnect=backoff.Backoff(initial=0.01,
+                                                           retries=3))
+    consumer = FairConsumer(conn, [('a', 1), ('b', 1)])
+    job = consumer.reserve(timeout=0)
+    assert job['data'] == 'a 0'
+    conn.delete(job['jid'])
+    # after the stats sent on connecting, list-tubes-watched, a watch, an
+    # ignore, a reserve and the delete: lost on the watch of b, with a
+    # still watched
+    server.drop_after = 7
+    assert_raises(errors.ConnectionLost, consumer.reserve, timeout=0)
+    server.drop_after = None
+    # the reconnected one watches a alone again, and b's turn still gets b
+    job = consumer.reserve(timeout=0)
+    assert job['data'] == 'b 0'
+    assert conn.list_tubes_watched()['data'] == ['b']
+    conn.close()
@@ -0,0 +1,137 @@
+"""
+FakeServer tests. The fake server runs in-process, so these need no
+beanstalkd binary. Each test gets a fresh server and connection.
+"""
+
+import os
+import socket
+import tempfile
+import time
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import serverconn
+from beanstalk import errors
+from beanstalk.testing import FakeServer
+
+server = None
+conn = None
+
+
+def _setup():
+    global server, conn
+    server = FakeServer().start()
+    conn = serverconn.ServerConn(*server.address)
+
+def _teardown():
+    try:
+        conn.close()
+    except socket.error:
+        # already closed by a test that drops the connection
+        pass
+    server.stop()
+
+
+@with_setup(_setup, _teardown)
+def test_priority_order():
+    low = conn.put('low', 100)['jid']
+    high = conn.put('high', 1)['jid']
+    same = conn.put('high too', 1)['jid']
+    assert [conn.reserve()['jid'] for i in range(3)] == [high, same, low]
+
+@with_setup(_setup, _teardown)
+def test_delay_and_kick():
+    jid = conn.put('later', 0, 1)['jid']
+    assert conn.stats_job(jid)['data']['state'] == 'delayed'
+    assert conn.reserve_with_timeout(0)['state'] == 'timeout'
+    assert conn.peek_delayed()['jid'] == jid
+    assert conn.kick(5)['count'] == 1
+    assert conn.reserve_with_timeout(0)['jid'] == jid
+
+@with_setup(_setup, _teardown)
+def test_delayed_job_becomes_ready():
+    jid = conn.put('later', 0, 1)['jid']
+    start = time.time()
+    assert conn.reserve_with_timeout(3)['jid'] == jid
+    assert 0.9 < time.time() - start < 2
+
+@with_setup(_setup, _teardown)
+def test_ttr_expiry():
+    jid = conn.put('short', 0, 0, 1)['jid']
+    conn.reserve()
+    # the only reserved job is about to time out
+    assert_raises(errors.DeadlineSoon, conn.reserve)
+    time.sleep(1.1)
+    stats = conn.stats_job(jid)['data']
+    assert stats['state'] == 'ready'
+    assert stats['timeouts'] == 1
+
+@with_setup(_setup, _teardown)
+def test_bury_kick_and_stats():
+    conn.use('work')
+    conn.watch('work')
+    jid = conn.put('x')['jid']
+    conn.reserve()
+    conn.bury(jid)
+    assert conn.peek_buried()['jid'] == jid
+    stats = conn.stats_tube('work')['data']
+    assert stats['current-jobs-buried'] == 1
+    assert stats['name'] == 'work'
+    assert conn.kick(1)['count'] == 1
+    assert conn.stats_job(jid)['data']['kicks'] == 1
+    assert conn.stats()['data']['cmd-bury'] == 1
+    assert_raises(errors.NotFound, conn.stats_tube, 'nosuchtube')
+
+@with_setup(_setup, _teardown)
+def test_reservations_are_per_connection():
+    other = serverconn.ServerConn(*server.address)
+    jid = conn.put('x')['jid']
+    other.reserve()
+    assert_raises(errors.NotFound, conn.release, jid)
+    assert_raises(errors.NotFound, conn.delete, jid)
+    # closing the connection releases its jobs
+    other.close()
+    assert conn.reserve_with_timeout(1)['jid'] == jid
+
+@with_setup(_setup, _teardown)
+def test_ignore_last_tube():
+    assert_raises(errors.NotIgnored, conn.ignore, 'default')
+
+def test_unix_socket():
+    path = os.path.join(tempfile.mkdtemp(), 'beanstalk.sock')
+    with FakeServer(path) as unix_server:
+        assert os.path.exists(path)
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(path)
+        sock.sendall('put 0 0 10 3\r\nabc\r\n')
+        assert sock.recv(100) == 'INSERTED 1\r\n'
+        sock.close()
+    assert not os.path.exists(path)
+
+@with_setup(_setup, _teardown)
+def test_partial_writes():
+    server.chunk_size = 3
+    conn.put('a longer body that arrives in pieces')
+    assert conn.reserve()['data'] == 'a longer body that arrives in pieces'
+
+@with_setup(_setup, _teardown)
+def test_latency():
+    server.latency = {'stats-tube': 0.2}
+    start = time.time()
+    conn.stats_tube('default')
+    assert time.time() - start >= 0.2
+    start = time.time()
+    conn.list_tube_used()
+    assert time.time() - start < 0.2
+
+@with_setup(_setup, _teardown)
+def test_put_error():
+    server.put_error = 'DRAINING'
+    assert_raises(errors.Draining, conn.put, 'x')
+
+@with_setup(_setup, _teardown)
+def test_drop_after():
+    # the connection already sent a stats when it was made
+    server.drop_after = 3
+    conn.put('x')
+    assert_raises(errors.ProtoError, conn.put, 'y')
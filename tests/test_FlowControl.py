@@ -0,0 +1,92 @@
+"""
+Token bucket and paced producer tests, against the in-process fake server.
+"""
+
+import time
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import errors
+from beanstalk import flowcontrol
+from beanstalk import multiserverconn
+from beanstalk import serverconn
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+
+def test_token_bucket():
+    bucket = flowcontrol.TokenBucket(100, burst=1)
+    start = time.time()
+    for i in range(11):
+        assert bucket.acquire()
+    assert 0.09 <= time.time() - start < 0.3
+    assert not bucket.acquire(timeout=0)
+    bucket.set_rate(1000)
+    assert bucket.acquire(timeout=0.01)
+
+@with_setup(_setup, _teardown)
+def test_aimd():
+    conn = serverconn.ServerConn(*server.address)
+    producer = flowcontrol.PacedProducer(conn, target_backlog=5, rate=1000,
+                                         increase=100, interval=0)
+    # every put samples first; under target: additive increase
+    producer.put('job', tube='paced')
+    producer.put('job', tube='paced')
+    assert producer.rate == 1200
+    for i in range(4):
+        producer.put('job', tube='paced')
+    producer.sample()
+    assert producer.rate < 1200
+    assert producer.backlog['paced'] == (6, 6)
+    assert producer.stats()['backoffs'] == 2
+
+    # shrinking, but still above target: the rate holds
+    rate = producer.rate
+    conn.watch('paced')
+    conn.delete(conn.reserve()['jid'])
+    producer.sample()
+    assert producer.rate == rate
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_backs_off_when_draining():
+    conn = serverconn.ServerConn(*server.address)
+    producer = flowcontrol.PacedProducer(conn, rate=100, min_rate=30)
+    server.put_error = 'DRAINING'
+    assert_raises(errors.Draining, producer.put, 'job')
+    assert producer.rate == 50
+    assert_raises(errors.Draining, producer.put, 'job')
+    assert producer.rate == 30
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_rate_limit_timeout():
+    conn = serverconn.ServerConn(*server.address)
+    producer = flowcontrol.PacedProducer(conn, rate=1, min_rate=1)
+    producer.put('job')
+    assert_raises(errors.QueueFull, producer.put, 'job', timeout=0.01)
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_backlog():
+    other = FakeServer().start()
+    try:
+        pool = multiserverconn.ServerPool([server.address + (False,),
+                                           other.address + (False,)])
+        producer = flowcontrol.PacedProducer(pool, rate=1000, interval=0)
+        for i in range(4):
+            producer.put('job', tube='pooled', pri=i * 1000)
+        producer.sample()
+        assert producer.backlog['pooled'] == (4, 2)
+        pool.close()
+    finally:
+        other.stop()
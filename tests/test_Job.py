@@ -0,0 +1,77 @@
+"""
+Job tests. None of these talk to a server, so a dummy object stands in for
+the connection.
+"""
+
+import sys
+sys.path.append('..')
+
+from nose.tools import assert_raises
+
+from beanstalk import job
+
+
+class DummyConn(object):
+    pass
+
+
+class CountingJob(job.SlimJob):
+    __slots__ = ()
+    decodes = []
+
+    def _decode(self, body):
+        self.decodes.append(body)
+        return body.upper()
+
+
+def test_SlimJob_has_no_instance_dict():
+    j = job.SlimJob(conn=DummyConn(), jid=3, data='abc')
+    assert not hasattr(j, '__dict__')
+    assert_raises(AttributeError, setattr, j, 'unknown', 1)
+
+def test_SlimJob_accepts_reserve_reply():
+    reply = {'jid': 12, 'bytes': 5, 'state': 'ok', 'data': 'abcde'}
+    j = job.SlimJob(conn=DummyConn(), **reply)
+    assert j.jid == 12
+    assert j.body == 'abcde'
+    assert j['data'] == 'abcde'
+
+def test_SlimJob_decodes_lazily_and_once():
+    del CountingJob.decodes[:]
+    j = CountingJob(conn=DummyConn(), jid=1, data='payload')
+    assert not j.decoded
+    assert j.jid == 1 and j.body == 'payload'
+    assert CountingJob.decodes == []
+
+    assert j.data == 'PAYLOAD'
+    assert j.data == 'PAYLOAD'
+    assert j.decoded
+    assert CountingJob.decodes == ['payload']
+
+def test_SlimJob_data_can_be_assigned():
+    j = CountingJob(conn=DummyConn(), jid=1, data='payload')
+    j.data = 'other'
+    assert j.data == 'other'
+    assert j.body == 'payload'
+
+def test_SlimJob_compares_like_Job():
+    conn = DummyConn()
+    slim = job.SlimJob(conn=conn, jid=4, data='x')
+    full = job.Job(conn=conn, jid=4, data='x')
+    assert slim == full
+    assert full == slim
+
+def test_RetryPolicy_delays():
+    policy = job.RetryPolicy(attempts=4, initial=2, factor=3, jitter=0)
+    assert [policy.retry_delay(n) for n in range(4)] == [2, 6, 18, None]
+    policy = job.RetryPolicy(attempts=None, initial=0.5, maximum=10)
+    for n in range(40):
+        assert 1 <= policy.retry_delay(n) <= 10
+
+def test_retry_policy_is_per_class():
+    class Fragile(job.Job):
+        retry_policy = job.RetryPolicy(attempts=1)
+    conn = DummyConn()
+    assert job.Job(conn=conn).retry_policy is job.DEFAULT_RETRY
+    assert Fragile(conn=conn).retry_policy.attempts == 1
+    assert job.SlimJob(conn=conn, releases=2).releases == 2
@@ -0,0 +1,105 @@
+"""
+Metrics tests, using the in-process fake server.
+"""
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import errors
+from beanstalk import metrics
+from beanstalk import multiserverconn
+from beanstalk import serverconn
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+
+def test_histogram_buckets():
+    h = metrics.Histogram()
+    for seconds in (0.0000005, 0.001, 0.001, 0.002, 10.0):
+        h.record(seconds)
+    assert h.count == 5
+    assert h.max == 10.0
+    # 1ms lands in the bucket up to 1.024ms
+    assert h.percentile(50) == metrics.Histogram.upper_bound(10)
+    assert h.percentile(100) == 10.0
+    assert sum(h.snapshot()['buckets'].values()) == 5
+
+    h.record(1e9)
+    assert h.counts[-1] == 1
+
+def test_histogram_merge():
+    a, b = metrics.Histogram(), metrics.Histogram()
+    a.record(0.001)
+    b.record(0.5)
+    a.merge(b)
+    assert a.count == 2 and a.max == 0.5
+
+def test_command_name():
+    assert metrics.command_name('put 0 0 60 3\r\nabc\r\n') == 'put'
+    assert metrics.command_name('reserve\r\n') == 'reserve'
+
+@with_setup(_setup, _teardown)
+def test_serverconn_metrics():
+    seen = []
+    conn = serverconn.ServerConn(*server.address)
+    assert conn.metrics() == {}
+    conn.enable_metrics().add_hook(lambda *args: seen.append(args[1:4:2]))
+
+    jid = conn.put('hello')['jid']
+    conn.reserve()
+    conn.delete(jid)
+    assert_raises(errors.NotFound, conn.delete, jid)
+    conn.reserve_with_timeout(0)
+
+    m = conn.metrics()
+    assert m['put']['count'] == 1
+    assert m['put']['replies'] == {'ok': 1}
+    assert m['put']['bytes_sent'] == len('put 1 0 60 5\r\nhello\r\n')
+    assert m['put']['bytes_received'] == len('INSERTED 1\r\n')
+    assert m['reserve']['bytes_received'] == len('RESERVED 1 5\r\nhello\r\n')
+    assert m['delete']['replies'] == {'ok': 1}
+    assert m['delete']['errors'] == {'NotFound': 1}
+    assert m['reserve-with-timeout']['replies'] == {'timeout': 1}
+    assert seen == [('put', 'ok'), ('reserve', 'ok'), ('delete', 'ok'),
+                    ('delete', 'NotFound'), ('reserve-with-timeout', 'timeout')]
+
+    conn.disable_metrics()
+    conn.put('more')
+    assert conn.metrics() == {}
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_shared_metrics():
+    shared = metrics.Metrics('all')
+    a = serverconn.ServerConn(*server.address, metrics=shared)
+    b = serverconn.ServerConn(*server.address, metrics=shared)
+    a.stats()
+    b.stats()
+    # each connection also sent a stats when it connected
+    assert shared.snapshot()['stats']['count'] == 4
+    a.close()
+    b.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_metrics():
+    other = FakeServer().start()
+    try:
+        pool = multiserverconn.ServerPool([server.address + (False,),
+                                           other.address + (False,)])
+        pool.enable_metrics()
+        pool.stats()
+        m = pool.metrics()
+        assert m['stats']['count'] == 2
+        for conn in pool.servers:
+            assert conn.metrics()['stats']['count'] == 1
+        pool.close()
+    finally:
+        other.stop()
@@ -23,8 +23,9 @@ import nose
 from beanstalk import multiserverconn
 from beanstalk import errors
 from beanstalk import job
+from beanstalk.testing import FakeServer
 
-from config import get_config
+from config import get_config, use_fake_server
 
 
 # created during setup
@@ -46,21 +47,31 @@ def setup():
     conn = multiserverconn.ServerPool([])
 
     for ip, port in itertools.izip_longest(H, xrange(P, P+C), fillvalue=H[0]):
-        process = subprocess.Popen([binloc, "-l", str(ip), "-p", str(port)])
+        if use_fake_server(config):
+            process = FakeServer((ip, port)).start()
+            print "fake server started on %s:%s" % (ip, port)
+        else:
+            process = subprocess.Popen([binloc, "-l", str(ip), "-p", str(port)])
+            print output % { "ip" : ip, "port" : port, "pid" : process.pid }
+            time.sleep(0.1)
         processes.append(process)
-        print output % { "ip" : ip, "port" : port, "pid" : process.pid }
-        time.sleep(0.1)
         try:
             conn.add_server(ip, port, J)
         except Exception, e:
-            processes.pop().kill()
+            _stop(processes.pop())
             raise
 
 def teardown():
     global processes
-    output = "terminating beanstalkd with PID: %(pid)s"
     for process in processes:
-        print output % {"pid" : process.pid}
+        _stop(process)
+
+def _stop(process):
+    if isinstance(process, FakeServer):
+        print "stopping fake server at %s:%s" % process.address
+        process.stop()
+    else:
+        print "terminating beanstalkd with PID: %(pid)s" % {"pid" : process.pid}
         process.kill()
 
 def _clean_up():
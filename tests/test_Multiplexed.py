@@ -0,0 +1,140 @@
+"""
+Multiplexed connection tests, against the in-process fake server.
+"""
+
+import threading
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import backoff
+from beanstalk import errors
+from beanstalk import protohandler
+from beanstalk import serverconn
+from beanstalk.job import Job
+from beanstalk.multiplexconn import MultiplexedConn, _Request
+from beanstalk.producer import Future
+from beanstalk.testing import FakeServer
+
+server = None
+quick = backoff.Backoff(initial=0.01, maximum=0.05, retries=3)
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+def _stats():
+    conn = serverconn.ServerConn(*server.address)
+    try:
+        return conn.stats()['data']
+    finally:
+        conn.close()
+
+
+@with_setup(_setup, _teardown)
+def test_commands():
+    conn = MultiplexedConn(*server.address, job=Job)
+    jid = conn.put('payload')['jid']
+    job = conn.peek(jid)
+    assert isinstance(job, Job) and job.data == 'payload'
+    assert_raises(errors.NotFound, conn.delete, 12345)
+    assert conn.delete(jid)['state'] == 'ok'
+
+    future = conn.submit(*protohandler.process_stats())
+    assert future.result(5)['data']['current-connections'] >= 1
+    assert_raises(errors.BeanStalkError, conn.reserve)
+    assert_raises(errors.BeanStalkError, conn.watch, 'other')
+    assert conn.close()
+    assert_raises(errors.NotConnected, conn.put, 'late')
+
+@with_setup(_setup, _teardown)
+def test_threads_share_one_socket():
+    conn = MultiplexedConn(*server.address)
+    connections = _stats()['total-connections']
+    jids = []
+    failures = []
+
+    def produce(number):
+        try:
+            tube = 'tube%d' % (number % 4)
+            conn.use(tube)
+            for i in range(50):
+                jids.append(conn.put('%s %d' % (tube, i))['jid'])
+                assert conn.tube == tube
+                assert conn.list_tube_used()['tube'] == tube
+        except Exception, e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=produce, args=(i,))
+               for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures, failures
+    assert len(set(jids)) == 16 * 50
+    assert _stats()['total-connections'] == connections + 1
+
+    check = serverconn.ServerConn(*server.address)
+    for number in range(4):
+        tube = 'tube%d' % number
+        assert check.stats_tube(tube)['data']['current-jobs-ready'] == 200
+        check.use(tube)
+        assert check.peek_ready()['data'].startswith(tube)
+    check.close()
+
+    stats = conn.io_stats()
+    assert stats['requests'] == 16 * 101 and stats['in-flight'] == 0
+    # many commands went out together
+    assert stats['writes'] < stats['requests']
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_lost_connection():
+    conn = MultiplexedConn(*server.address, reconnect=quick)
+    assert conn.put('one')['jid']
+    server.stop()
+    server.start()
+    conn.port = server.address[1]
+    # stats is idempotent: sent again if the loss is noticed with it in
+    # flight
+    assert conn.stats()['data']['current-connections'] == 1
+    assert conn.io_stats()['reconnects'] == 1
+    assert conn.put('two')['jid']
+    conn.close()
+
+    conn = MultiplexedConn(*server.address)
+    server.stop()
+    assert_raises((errors.ConnectionLost, errors.NotConnected), conn.put,
+                  'lost')
+    assert_raises(errors.NotConnected, conn.put, 'closed')
+    conn.close()
+
+def test_queued_while_giving_up():
+    server = FakeServer().start()
+    conn = MultiplexedConn(*server.address)
+    server.stop()
+    conn._thread.join(5)
+    # a request that got past the closed check as the connection was lost
+    future = Future()
+    conn._queue.append(_Request(*protohandler.process_stats(),
+                                future=future, tube='default'))
+    assert not conn._reconnect()
+    assert_raises(errors.NotConnected, future.result, 0)
+    conn.close()
+
+def test_timeout_keeps_the_connection():
+    server = FakeServer(latency={'put': 0.2}).start()
+    try:
+        conn = MultiplexedConn(*server.address)
+        assert_raises(errors.CommandTimeout, conn.put, 'slow', timeout=0.05)
+        # the late reply went to the put, not to this
+        assert conn.stats_tube('default')['data']['current-jobs-ready'] == 1
+        second = conn.put('second')['jid']
+        assert conn.peek(second)['data'] == 'second'
+        conn.close()
+    finally:
+        server.stop()
@@ -0,0 +1,91 @@
+"""
+ServerPool startup tests: connecting to many servers at once, with some of
+them unreachable or unresponsive.
+"""
+
+import socket
+import time
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import backoff
+from beanstalk import multiserverconn
+from beanstalk import transport
+from beanstalk.testing import FakeServer
+
+servers = []
+quick = {'backoff': backoff.Backoff(initial=0.05, maximum=0.1, jitter=0,
+                                    retries=None)}
+
+
+def _setup():
+    servers[:] = [FakeServer().start() for i in range(3)]
+
+def _teardown():
+    for server in servers:
+        server.stop()
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@with_setup(_setup, _teardown)
+def test_connect_all():
+    port = _free_port()
+    addresses = [s.address for s in servers] + [('127.0.0.1', port)]
+    results = transport.connect_all(addresses, timeout=1)
+    for sock in results[:3]:
+        assert isinstance(sock, socket.socket)
+        sock.sendall('stats\r\n')
+        assert sock.recv(3) == 'OK '
+        sock.close()
+    assert isinstance(results[3], socket.error)
+    assert not isinstance(results[3], socket.timeout)
+
+@with_setup(_setup, _teardown)
+def test_degraded_start():
+    port = _free_port()
+    pool = multiserverconn.ServerPool(
+        [s.address + (False,) for s in servers] + [('127.0.0.1', port, False)],
+        breaker=quick, connect_timeout=1)
+    assert len(pool.servers) == 3
+    health = pool.health()
+    assert len(health) == 4
+    assert not health['127.0.0.1:%d' % port]['connected']
+    pool.put('job')
+
+    # added once it answers
+    servers.append(FakeServer(('127.0.0.1', port)).start())
+    deadline = time.time() + 5
+    while len(pool.servers) < 4 and time.time() < deadline:
+        time.sleep(0.1)
+        assert pool.stats()['data']['current-connections'] == 1
+    assert len(pool.servers) == 4
+    assert all(h['connected'] for h in pool.health().values())
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_connect_deadline():
+    # accepts connections, but never answers
+    silent = socket.socket()
+    silent.bind(('127.0.0.1', 0))
+    silent.listen(5)
+    try:
+        start = time.time()
+        pool = multiserverconn.ServerPool(
+            [s.address + (False,) for s in servers] +
+            [silent.getsockname() + (False,)], connect_timeout=0.3)
+        assert time.time() - start < 0.6
+        assert len(pool.servers) == 3
+        assert not pool.health()['%s:%d' % silent.getsockname()]['connected']
+        pool.close()
+    finally:
+        silent.close()
+
+def test_nothing_reachable():
+    assert_raises(socket.error, multiserverconn.ServerPool,
+                  [('127.0.0.1', _free_port(), False)], connect_timeout=1)
@@ -0,0 +1,107 @@
+"""
+Pipelining and BackgroundProducer tests against the in-process fake server.
+"""
+
+import threading
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import errors
+from beanstalk import multiserverconn
+from beanstalk import protohandler
+from beanstalk import serverconn
+from beanstalk import producer as producer_module
+from beanstalk.producer import BackgroundProducer
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+def _ready(tube):
+    conn = serverconn.ServerConn(*server.address)
+    try:
+        return conn.stats_tube(tube)['data']['current-jobs-ready']
+    finally:
+        conn.close()
+
+
+@with_setup(_setup, _teardown)
+def test_pipeline():
+    conn = serverconn.ServerConn(*server.address)
+    results = conn.pipeline([protohandler.process_use('piped'),
+                             protohandler.process_put('a'),
+                             protohandler.process_put('b'),
+                             protohandler.process_delete(12345),
+                             protohandler.process_peek_ready()])
+    assert results[0]['tube'] == 'piped'
+    assert results[2]['jid'] == results[1]['jid'] + 1
+    assert isinstance(results[3], errors.NotFound)
+    assert results[4]['data'] == 'a'
+    # the connection is still in step
+    assert conn.list_tube_used()['tube'] == 'piped'
+    assert conn.pipeline([]) == []
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_submit():
+    producer = BackgroundProducer(serverconn.ServerConn(*server.address))
+    futures = [producer.submit('job %d' % i, tube='tube%d' % (i % 3))
+               for i in range(30)]
+    jids = [f.result(timeout=5) for f in futures]
+    assert sorted(jids) == sorted(set(jids))
+    assert producer.pending == 0
+    assert [_ready('tube%d' % i) for i in range(3)] == [10, 10, 10]
+    assert producer.close(timeout=5)
+    assert_raises(errors.BeanStalkError, producer.submit, 'late')
+
+@with_setup(_setup, _teardown)
+def test_submit_to_pool():
+    pool = multiserverconn.ServerPool([server.address + (False,)])
+    producer = BackgroundProducer(pool)
+    futures = [producer.submit('job', tube='pooled') for i in range(5)]
+    assert producer.flush(timeout=5)
+    assert all(isinstance(f.result(), int) for f in futures)
+    assert _ready('pooled') == 5
+    producer.close()
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_errors():
+    server.put_error = 'DRAINING'
+    producer = BackgroundProducer(serverconn.ServerConn(*server.address))
+    assert_raises(errors.Draining, producer.submit('job').result, 5)
+    server.put_error = None
+    big = producer.submit('x' * protohandler.MAX_JOB_SIZE)
+    fine = producer.submit('job')
+    assert_raises(errors.JobTooBig, big.result, 5)
+    assert isinstance(fine.result(timeout=5), int)
+    assert_raises(errors.BadFormat, producer.submit, 'job', tube='-bad')
+    producer.close()
+
+@with_setup(_setup, _teardown)
+def test_cancel_and_queue_full():
+    server.latency = {'put': 0.2}
+    producer = BackgroundProducer(serverconn.ServerConn(*server.address),
+                                  max_queue=2, linger=0, max_batch=1)
+    first = producer.submit('first')
+    # wait until the sender took it
+    while producer._queue:
+        threading.Event().wait(0.01)
+    cancelled = producer.submit('cancelled')
+    producer.submit('third')
+    assert_raises(producer_module.TimeoutError, cancelled.result, 0)
+    assert cancelled.cancel()
+    assert_raises(producer_module.CancelledError, cancelled.result)
+    assert_raises(errors.QueueFull, producer.submit, 'full', block=False)
+    assert_raises(errors.QueueFull, producer.submit, 'full', timeout=0.05)
+    assert producer.close(timeout=5)
+    assert isinstance(first.result(), int)
+    assert cancelled.cancelled()
+    assert _ready('default') == 2
@@ -214,3 +214,32 @@ def test_put_extra():
 
 def test_tube_name():
     assert(protohandler._namematch.match("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-+/;.$_()"))
+
+def test_protProvider():
+    class Recorder(object):
+        def _send(self, line, handler):
+            return line
+        def stats(self):
+            return 'own stats'
+    Recorder = protohandler.protProvider(Recorder, interaction='_send')
+
+    r = Recorder()
+    assert r.delete(5) == 'delete 5\r\n'
+    assert r.put('abc', 1, 2, 3) == 'put 1 2 3 3\r\nabc\r\n'
+    assert Recorder.delete.__name__ == 'delete'
+    # methods defined by the class itself are kept
+    assert r.stats() == 'own stats'
+
+def test_handler_leftover():
+    # pipelined replies: whatever follows the reply is kept for the next one
+    line, handler = protohandler.process_delete(1)
+    assert handler('DELETED\r\nNOT_') == {'state': 'ok'}
+    assert handler.leftover == 'NOT_'
+
+    line, handler = protohandler.process_reserve()
+    assert handler('RESERVED 3 5\r\nhe') is None
+    assert handler('l') is None
+    assert handler('lo\r\nINSERTED 4\r\n') == {'jid': 3, 'bytes': 5,
+                                               'state': 'ok', 'data': 'hello'}
+    assert handler.leftover == 'INSERTED 4\r\n'
+    assert handler.remaining == 0
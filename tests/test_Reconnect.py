@@ -0,0 +1,124 @@
+"""
+Reconnect and replay tests, using the in-process fake server's
+drop_connections().
+"""
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import backoff
+from beanstalk import errors
+from beanstalk import multiserverconn
+from beanstalk import protohandler
+from beanstalk import serverconn
+from beanstalk.testing import FakeServer
+
+server = None
+quick = backoff.Backoff(initial=0.01, maximum=0.05, retries=5)
+# without jitter, a retry never comes before the breaker is due
+steady = backoff.Backoff(initial=0.01, maximum=0.05, jitter=0, retries=5)
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+
+def test_backoff_delays():
+    policy = backoff.Backoff(initial=0.1, maximum=1.0, retries=6)
+    delays = list(policy.delays())
+    assert len(delays) == 6
+    for attempt, delay in enumerate(delays):
+        assert 0 <= delay <= policy.bound(attempt)
+    assert policy.bound(3) == 0.8
+    assert policy.bound(4) == 1.0
+    assert policy.bound(10000) == 1.0
+    assert policy.exhausted(6) and not policy.exhausted(5)
+
+    exact = backoff.Backoff(initial=0.1, jitter=0)
+    assert [exact.delay(n) for n in range(3)] == [0.1, 0.2, 0.4]
+    assert not backoff.Backoff(retries=None).exhausted(10 ** 6)
+    assert list(backoff.ONCE.delays()) == [0]
+
+@with_setup(_setup, _teardown)
+def test_no_reconnect_by_default():
+    conn = serverconn.ServerConn(*server.address)
+    server.drop_connections()
+    assert_raises(errors.ConnectionLost, conn.stats)
+    assert_raises(errors.NotConnected, conn.stats)
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_replay_restores_tubes():
+    conn = serverconn.ServerConn(*server.address, reconnect=quick)
+    conn.use('used')
+    conn.watch('watched')
+    conn.ignore('default')
+    conn.watch('dropped')
+    conn.ignore('dropped')
+    conn.put('job')
+
+    server.drop_connections()
+    # idempotent, so sent again on a new connection
+    assert conn.stats()['data']['current-connections'] == 1
+    assert conn.list_tube_used()['tube'] == 'used'
+    assert conn.list_tubes_watched()['data'] == ['watched']
+
+    # the reserve replayed after the drop gets the job released by it
+    conn.watch('used')
+    job = conn.reserve()
+    server.drop_connections()
+    assert conn.reserve_with_timeout(0)['jid'] == job['jid']
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_reconnect_restores_pipelined_tubes():
+    conn = serverconn.ServerConn(*server.address, reconnect=quick)
+    conn.pipeline([protohandler.process_use('used'),
+                   protohandler.process_watch('watched'),
+                   protohandler.process_ignore('default'),
+                   protohandler.process_ignore('missing')])
+    server.drop_connections()
+    assert conn.list_tube_used()['tube'] == 'used'
+    assert conn.list_tubes_watched()['data'] == ['watched']
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_put_is_not_replayed():
+    conn = serverconn.ServerConn(*server.address, reconnect=quick)
+    conn.use('used')
+    server.drop_connections()
+    assert_raises(errors.ConnectionLost, conn.put, 'maybe')
+    # the next command reconnects
+    conn.put('surely')
+    assert conn.stats_tube('used')['data']['current-jobs-ready'] == 1
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_reconnect_gives_up():
+    conn = serverconn.ServerConn(*server.address, reconnect=quick)
+    server.stop()
+    assert_raises(errors.NotConnected, conn.stats)
+    assert 'Closed' in repr(conn)
+
+    server.start()
+    conn.port = server.address[1]
+    conn.reconnect()
+    assert conn.stats()['data']['current-connections'] == 1
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_reconnects():
+    pool = multiserverconn.ServerPool([server.address + (False,)],
+                                      backoff=steady,
+                                      breaker={'backoff': steady})
+    pool.use('used')
+    server.drop_connections()
+    assert pool.stats()['data']['current-connections'] == 1
+    assert pool.list_tube_used().values()[0]['tube'] == 'used'
+
+    server.drop_connections()
+    assert_raises(errors.NotConnected, pool.put, 'maybe')
+    pool.close()
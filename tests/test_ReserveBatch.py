@@ -0,0 +1,151 @@
+"""
+Batched reserve, delete and release tests, against the in-process fake
+server.
+"""
+
+import threading
+import time
+
+from nose.tools import with_setup
+
+from beanstalk import errors
+from beanstalk import multiserverconn
+from beanstalk import serverconn
+from beanstalk.job import Job
+from beanstalk.testing import FakeServer
+
+servers = []
+
+
+def _setup():
+    servers[:] = [FakeServer().start(), FakeServer().start()]
+
+def _teardown():
+    for server in servers:
+        server.stop()
+
+def _put(server, count, pri=1):
+    conn = serverconn.ServerConn(*server.address)
+    jids = [conn.put('job %d' % i, pri)['jid'] for i in range(count)]
+    conn.close()
+    return jids
+
+def _stats(server):
+    conn = serverconn.ServerConn(*server.address)
+    try:
+        return conn.stats()['data']
+    finally:
+        conn.close()
+
+
+@with_setup(_setup, _teardown)
+def test_reserve_batch():
+    jids = _put(servers[0], 5)
+    conn = serverconn.ServerConn(*servers[0].address)
+    conn.enable_metrics()
+    jobs = conn.reserve_batch(3)
+    assert [job['jid'] for job in jobs] == jids[:3]
+    jobs += conn.reserve_batch(10)
+    assert [job['jid'] for job in jobs] == jids
+    assert conn.reserve_batch(10) == []
+    # one round trip for the first job, one for the rest
+    assert conn.metrics()['reserve-with-timeout']['count'] == 3 + 10 + 1
+
+    results = conn.ack_batch(jobs[:4] + [jids[0]])
+    assert all(r['state'] == 'ok' for r in results[:4])
+    assert isinstance(results[4], errors.NotFound)
+    assert _stats(servers[0])['current-jobs-reserved'] == 1
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_reserve_batch_waits():
+    conn = serverconn.ServerConn(*servers[0].address)
+    start = time.time()
+    assert conn.reserve_batch(5, max_wait=1) == []
+    assert time.time() - start >= 1
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_release_batch():
+    _put(servers[0], 2, pri=5)
+    _put(servers[0], 1, pri=9)
+    conn = serverconn.ServerConn(*servers[0].address, job=Job)
+    jobs = conn.reserve_batch(3)
+    assert all(isinstance(job, Job) for job in jobs)
+    results = conn.release_batch(jobs[:2] + [12345], delay=0)
+    assert isinstance(results[2], errors.NotFound)
+    assert _stats(servers[0])['current-jobs-ready'] == 2
+    # the priorities were kept
+    pris = sorted(conn.stats_job(job.jid)['data']['pri'] for job in jobs)
+    assert pris == [5, 5, 9]
+
+    conn.release_batch(jobs[2:], pri=1, delay=60)
+    assert conn.stats_job(jobs[2].jid)['data']['state'] == 'delayed'
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_reserve_batch():
+    _put(servers[0], 3)
+    _put(servers[1], 2)
+    pool = multiserverconn.ServerPool([s.address + (False,) for s in servers])
+    jobs = pool.reserve_batch(10)
+    assert len(jobs) == 5
+    assert set(job['conn'].port for job in jobs) == \
+        set(s.address[1] for s in servers)
+    assert pool.reserve_batch(10) == []
+
+    results = pool.release_batch(jobs[:1])
+    assert results[0]['state'] == 'ok'
+    results = pool.ack_batch(jobs[1:])
+    assert all(r['state'] == 'ok' for r in results)
+    assert sum(_stats(s)['current-jobs-ready'] for s in servers) == 1
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_reserve_batch_waits_for_more():
+    _put(servers[0], 1)
+    pool = multiserverconn.ServerPool([s.address + (False,) for s in servers])
+    later = threading.Timer(0.3, _put, (servers[1], 1))
+    later.start()
+    start = time.time()
+    # whichever server the first job came from, both wait for the second
+    jobs = pool.reserve_batch(2, max_wait=1)
+    later.join()
+    assert len(jobs) == 2
+    assert set(job['conn'].port for job in jobs) == \
+        set(s.address[1] for s in servers)
+    # the round waited for the server that got no job, not beyond
+    assert time.time() - start < 1 + multiserverconn.RESERVE_MARGIN + 0.5
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_reserve_batch_releases_extra_jobs():
+    pool = multiserverconn.ServerPool([s.address + (False,) for s in servers])
+    later = threading.Timer(0.3, lambda: [_put(s, 1, pri=5) for s in servers])
+    later.start()
+    # both servers wait, and both get a job
+    jobs = pool.reserve_batch(1, max_wait=3)
+    later.join()
+    assert len(jobs) == 1
+    stats = [_stats(s) for s in servers]
+    assert sum(s['current-jobs-reserved'] for s in stats) == 1
+    assert sum(s['current-jobs-ready'] for s in stats) == 1
+    assert sum(s['cmd-release'] for s in stats) == 1
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_reserve_batch_loses_a_server():
+    _put(servers[0], 3)
+    _put(servers[1], 3)
+    servers[1].latency = {'reserve-with-timeout': 0.3}
+    pool = multiserverconn.ServerPool([s.address + (False,) for s in servers])
+    threading.Timer(0.1, servers[1].drop_connections).start()
+    jobs = pool.reserve_batch(10)
+    assert len(jobs) == 3
+    assert set(job['conn'].port for job in jobs) == \
+        set([servers[0].address[1]])
+    servers[1].latency = 0
+    # the lost connection's job went back to the queue
+    assert _stats(servers[1])['current-jobs-ready'] == 3
+    assert _stats(servers[0])['current-jobs-reserved'] == 3
+    pool.close()
@@ -0,0 +1,57 @@
+"""
+Job retry tests, against the in-process fake server.
+"""
+
+from nose.tools import with_setup
+
+from beanstalk import job
+from beanstalk import serverconn
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+class RetriedJob(job.Job):
+    retry_policy = job.RetryPolicy(attempts=3, initial=1, factor=2, jitter=0,
+                                   bury_pri=7)
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+
+@with_setup(_setup, _teardown)
+def test_retry_delays_then_buries():
+    conn = serverconn.ServerConn(*server.address, job=RetriedJob)
+    conn.enable_metrics()
+    jid = conn.put('flaky', 3)['jid']
+    for delay in (1, 2):
+        j = conn.reserve_with_timeout(delay + 1)
+        assert j.jid == jid and j.releases is None
+        assert j.Retry()
+        stats = conn.stats_job(jid)['data']
+        assert stats['state'] == 'delayed' and stats['delay'] == delay
+        assert stats['pri'] == 3
+
+    j = conn.reserve_with_timeout(5)
+    assert j.Retry()
+    stats = conn.stats_job(jid)['data']
+    assert stats['state'] == 'buried' and stats['pri'] == 7
+    assert stats['releases'] == 2
+    assert conn.metrics()['stats-job']['count'] == 6
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_retry_uses_known_releases():
+    conn = serverconn.ServerConn(*server.address)
+    jid = conn.put('flaky')['jid']
+    reply = conn.reserve()
+    j = RetriedJob(conn=conn, releases=2, **reply)
+    assert j.Retry()
+    assert conn.stats_job(jid)['data']['state'] == 'buried'
+    assert not j.Retry()
+    conn.close()
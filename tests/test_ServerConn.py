@@ -18,28 +18,39 @@ import nose
 
 from beanstalk import serverconn
 from beanstalk import errors
-from config import get_config
+from beanstalk.testing import FakeServer
+from config import get_config, use_fake_server
 
 config = get_config("ServerConn")
 
 # created during setup
 server_pid = None
+fake_server = None
 conn = None
 
 
 def setup():
-    global server_pid, conn, config
-    server_pid = os.spawnl(os.P_NOWAIT,
-                            os.path.join(config.BPATH,config.BEANSTALKD),
-                            os.path.join(config.BPATH,config.BEANSTALKD),
-                            '-l', config.BEANSTALKD_HOST,
-                            '-p', config.BEANSTALKD_PORT
-                            )
-    print "server started at process", server_pid
-    time.sleep(0.1)
+    global server_pid, fake_server, conn, config
+    if use_fake_server(config):
+        fake_server = FakeServer((config.BEANSTALKD_HOST,
+                                  int(config.BEANSTALKD_PORT))).start()
+        print "fake server started at", fake_server.address
+    else:
+        server_pid = os.spawnl(os.P_NOWAIT,
+                                os.path.join(config.BPATH,config.BEANSTALKD),
+                                os.path.join(config.BPATH,config.BEANSTALKD),
+                                '-l', config.BEANSTALKD_HOST,
+                                '-p', config.BEANSTALKD_PORT
+                                )
+        print "server started at process", server_pid
+        time.sleep(0.1)
     conn = serverconn.ServerConn(config.BEANSTALKD_HOST, int(config.BEANSTALKD_PORT))
 
 def teardown():
+    if fake_server:
+        print "stopping fake server at", fake_server.address
+        fake_server.stop()
+        return
     print "terminating beanstalkd at", server_pid
     os.kill(server_pid, signal.SIGTERM)
 
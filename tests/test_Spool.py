@@ -0,0 +1,166 @@
+"""
+Disk spool tests, and Spooler replaying against the in-process fake server.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import backoff
+from beanstalk import errors
+from beanstalk import multiserverconn
+from beanstalk import serverconn
+from beanstalk.spool import Spool, Spooler
+from beanstalk.testing import FakeServer
+
+server = None
+directory = None
+quick = backoff.Backoff(initial=0.02, maximum=0.05, jitter=0, retries=None)
+
+
+def _setup():
+    global server, directory
+    server = FakeServer().start()
+    directory = tempfile.mkdtemp()
+
+def _teardown():
+    server.stop()
+    shutil.rmtree(directory)
+
+def _segments():
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith('.spool'))
+
+def _wait_empty(spooler):
+    deadline = time.time() + 5
+    while not spooler.spool.empty() and time.time() < deadline:
+        time.sleep(0.02)
+    assert spooler.spool.empty()
+
+def _bodies(tube):
+    conn = serverconn.ServerConn(*server.address)
+    conn.watch(tube)
+    conn.ignore('default')
+    bodies = []
+    while True:
+        try:
+            job = conn.reserve_with_timeout(0)
+        except errors.BeanStalkError:
+            break
+        if 'jid' not in job:
+            break
+        bodies.append(job['data'])
+        conn.delete(job['jid'])
+    conn.close()
+    return bodies
+
+
+@with_setup(_setup, _teardown)
+def test_spool_segments():
+    spool = Spool(directory, segment_size=256, max_bytes=1024)
+    for i in range(10):
+        spool.append('tube', 'job %02d' % i, pri=i, ttr=30)
+    assert len(spool) == 10
+    assert len(_segments()) == 2
+
+    # 7 records fill a segment
+    records = spool.read(count=7)
+    assert [r[1] for r in records[:2]] == [('tube', 'job 00', 0, 0, 30),
+                                           ('tube', 'job 01', 1, 0, 30)]
+    # reading does not consume
+    assert spool.read(count=1)[0][1][1] == 'job 00'
+    spool.commit(records[-1][0])
+    assert len(spool) == 3
+    assert len(_segments()) == 1
+    spool.close()
+
+    spool = Spool(directory, segment_size=256, max_bytes=1024)
+    assert [r[1][1] for r in spool.read()] == ['job %02d' % i
+                                               for i in range(7, 10)]
+    spool.commit(spool.read()[-1][0])
+    assert spool.empty()
+    assert spool.stats()['committed'] == 3
+    spool.close()
+
+@with_setup(_setup, _teardown)
+def test_spool_full():
+    spool = Spool(directory, segment_size=64, max_bytes=128)
+    assert_raises(errors.JobTooBig, spool.append, 'tube', 'x' * 64)
+    spool.append('tube', 'x' * 30)
+    spool.append('tube', 'x' * 30)
+    assert_raises(errors.QueueFull, spool.append, 'tube', 'x' * 30)
+    assert len(spool) == 2
+    # room again once replayed
+    spool.commit(spool.read(count=1)[0][0])
+    spool.append('tube', 'x' * 30)
+    spool.close()
+
+@with_setup(_setup, _teardown)
+def test_torn_record():
+    spool = Spool(directory, segment_size=256, max_bytes=256)
+    for i in range(3):
+        spool.append('tube', 'job %d' % i)
+    spool.close()
+    # the last record lost its tail
+    path = os.path.join(directory, _segments()[0])
+    f = open(path, 'r+b')
+    f.seek(3 * (23 + len('tube') + len('job 0')) - 2)
+    f.write('\0\0')
+    f.close()
+
+    spool = Spool(directory, segment_size=256, max_bytes=256)
+    assert len(spool) == 2
+    spool.append('tube', 'job 3')
+    assert [r[1][1] for r in spool.read()] == ['job 0', 'job 1', 'job 3']
+    spool.close()
+
+@with_setup(_setup, _teardown)
+def test_spool_while_draining():
+    server.put_error = 'DRAINING'
+    spooler = Spooler(serverconn.ServerConn(*server.address),
+                      Spool(directory), backoff=quick)
+    spooler.use('spooled')
+    assert spooler.put('job 0') is None
+    server.put_error = None
+    # queued behind the spooled job, to keep the order
+    assert spooler.put('job 1') is None
+    _wait_empty(spooler)
+    assert isinstance(spooler.put('job 2'), int)
+    assert _bodies('spooled') == ['job 0', 'job 1', 'job 2']
+    stats = spooler.stats()
+    assert stats['spooled'] == 2 and stats['replayed'] == 2
+    spooler.close()
+
+@with_setup(_setup, _teardown)
+def test_spool_while_unreachable():
+    global server
+    port = server.address[1]
+    spooler = Spooler(serverconn.ServerConn(*server.address),
+                      Spool(directory), backoff=quick)
+    server.stop()
+    for i in range(5):
+        assert spooler.put('job %d' % i, tube='down') is None
+    time.sleep(0.1)
+    assert len(spooler.spool) == 5
+
+    server = FakeServer(('127.0.0.1', port)).start()
+    _wait_empty(spooler)
+    assert _bodies('down') == ['job %d' % i for i in range(5)]
+    spooler.close()
+
+@with_setup(_setup, _teardown)
+def test_spool_through_pool():
+    pool = multiserverconn.ServerPool([server.address + (False,)],
+                                      backoff=backoff.ONCE)
+    server.put_error = 'DRAINING'
+    spooler = Spooler(pool, Spool(directory), backoff=quick)
+    for i in range(3):
+        assert spooler.put('job %d' % i, tube='pooled') is None
+    server.put_error = None
+    _wait_empty(spooler)
+    assert _bodies('pooled') == ['job 0', 'job 1', 'job 2']
+    spooler.close()
+    pool.close()
@@ -0,0 +1,143 @@
+"""
+Consumer supervisor tests, against the in-process fake server.
+"""
+
+import threading
+import time
+
+from nose.tools import with_setup
+
+from beanstalk import errors
+from beanstalk import serverconn
+from beanstalk import supervisor
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    server = FakeServer().start()
+
+def _teardown():
+    server.stop()
+
+def _connect():
+    return serverconn.ServerConn(*server.address)
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+def _tube_stats(tube):
+    conn = _connect()
+    try:
+        return conn.stats_tube(tube)['data']
+    finally:
+        conn.close()
+
+def _stats():
+    conn = _connect()
+    try:
+        return conn.stats()['data']
+    finally:
+        conn.close()
+
+def _put(tube, count, pri=1):
+    conn = _connect()
+    conn.use(tube)
+    for i in range(count):
+        conn.put('job %d' % i, pri)
+    conn.close()
+
+
+@with_setup(_setup, _teardown)
+def test_handles_jobs():
+    done = []
+    def handle(job):
+        if job['data'] == 'job 1':
+            raise ValueError('bad job')
+        done.append(job['data'])
+    _put('work', 3)
+    sup = supervisor.ConsumerSupervisor(_connect, handle, tubes=['work'],
+                                        poll=0, error_delay=60)
+    sup.start()
+    assert _wait_for(lambda: len(done) == 2)
+    assert sup.stop(timeout=5)
+    assert sorted(done) == ['job 0', 'job 2']
+    stats = _tube_stats('work')
+    # the failed one is released with a delay
+    assert stats['current-jobs-delayed'] == 1
+    assert stats['current-jobs-ready'] == 0
+
+@with_setup(_setup, _teardown)
+def test_scaling():
+    sup = supervisor.ConsumerSupervisor(
+        _connect, lambda job: time.sleep(0.02), tubes=['busy'],
+        max_workers=4, target_wait=0.1, interval=0.05, up_after=1,
+        down_after=2, poll=0)
+    sup.sample()
+    _put('busy', 60)
+    sup.start()
+    assert _wait_for(lambda: sup.workers > 1)
+    assert _wait_for(lambda: _tube_stats('busy')['current-jobs-ready'] == 0)
+    # idle now, back to one
+    assert _wait_for(lambda: sup.workers == 1)
+    assert sup.stats()['resizes'] >= 2
+    assert sup.stop(timeout=5)
+    assert _tube_stats('busy')['total-jobs'] == 60
+
+@with_setup(_setup, _teardown)
+def test_graceful_stop():
+    started = threading.Event()
+    finish = threading.Event()
+    def handle(job):
+        started.set()
+        finish.wait(5)
+    _put('prefetch', 4, pri=7)
+    sup = supervisor.ConsumerSupervisor(_connect, handle, tubes=['prefetch'],
+                                        prefetch=4, poll=0, min_workers=0)
+    sup.resize(1)
+    assert started.wait(5)
+    sup.resize(0)
+    assert sup.workers == 0
+    finish.set()
+    assert sup.stop(timeout=5)
+    stats = _tube_stats('prefetch')
+    # the one being handled was finished, the prefetched ones are back
+    assert stats['current-jobs-ready'] == 3
+    assert stats['current-jobs-reserved'] == 0
+    assert stats['cmd-delete'] == 1
+    conn = _connect()
+    conn.watch('prefetch')
+    assert conn.stats_job(conn.reserve()['jid'])['data']['pri'] == 7
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_failed_worker_is_replaced():
+    class FailingDelete(serverconn.ServerConn):
+        def delete(self, jid):
+            raise errors.BeanStalkError('delete failed')
+
+    def connect():
+        if threading.current_thread().name == 'ConsumerWorker-1':
+            return FailingDelete(*server.address)
+        return _connect()
+
+    done = []
+    _put('fails', 3)
+    sup = supervisor.ConsumerSupervisor(connect, lambda job: done.append(
+                                            job['data']),
+                                        tubes=['fails'], prefetch=3, poll=0,
+                                        interval=0.05)
+    sup.start()
+    # the first worker dies on its first delete, releasing the other two
+    assert _wait_for(lambda: len(done) == 4)
+    assert sorted(done) == ['job 0', 'job 0', 'job 1', 'job 2']
+    assert sup.workers == 1
+    assert sup.stop(timeout=5)
+    stats = _tube_stats('fails')
+    assert stats['cmd-delete'] == 3 and stats['current-jobs-ready'] == 0
+    assert _stats()['cmd-release'] == 2
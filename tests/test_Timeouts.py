@@ -0,0 +1,71 @@
+"""
+ServerConn deadline tests, using the in-process fake server's latency.
+"""
+
+import time
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import errors
+from beanstalk import protohandler
+from beanstalk import serverconn
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    server = FakeServer(latency={'list-tube-used': 1, 'peek-ready': 0.3})
+    server.start()
+
+def _teardown():
+    server.stop()
+
+
+@with_setup(_setup, _teardown)
+def test_default_timeout():
+    conn = serverconn.ServerConn(*server.address, timeout=0.2)
+    conn.put('fast enough')
+    start = time.time()
+    assert_raises(errors.CommandTimeout, conn.list_tube_used)
+    assert time.time() - start < 0.5
+    # a late reply would be taken for the next one, so the connection is gone
+    assert_raises(errors.NotConnected, conn.stats)
+    assert 'Closed' in repr(conn)
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_per_call_timeout():
+    conn = serverconn.ServerConn(*server.address)
+    conn.put('job')
+    assert_raises(errors.CommandTimeout, conn.peek_ready, timeout=0.1)
+    conn.close()
+
+    # overriding the connection's default, both ways
+    conn = serverconn.ServerConn(*server.address, timeout=0.1)
+    assert conn.peek_ready(timeout=2)['data'] == 'job'
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_reserve_deadlines():
+    conn = serverconn.ServerConn(*server.address, timeout=0.1)
+    # the server side timeout is longer than the connection's own timeout
+    assert conn.reserve_with_timeout(1)['state'] == 'timeout'
+    # a plain reserve blocks unless told otherwise
+    assert_raises(errors.CommandTimeout, conn.reserve, timeout=0.1)
+    conn.close()
+
+def test_timeout_option_split():
+    # reserve_with_timeout keeps its own timeout argument
+    argnames = protohandler.process_reserve_with_timeout.argnames
+    assert argnames == ('timeout',)
+    class Recorder(object):
+        def _send(self, line, handler, **options):
+            return line, options
+    Recorder = protohandler.protProvider(Recorder, interaction='_send',
+                                         options=('timeout',))
+    r = Recorder()
+    assert r.delete(1, timeout=0.5) == ('delete 1\r\n', {'timeout': 0.5})
+    assert r.reserve_with_timeout(timeout=3) == \
+        ('reserve-with-timeout 3\r\n', {})
@@ -0,0 +1,101 @@
+"""
+Transport tests: address parsing, socket options, and unix domain sockets
+for each connection type, using the in-process fake server.
+"""
+
+import os
+import socket
+import tempfile
+
+from nose.tools import with_setup, assert_raises
+
+from beanstalk import eventconn
+from beanstalk import multiserverconn
+from beanstalk import serverconn
+from beanstalk import transport
+from beanstalk.testing import FakeServer
+
+server = None
+
+
+def _setup():
+    global server
+    path = os.path.join(tempfile.mkdtemp(), 'beanstalkd.sock')
+    server = FakeServer(path).start()
+
+def _teardown():
+    server.stop()
+    os.rmdir(os.path.dirname(server.address))
+
+def _unix():
+    return transport.UNIX_PREFIX + server.address
+
+
+def test_parse_address():
+    inet, inet6 = socket.AF_INET, socket.AF_INET6
+    assert transport.parse_address('localhost', 11301) == \
+        (inet, ('localhost', 11301))
+    assert transport.parse_address(('10.0.0.1', '80')) == \
+        (inet, ('10.0.0.1', 80))
+    assert transport.parse_address('10.0.0.1:80') == (inet, ('10.0.0.1', 80))
+    assert transport.parse_address('localhost') == \
+        (inet, ('localhost', transport.DEFAULT_PORT))
+    assert transport.parse_address('[::1]:80') == (inet6, ('::1', 80))
+    assert transport.parse_address('fe80::1') == \
+        (inet6, ('fe80::1', transport.DEFAULT_PORT))
+    assert transport.parse_address('unix:/tmp/b.sock') == \
+        (socket.AF_UNIX, '/tmp/b.sock')
+    assert transport.format_address('unix:/tmp/b.sock') == 'unix:/tmp/b.sock'
+    assert transport.format_address('localhost', 11300) == 'localhost:11300'
+    assert transport.format_address('[::1]:80') == '[::1]:80'
+
+def test_socket_options():
+    assert transport.get_options(None) is transport.PROFILES['default']
+    assert transport.get_options('remote').keepalive
+    assert transport.get_options({'nodelay': True}).nodelay
+    assert_raises(ValueError, transport.get_options, 'fast')
+
+    sock, address = transport.make_socket('localhost', 11300, 'remote')
+    try:
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        # the kernel may round the buffer sizes, but not below the request
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= \
+            256 * 1024
+    finally:
+        sock.close()
+
+    # tcp options are skipped on unix sockets
+    sock, address = transport.make_socket('unix:/tmp/b.sock',
+                                          options='low-latency')
+    sock.close()
+
+@with_setup(_setup, _teardown)
+def test_serverconn_unix():
+    conn = serverconn.ServerConn(_unix(), socket_options='remote')
+    jid = conn.put('over a unix socket')['jid']
+    assert conn.reserve()['jid'] == jid
+    assert 'unix:' in repr(conn)
+    conn.close()
+
+@with_setup(_setup, _teardown)
+def test_pool_unix():
+    pool = multiserverconn.ServerPool([(_unix(), None, False)],
+                                      socket_options='low-latency')
+    pool.enable_metrics()
+    pool.put('pooled')
+    assert pool.servers[0]._metrics.name == _unix()
+    pool.close()
+
+@with_setup(_setup, _teardown)
+def test_eventconn_unix():
+    loop = eventconn.EventLoop()
+    results = []
+    conn = eventconn.EventConn(_unix(), loop=loop,
+                               result_callback=results.append,
+                               error_callback=lambda *exc_info: None)
+    conn.put('event')
+    conn.reserve()
+    loop.run(timeout=5)
+    assert results[1]['data'] == 'event'
+    loop.close()
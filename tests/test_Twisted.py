@@ -9,16 +9,20 @@ import time
 
 from zope.interface import provider
 from twisted.trial import unittest
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
 from twisted.logger import Logger, globalLogPublisher, formatEvent, STDLibLogObserver, ILogObserver
 
 # stuff under test
-from beanstalk.twisted_client import Beanstalk, BeanstalkClientFactory
+from beanstalk.twisted_client import Beanstalk, BeanstalkClientFactory, \
+     BeanstalkPool, ConsumerService
 from beanstalk import errors
 from beanstalk.job import Job
+from beanstalk.testing import FakeServer
 
 # test configuration
-from config import get_config
+from config import get_config, use_fake_server
 
 #
 # Set up nose testing
@@ -46,6 +50,10 @@ def setup():
    cmd = os.path.join(config.BPATH,config.BEANSTALKD)
    host = config.BEANSTALKD_HOST
    port = config.BEANSTALKD_PORT
+   if use_fake_server(config):
+      process = FakeServer((host, int(port))).start()
+      logger.info("fake beanstalkd server started at %s:%s" % process.address)
+      return
    try:
       process = subprocess.Popen([cmd, "-l", host, "-p", port])
    except OSError as exc:
@@ -58,6 +66,10 @@ def teardown():
    "shut down beanstalkd"
    stop_reactor() # required per nose docs on Twisted support
    logger = logging.getLogger("teardown")
+   if isinstance(process, FakeServer):
+      logger.info("stopping fake beanstalkd server at %s:%s" % process.address)
+      process.stop()
+      return
    logger.info("terminating beanstalkd at %i" % process.pid)
    os.kill(process.pid, signal.SIGTERM)
 
@@ -77,7 +89,9 @@ class TestTwistedClient(unittest.TestCase):
       self.creator = protocol.ClientCreator(reactor, Beanstalk)
 
    def tearDown(self):
-      self.conn.transport.loseConnection()
+      # the pool tests close their own connections
+      if hasattr(self, 'conn'):
+         self.conn.transport.loseConnection()
 
    @deferred() # required for nose integration
    def test_00_Job(self):
@@ -107,7 +121,7 @@ class TestTwistedClient(unittest.TestCase):
             self.assertEqual(stats["state"], "ok")
             self.logger.debug("got stats ok")
          #
-         statist.addCallback(onstats)
+         return statist.addCallback(onstats)
       connector = self.creator.connectTCP(self.host, self.port)
       return connector.addCallback(onconn)
 
@@ -154,3 +168,211 @@ class TestTwistedClient(unittest.TestCase):
       self.r = defer.Deferred()
       connector.addCallback(onconn)
       return self.r # chained after completion of putting and reserving
+
+   @deferred() # required for nose integration
+   def test_03_Metrics(self):
+      "metrics are recorded per command"
+
+      def onconn(conn):
+         self.conn = conn
+         conn.enable_metrics()
+         d = defer.gatherResults([conn.stats(), conn.list_tube_used()])
+         #
+         def check(results):
+            metrics = conn.metrics()
+            self.assertEqual(metrics['stats']['count'], 1)
+            self.assertEqual(metrics['list-tube-used']['replies'], {'ok': 1})
+            self.logger.debug("metrics ok")
+         return d.addCallback(check)
+
+      connector = self.creator.connectTCP(self.host, self.port)
+      return connector.addCallback(onconn)
+
+   def test_04_Split_Replies(self):
+      "several replies in one segment, and replies split anywhere"
+
+      replies = ('INSERTED 1\r\nRESERVED 1 5\r\nhello\r\nNOT_FOUND\r\n'
+                 'RESERVED 2 0\r\n\r\nDELETED\r\n')
+      expected = [{'jid': 1, 'state': 'ok'},
+                  {'jid': 1, 'bytes': 5, 'state': 'ok', 'data': 'hello'},
+                  errors.NotFound,
+                  {'jid': 2, 'bytes': 0, 'state': 'ok', 'data': ''},
+                  {'state': 'ok'}]
+      for size in (len(replies), 1, 3, 7):
+         self.conn = Beanstalk()
+         self.conn.makeConnection(proto_helpers.StringTransport())
+         results = []
+         for d in (self.conn.put('hello'), self.conn.reserve(),
+                   self.conn.delete(9), self.conn.reserve(),
+                   self.conn.delete(2)):
+            d.addCallbacks(results.append, lambda f: results.append(f.type))
+         for i in range(0, len(replies), size):
+            self.conn.dataReceived(replies[i:i + size])
+         self.assertEqual(results, expected)
+
+   def test_05_Backpressure(self):
+      "commands beyond max_in_flight are held back and producers paused"
+
+      class Producer(object):
+         paused = stopped = False
+         def pauseProducing(self):
+            self.paused = True
+         def resumeProducing(self):
+            self.paused = False
+         def stopProducing(self):
+            self.stopped = True
+
+      transport = proto_helpers.StringTransport()
+      self.conn = Beanstalk(max_in_flight=4)
+      self.conn.makeConnection(transport)
+      producer = Producer()
+      self.conn.registerProducer(producer)
+
+      results = []
+      for i in range(6):
+         self.conn.delete(i).addCallbacks(results.append,
+                                          lambda f: results.append(f.type))
+      self.assertTrue(producer.paused)
+      self.assertEqual(transport.value().count('delete'), 4)
+      ready = []
+      self.conn.whenReady().addCallback(ready.append)
+
+      self.conn.dataReceived('DELETED\r\n' * 3)
+      # the held back commands went out, three are still outstanding
+      self.assertEqual(transport.value().count('delete'), 6)
+      self.assertTrue(producer.paused)
+      self.assertEqual(ready, [])
+
+      self.conn.dataReceived('DELETED\r\n')
+      self.assertFalse(producer.paused)
+      self.assertEqual(ready, [self.conn])
+
+      self.conn.connectionLost(failure.Failure(error.ConnectionDone()))
+      self.assertEqual(results, [{'state': 'ok'}] * 4 +
+                                [error.ConnectionDone] * 2)
+      self.assertTrue(producer.stopped)
+
+   @deferred() # required for nose integration
+   def test_06_Pipelining(self):
+      "hundreds of pipelined commands against a server"
+
+      count = 500
+
+      @defer.inlineCallbacks
+      def onconn(conn):
+         self.conn = conn
+         conn.use('pipelining')
+         conn.watch('pipelining')
+         conn.ignore('default')
+         puts = yield defer.gatherResults(
+            [conn.put('job %d' % i) for i in range(count)])
+         jobs = yield defer.gatherResults(
+            [conn.reserve() for i in range(count)])
+         self.assertEqual([job['data'] for job in jobs],
+                          ['job %d' % i for i in range(count)])
+         yield defer.gatherResults([conn.delete(job['jid']) for job in jobs])
+         stats = yield conn.stats_tube('pipelining')
+         self.assertEqual(stats['data']['current-jobs-ready'], 0)
+
+      creator = protocol.ClientCreator(reactor, Beanstalk, max_in_flight=50)
+      connector = creator.connectTCP(self.host, self.port)
+      return connector.addCallback(onconn)
+
+   @deferred(timeout=10) # required for nose integration
+   def test_07_Pool(self):
+      "a pool spreads commands over its connections"
+
+      pool = BeanstalkPool([(self.host, self.port)], size=3, use='pooled')
+      pool.start()
+
+      @defer.inlineCallbacks
+      def check(pool):
+         while len(pool.connections()) < 3:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+         puts = [pool.put('job %d' % i) for i in range(9)]
+         self.assertEqual(sorted(p.pending() for p in pool.connections()),
+                          [3, 3, 3])
+         yield defer.gatherResults(puts)
+
+         conn = yield pool.acquire()
+         for i in range(5):
+            self.assertNotEqual(pool.pick(), conn)
+         pool.release(conn)
+         stats = yield pool.stats_tube('pooled')
+         self.assertEqual(stats['data']['current-jobs-ready'], 9)
+         yield pool.stop()
+         self.assertEqual(pool.connections(), [])
+
+      return pool.whenConnected().addCallback(check)
+
+   @deferred(timeout=20) # required for nose integration
+   def test_08_ConsumerService(self):
+      "concurrent consumer loops process, retry and delete jobs"
+
+      pool = BeanstalkPool([(self.host, self.port)], size=3, use='consumed',
+                           watch=['consumed'])
+      pool.start()
+      seen = []
+      running = [0, 0] # now, most at once
+
+      def process(conn, job):
+         running[0] += 1
+         running[1] = max(running)
+         seen.append(job['data'])
+         def done():
+            running[0] -= 1
+            if job['data'] == 'job 3' and seen.count('job 3') == 1:
+               raise ValueError('try again')
+         return task.deferLater(reactor, 0.01, done)
+
+      consumer = ConsumerService(pool, process, concurrency=3, timeout=0)
+
+      @defer.inlineCallbacks
+      def check(pool):
+         yield defer.gatherResults([pool.put('job %d' % i) for i in range(12)])
+         consumer.startService()
+         while consumer.processed < 12:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+         yield consumer.stopService()
+         self.assertEqual(consumer.failed, 1)
+         self.assertEqual(sorted(set(seen)),
+                          sorted('job %d' % i for i in range(12)))
+         self.assertEqual(len(seen), 13)
+         self.assertTrue(1 < running[1] <= 3)
+         stats = yield pool.stats_tube('consumed')
+         self.assertEqual(stats['data']['current-jobs-ready'], 0)
+         self.assertEqual(stats['data']['current-jobs-reserved'], 0)
+         yield pool.stop()
+
+      return pool.whenConnected().addCallback(check)
+
+   @deferred(timeout=20) # required for nose integration
+   def test_09_ConsumerService_Retry_Priority(self):
+      "a job that failed is released with its own priority"
+
+      pool = BeanstalkPool([(self.host, self.port)], size=1, use='retried',
+                           watch=['retried'])
+      pool.start()
+      pris = []
+
+      @defer.inlineCallbacks
+      def process(conn, job):
+         stats = yield conn.stats_job(job['jid'])
+         pris.append(stats['data']['pri'])
+         if len(pris) == 1:
+            raise ValueError('try again')
+
+      consumer = ConsumerService(pool, process, timeout=0)
+
+      @defer.inlineCallbacks
+      def check(pool):
+         yield pool.put('urgent', 7)
+         consumer.startService()
+         while consumer.processed < 1:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+         yield consumer.stopService()
+         self.assertEqual(consumer.failed, 1)
+         self.assertEqual(pris, [7, 7])
+         yield pool.stop()
+
+      return pool.whenConnected().addCallback(check)